@@ -1,8 +1,13 @@
+import asyncio
+import gzip
 import time
 import random as rd
 from abc import abstractmethod
 from .util import get_logger
 from .smp import *
+from .tokenizer import count_tokens
+from .cache import request_key
+from .telemetry import RequestTrace
 
 
 class BaseAPI:
@@ -13,8 +18,17 @@ class BaseAPI:
                  system_prompt=None,
                  verbose=True,
                  fail_msg='Failed to obtain answer via API.',
+                 rate_limiter=None,
+                 response_cache=None,
+                 telemetry=None,
                  **kwargs):
         self.wait = wait
+        # a shared ratelimit.RateLimiter, replaces the blind random delays if set
+        self.rate_limiter = rate_limiter
+        # a cache.ResponseCache, answers found there are returned without any request
+        self.response_cache = response_cache
+        # a telemetry.Telemetry sink, one request event is written per generate call
+        self.telemetry = telemetry
         self.retry = retry
         self.system_prompt = system_prompt
         self.kwargs = kwargs
@@ -33,6 +47,59 @@ class BaseAPI:
         # if ret_code is 0, means succeed
         return ret_code, answer, log
 
+    def estimate_tokens(self, inputs, **kwargs):
+        # the number of tokens charged to the rate limiter for one request
+        return 0
+
+    def retry_delay(self, i, ret_code):
+        if self.rate_limiter is None:
+            return rd.random() * self.wait * 2
+        # 429s are paused by the limiter itself, back off exponentially for other failures
+        if ret_code == 429:
+            return 0
+        return rd.random() * min(self.wait * 2 ** i, 60)
+
+    def prepare_request(self, inputs, **kwargs):
+        # build everything that does not change across retries only once
+        return inputs, kwargs
+
+    def cache_key(self, inputs, **kwargs):
+        # the key of the request in the response cache, None if it should not be cached
+        return None
+
+    def response_info(self, log):
+        # prompt_tokens / completion_tokens / bytes_sent of a call, for the telemetry
+        return {}
+
+    def lookup_cache(self, inputs, **kwargs):
+        """Returns ``(key, cached answer)``, both None without a cache."""
+        if self.response_cache is None:
+            return None, None
+        try:
+            key = self.cache_key(inputs, **kwargs)
+            return key, self.response_cache.get(key)
+        except Exception as err:
+            self.logger.warning(f'Response cache lookup failed: {err}')
+            return None, None
+
+    def store_cache(self, key, answer):
+        if self.response_cache is None or key is None:
+            return
+        try:
+            self.response_cache.put(key, answer)
+        except Exception as err:
+            self.logger.warning(f'Response cache write failed: {err}')
+
+    async def agenerate_inner(self, request):
+        self.logger.warning('For APIBase, agenerate_inner is an abstract method. ')
+        assert 0, 'agenerate_inner not defined'
+        ret_code, answer, log = None, None, None
+        # if ret_code is 0, means succeed
+        return ret_code, answer, log
+
+    async def aclose(self):
+        pass
+
     def working(self):
         retry = 3
         while retry > 0:
@@ -52,17 +119,32 @@ class BaseAPI:
             input_type = 'dictlist'
         assert input_type is not None, input_type
 
-        answer = None
-        # a very small random delay [0s - 0.5s]
-        T = rd.random() * 0.5
-        time.sleep(T)
+        trace = RequestTrace(self.telemetry)
+        key, answer = self.lookup_cache(inputs, **kwargs)
+        if answer is not None:
+            trace.finish(True, cached=True)
+            return answer
+        if self.rate_limiter is None:
+            # a very small random delay [0s - 0.5s]
+            T = rd.random() * 0.5
+            time.sleep(T)
+        else:
+            tokens = self.estimate_tokens(inputs, **kwargs)
 
         for i in range(self.retry):
+            ret_code, headers = None, None
+            if self.rate_limiter is not None:
+                self.rate_limiter.acquire(tokens)
             try:
+                trace.begin_attempt()
                 ret_code, answer, log = self.generate_inner(inputs, **kwargs)
+                headers = getattr(log, 'headers', None)
+                trace.end_attempt(ret_code, self.response_info(log))
                 if ret_code == 0 and self.fail_msg not in answer and answer != '':
                     if self.verbose:
                         print(answer)
+                    self.store_cache(key, answer)
+                    trace.finish(True)
                     return answer
                 elif self.verbose:
                     if not isinstance(log, str):
@@ -72,15 +154,92 @@ class BaseAPI:
                             self.logger.warning(f'Failed to parse {log} as an http response. ')
                     self.logger.info(f'RetCode: {ret_code}\nAnswer: {answer}\nLog: {log}')
             except Exception as err:
+                trace.end_attempt('error')
                 if self.verbose:
                     self.logger.error(f'An error occured during try {i}:')
                     self.logger.error(err)
+            finally:
+                if self.rate_limiter is not None:
+                    self.rate_limiter.release(ret_code, headers)
             # delay before each retry
-            T = rd.random() * self.wait * 2
+            T = self.retry_delay(i, ret_code)
             time.sleep(T)
 
+        trace.finish(False)
+        return self.fail_msg if answer in ['', None] else answer
+
+    async def agenerate(self, inputs, **kwargs):
+        """The asyncio counterpart of ``generate``. The request is prepared
+        once and reused by all retries."""
+        trace = RequestTrace(self.telemetry)
+        try:
+            request = self.prepare_request(inputs, **kwargs)
+        except Exception as err:
+            self.logger.error(f'Failed to prepare the request: {err}')
+            trace.finish(False)
+            return self.fail_msg
+        key, answer = self.lookup_cache(inputs, **kwargs)
+        if answer is not None:
+            trace.finish(True, cached=True)
+            return answer
+        if self.rate_limiter is None:
+            await asyncio.sleep(rd.random() * 0.5)
+        else:
+            tokens = self.estimate_tokens(inputs, **kwargs)
+
+        for i in range(self.retry):
+            ret_code, headers = None, None
+            if self.rate_limiter is not None:
+                await self.rate_limiter.aacquire(tokens)
+            try:
+                trace.begin_attempt()
+                ret_code, answer, log = await self.agenerate_inner(request)
+                headers = getattr(log, 'headers', None)
+                trace.end_attempt(ret_code, self.response_info(log))
+                if ret_code == 0 and self.fail_msg not in answer and answer != '':
+                    if self.verbose:
+                        print(answer)
+                    self.store_cache(key, answer)
+                    trace.finish(True)
+                    return answer
+                elif self.verbose:
+                    if not isinstance(log, str):
+                        try:
+                            log = log.text
+                        except:
+                            self.logger.warning(f'Failed to parse {log} as an http response. ')
+                    self.logger.info(f'RetCode: {ret_code}\nAnswer: {answer}\nLog: {log}')
+            except Exception as err:
+                trace.end_attempt('error')
+                if self.verbose:
+                    self.logger.error(f'An error occured during try {i}:')
+                    self.logger.error(err)
+            finally:
+                if self.rate_limiter is not None:
+                    self.rate_limiter.release(ret_code, headers)
+            await asyncio.sleep(self.retry_delay(i, ret_code))
+
+        trace.finish(False)
         return self.fail_msg if answer in ['', None] else answer
 
+    async def agenerate_batch(self, inputs_list, concurrency=64, callback=None, **kwargs):
+        """Run ``agenerate`` over ``inputs_list`` with at most ``concurrency``
+        requests in flight. ``callback(idx, answer)`` is called as soon as
+        each request finishes. Returns the answers in input order."""
+        sem = asyncio.Semaphore(concurrency)
+
+        async def _run(idx, inputs):
+            async with sem:
+                answer = await self.agenerate(inputs, **kwargs)
+            if callback is not None:
+                callback(idx, answer)
+            return answer
+
+        try:
+            return await asyncio.gather(*[_run(i, x) for i, x in enumerate(inputs_list)])
+        finally:
+            await self.aclose()
+
 APIBASES = {
     'OFFICIAL': 'https://api.openai.com/v1/chat/completions',
 }
@@ -108,6 +267,68 @@ def GPT_context_window(model):
         return 4096
 
 
+class StreamReader:
+    """Accumulates the content of a server-sent event stream of chat
+    completion chunks. ``feed`` returns True once the stream can be closed:
+    at ``[DONE]``, or as soon as ``answer_complete(text)`` holds."""
+
+    def __init__(self, answer_complete=None):
+        self.answer_complete = answer_complete
+        self.parts = []
+        self.usage = None
+        self.ttft = None
+        self.early_stop = False
+        self.start = time.time()
+
+    @property
+    def text(self):
+        return ''.join(self.parts)
+
+    def feed(self, line):
+        if not line.startswith('data:'):
+            return False
+        data = line[len('data:'):].strip()
+        if data == '[DONE]':
+            return True
+        try:
+            chunk = json.loads(data)
+        except ValueError:
+            return False
+        if chunk.get('usage'):
+            self.usage = chunk['usage']
+        new = False
+        for choice in chunk.get('choices') or []:
+            content = (choice.get('delta') or {}).get('content')
+            if content:
+                if self.ttft is None:
+                    self.ttft = time.time() - self.start
+                self.parts.append(content)
+                new = True
+        if new and self.answer_complete is not None and self.answer_complete(self.text):
+            self.early_stop = True
+            return True
+        return False
+
+
+class StreamLog:
+    """What is kept of a streamed response: the status, headers and request
+    of the response, and the usage, time to first token and early stop flag
+    of the stream."""
+
+    def __init__(self, response, reader):
+        self.status_code = response.status_code
+        self.headers = response.headers
+        self.request = response.request
+        self.ttft = reader.ttft
+        self.early_stop = reader.early_stop
+        self.text = json.dumps(dict(usage=reader.usage))
+
+
+def is_image(s):
+    # long prompts are never image paths, skip the filesystem lookup for them
+    return s.startswith('http') or (len(s) < 4096 and '\n' not in s and osp.exists(s))
+
+
 class OpenAIWrapper(BaseAPI):
 
     is_api: bool = True
@@ -125,6 +346,10 @@ class OpenAIWrapper(BaseAPI):
                  max_tokens: int = 1024,
                  img_size: int = 512,
                  img_detail: str = 'low',
+                 max_connections: int = 256,
+                 http2: bool = False,
+                 gzip_threshold: int = 0,
+                 stream: bool = False,
                  **kwargs):
 
         self.model = model
@@ -145,6 +370,13 @@ class OpenAIWrapper(BaseAPI):
         if model == 'gpt-4-vision-preview':
             self.vision = True
         self.timeout = timeout
+        # settings of the asyncio client, gzip_threshold = 0 disables compression
+        self.max_connections = max_connections
+        self.http2 = http2
+        self.gzip_threshold = gzip_threshold
+        # stream the completions, so that reading can stop as soon as the answer is complete
+        self.stream = stream
+        self._aclient = None
 
         assert isinstance(openai_key, str) and openai_key.startswith('sk-'), (
             f'Illegal openai_key {openai_key}. '
@@ -180,7 +412,7 @@ class OpenAIWrapper(BaseAPI):
             return input_msgs
         str_flag = [isinstance(x, str) for x in inputs]
         if np.all(str_flag):
-            img_flag = [x.startswith('http') or osp.exists(x) for x in inputs]
+            img_flag = [is_image(x) for x in inputs]
             if np.any(img_flag):
                 content_list = []
                 for fl, msg in zip(img_flag, inputs):
@@ -204,20 +436,29 @@ class OpenAIWrapper(BaseAPI):
                 return input_msgs
         raise NotImplementedError('list of list prompt not implemented now. ')
 
-    def generate_inner(self, inputs, **kwargs) -> str:
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_aclient'] = None
+        return state
+
+    def prepare_request(self, inputs, **kwargs):
+        """Serialize the request body. Returns None if the input does not fit
+        into the context window."""
         input_msgs = self.prepare_inputs(inputs)
+        answer_complete = kwargs.pop('answer_complete', None)
         temperature = kwargs.pop('temperature', self.temperature)
         max_tokens = kwargs.pop('max_tokens', self.max_tokens)
 
         context_window = GPT_context_window(self.model)
-        max_tokens = min(max_tokens, context_window - self.get_token_len(inputs))
+        prompt_tokens = self.get_token_len(inputs)
+        max_tokens = min(max_tokens, context_window - prompt_tokens)
         if 0 < max_tokens <= 100:
             self.logger.warning(
                 'Less than 100 tokens left, '
                 'may exceed the context window with some additional meta symbols. '
             )
         if max_tokens <= 0:
-            return 0, self.fail_msg + 'Input string longer than context window. ', 'Length Exceeded. '
+            return None
 
         headers = {'Content-Type': 'application/json', 'Authorization': f'Bearer {self.openai_key}'}
         payload = dict(
@@ -227,28 +468,140 @@ class OpenAIWrapper(BaseAPI):
             n=1,
             temperature=temperature,
             **kwargs)
-        response = requests.post(self.api_base, headers=headers, data=json.dumps(payload), timeout=self.timeout * 1.1)
-        ret_code = response.status_code
-        ret_code = 0 if (200 <= int(ret_code) < 300) else ret_code
+        if self.stream:
+            payload.update(stream=True, stream_options=dict(include_usage=True))
+        body = json.dumps(payload).encode('utf-8')
+        if self.gzip_threshold > 0 and len(body) >= self.gzip_threshold:
+            body = gzip.compress(body, compresslevel=1)
+            headers['Content-Encoding'] = 'gzip'
+        return dict(headers=headers, body=body, stream=self.stream, answer_complete=answer_complete,
+                    prompt_tokens=prompt_tokens)
+
+    def cache_key(self, inputs, **kwargs):
+        # everything that determines the answer, max_tokens before clipping to the context window
+        return request_key(
+            model=self.model,
+            api_base=self.api_base,
+            messages=self.prepare_inputs(inputs),
+            temperature=kwargs.get('temperature', self.temperature),
+            max_tokens=kwargs.get('max_tokens', self.max_tokens),
+            # an answer cut as soon as it is complete differs from the full one
+            early_stop=getattr(kwargs.get('answer_complete'), '__name__', None) if self.stream else None,
+            kwargs={k: v for k, v in kwargs.items() if k not in ['temperature', 'max_tokens', 'answer_complete']})
+
+    def estimate_tokens(self, inputs, **kwargs):
+        # the requested max_tokens also count towards the tokens/minute limit
+        max_tokens = kwargs.get('max_tokens', self.max_tokens)
+        return self.get_token_len(inputs) + max_tokens
+
+    def response_info(self, log):
+        info = {}
+        if self.telemetry is None:
+            return info
+        try:
+            # requests keeps the sent body in request.body, httpx in request.content
+            request = log.request
+            body = getattr(request, 'body', None)
+            body = request.content if body is None else body
+            info['bytes_sent'] = len(body)
+        except Exception:
+            pass
+        try:
+            usage = json.loads(log.text).get('usage') or {}
+            info['prompt_tokens'] = usage.get('prompt_tokens')
+            info['completion_tokens'] = usage.get('completion_tokens')
+        except Exception:
+            pass
+        if isinstance(log, StreamLog):
+            info.update(ttft=log.ttft, early_stop=log.early_stop)
+        return info
+
+    def parse_response(self, status_code, text):
+        ret_code = 0 if (200 <= int(status_code) < 300) else status_code
         answer = self.fail_msg
         try:
-            resp_struct = json.loads(response.text)
+            resp_struct = json.loads(text)
             answer = resp_struct['choices'][0]['message']['content'].strip()
         except:
             pass
+        return ret_code, answer
+
+    def generate_inner(self, inputs, **kwargs) -> str:
+        request = self.prepare_request(inputs, **kwargs)
+        if request is None:
+            return 0, self.fail_msg + 'Input string longer than context window. ', 'Length Exceeded. '
+        if request['stream']:
+            reader = StreamReader(request['answer_complete'])
+            response = requests.post(
+                self.api_base, headers=request['headers'], data=request['body'], timeout=self.timeout * 1.1,
+                stream=True)
+            if response.status_code != 200:
+                ret_code, answer = self.parse_response(response.status_code, response.text)
+                return ret_code, answer, response
+            with response:
+                for line in response.iter_lines(decode_unicode=True):
+                    if line and reader.feed(line):
+                        break
+            return self.finish_stream(reader, response, request)
+        response = requests.post(
+            self.api_base, headers=request['headers'], data=request['body'], timeout=self.timeout * 1.1)
+        ret_code, answer = self.parse_response(response.status_code, response.text)
         return ret_code, answer, response
 
+    def finish_stream(self, reader, response, request):
+        answer = reader.text.strip()
+        if reader.usage is None:
+            # the usage chunk comes last, estimate it if the stream was closed early
+            reader.usage = dict(prompt_tokens=request['prompt_tokens'],
+                                completion_tokens=count_tokens(reader.text, self.model))
+        log = StreamLog(response, reader)
+        if answer == '':
+            return response.status_code, self.fail_msg, log
+        return 0, answer, log
+
+    def _get_aclient(self):
+        # an httpx client is bound to the event loop it was created in
+        loop = asyncio.get_running_loop()
+        if self._aclient is None or self._aclient[0] is not loop:
+            import httpx
+            limits = httpx.Limits(
+                max_connections=self.max_connections, max_keepalive_connections=self.max_connections)
+            client = httpx.AsyncClient(limits=limits, http2=self.http2, timeout=self.timeout * 1.1)
+            self._aclient = (loop, client)
+        return self._aclient[1]
+
+    async def agenerate_inner(self, request):
+        if request is None:
+            return 0, self.fail_msg + 'Input string longer than context window. ', 'Length Exceeded. '
+        client = self._get_aclient()
+        if request['stream']:
+            reader = StreamReader(request['answer_complete'])
+            async with client.stream('POST', self.api_base, headers=request['headers'],
+                                     content=request['body']) as response:
+                if response.status_code != 200:
+                    await response.aread()
+                    ret_code, answer = self.parse_response(response.status_code, response.text)
+                    return ret_code, answer, response
+                # leaving the block early closes the connection, which stops the generation
+                async for line in response.aiter_lines():
+                    if line and reader.feed(line):
+                        break
+            return self.finish_stream(reader, response, request)
+        response = await client.post(self.api_base, headers=request['headers'], content=request['body'])
+        ret_code, answer = self.parse_response(response.status_code, response.text)
+        return ret_code, answer, response
+
+    async def aclose(self):
+        if self._aclient is not None:
+            await self._aclient[1].aclose()
+            self._aclient = None
+
     def get_token_len(self, inputs) -> int:
-        import tiktoken
-        try:
-            enc = tiktoken.encoding_for_model(self.model)
-        except:
-            enc = tiktoken.encoding_for_model('gpt-4')
         if isinstance(inputs, str):
-            if inputs.startswith('http') or osp.exists(inputs):
+            if is_image(inputs):
                 return 65 if self.img_detail == 'low' else 130
             else:
-                return len(enc.encode(inputs))
+                return count_tokens(inputs, self.model)
         elif isinstance(inputs, dict):
             assert 'content' in inputs
             return self.get_token_len(inputs['content'])
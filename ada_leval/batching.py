@@ -0,0 +1,132 @@
+import argparse
+import random as rd
+import time
+from collections import namedtuple
+
+
+def pack_batches(lens, budget, max_batch=None):
+    """Group positions into batches of similar lengths, longest first, with
+    the total tokens of each batch under ``budget``. A prompt longer than the
+    budget gets a batch of its own."""
+    order = sorted(range(len(lens)), key=lambda k: lens[k], reverse=True)
+    batches, cur, tot = [], [], 0
+    for k in order:
+        if len(cur) and (tot + lens[k] > budget or (max_batch is not None and len(cur) >= max_batch)):
+            batches.append(cur)
+            cur, tot = [], 0
+        cur.append(k)
+        tot += lens[k]
+    if len(cur):
+        batches.append(cur)
+    return batches
+
+
+def _run_window(model, window, lengths, budget, max_batch, stats):
+    prompts = [x[2] for x in window]
+    lens = lengths(prompts)
+    for batch in pack_batches(lens, budget, max_batch):
+        outputs = model([prompts[k] for k in batch])
+        for k, out in zip(batch, outputs):
+            i, index, _, _ = window[k]
+            if stats is not None:
+                stats['items'] += 1
+                stats['tokens'] += lens[k]
+            yield i, index, out.text
+
+
+def batch_dispatch(model, items, lengths, token_budget, window=256, max_batch=None, stats=None):
+    """Call a local pipeline on batches of prompts instead of one at a time.
+
+    Up to ``window`` pending items are buffered, sorted by token length and
+    packed into batches of at most ``token_budget`` tokens, each of which is
+    passed to ``model`` as a list. Yields ``(i, index, prediction)``.
+
+    Args:
+        model: A pipeline called as ``model(prompts)``, returning one
+            response with a ``text`` attribute per prompt.
+        items: ``(i, index, prompt, prediction)`` from ``admit_stage``.
+        lengths (callable): Maps a list of prompts to their token counts.
+        token_budget (int): Max total prompt tokens of one batch.
+        window (int): Max items buffered for sorting. Defaults to 256.
+        max_batch (int, optional): Max prompts of one batch.
+        stats (dict, optional): If given, ``items`` and ``tokens`` are
+            accumulated into it.
+    """
+    buf = []
+    for item in items:
+        i, index, _, pred = item
+        if pred is not None:
+            yield i, index, pred
+            continue
+        buf.append(item)
+        if len(buf) >= window:
+            yield from _run_window(model, buf, lengths, token_budget, max_batch, stats)
+            buf = []
+    if len(buf):
+        yield from _run_window(model, buf, lengths, token_budget, max_batch, stats)
+
+
+Response = namedtuple('Response', ['text'])
+
+
+class FakePipeline:
+    """A CPU stand-in of the lmdeploy ``pipeline``, for testing and
+    benchmarking the batching path.
+
+    A call sleeps ``launch`` seconds plus the prefill time of its prompts,
+    where up to ``parallel`` sequences share the engine, i.e. the prefill rate
+    of a batch is ``rate * min(len(batch), parallel)`` tokens per second.
+    Prompt lengths are estimated as ``len(prompt) // 4``. The response is
+    the first line of the prompt.
+    """
+
+    def __init__(self, rate=200000, launch=0.02, parallel=8):
+        self.rate = rate
+        self.launch = launch
+        self.parallel = parallel
+        self.calls = 0
+
+    @staticmethod
+    def lengths(prompts):
+        return [len(p) // 4 for p in prompts]
+
+    def __call__(self, prompts, **kwargs):
+        single = isinstance(prompts, str)
+        prompts = [prompts] if single else prompts
+        self.calls += 1
+        tokens = sum(self.lengths(prompts))
+        time.sleep(self.launch + tokens / (self.rate * min(len(prompts), self.parallel)))
+        res = [Response(p.split('\n', 1)[0]) for p in prompts]
+        return res[0] if single else res
+
+
+def _bench(name, model, items, dispatch):
+    t = time.time()
+    for _ in dispatch(model, items):
+        pass
+    elapsed = time.time() - t
+    tokens = sum(FakePipeline.lengths([x[2] for x in items]))
+    print(f'{name:<12} {len(items) / elapsed:8.2f} items/s {tokens / elapsed:12.0f} tokens/s '
+          f'{model.calls:6d} calls {elapsed:8.2f}s')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Compare the per-prompt loop with token-budget batching on a fake pipeline. ')
+    parser.add_argument('--num', type=int, default=200)
+    parser.add_argument('--min-tokens', type=int, default=1000)
+    parser.add_argument('--max-tokens', type=int, default=8000)
+    parser.add_argument('--token-budget', type=int, default=32000)
+    parser.add_argument('--window', type=int, default=256)
+    args = parser.parse_args()
+
+    rd.seed(0)
+    items = []
+    for i in range(args.num):
+        n = rd.randint(args.min_tokens, args.max_tokens)
+        items.append((i, i, f'{i}\n' + 'x' * (4 * n), None))
+
+    from .pipeline import local_dispatch
+    _bench('per-prompt', FakePipeline(), items, lambda m, x: local_dispatch(lambda p: m(p).text, x))
+    _bench('batched', FakePipeline(), items, lambda m, x: batch_dispatch(
+        m, x, FakePipeline.lengths, args.token_budget, window=args.window))
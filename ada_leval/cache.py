@@ -0,0 +1,158 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+# (path, mode, pid, thread) -> connection, shared by the copies of a cache unpickled in the same pool worker
+_CONNECTIONS = {}
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS responses (
+    key TEXT PRIMARY KEY,
+    answer TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    created REAL NOT NULL,
+    last_used REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS responses_last_used ON responses (last_used);
+CREATE TABLE IF NOT EXISTS stats (
+    name TEXT PRIMARY KEY,
+    value INTEGER NOT NULL
+);
+"""
+
+
+def request_key(**fields):
+    """The content address of a request: a hash of its canonical json."""
+    payload = json.dumps(fields, sort_keys=True, ensure_ascii=False, separators=(',', ':'))
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+class ResponseCache:
+    """A persistent, content-addressed cache of API answers in SQLite.
+
+    Answers are keyed by :func:`request_key` of everything that determines
+    them (see ``OpenAIWrapper.cache_key``), so they survive crashes, result
+    file renames and prompt template changes that leave a request unchanged.
+    The database is in WAL mode and can be shared by all processes of a run.
+    Hit / miss counters are kept in the database as well, so that they cover
+    all processes. A lookup only writes on a hit, to mark the answer as
+    recently used; a miss is counted along with the write of its answer.
+
+    Args:
+        path (str): The SQLite database file.
+        mode (str): ``'rw'`` reads and writes through the cache, ``'r'`` only
+            reads (the database is left untouched) and ``'w'`` only writes,
+            refreshing the cached answers. Defaults to ``'rw'``.
+        max_bytes (int): The cap of the total size of cached answers. The
+            least recently used answers are evicted when it is exceeded,
+            checked every ``check_every`` writes (counted in the database,
+            across processes). Defaults to 1 GiB.
+    """
+
+    def __init__(self, path, mode='rw', max_bytes=1 << 30, check_every=32):
+        assert mode in ['rw', 'r', 'w'], mode
+        self.path = path
+        self.mode = mode
+        self.max_bytes = max_bytes
+        self.check_every = check_every
+        if mode != 'r':
+            dirname = os.path.dirname(path)
+            if dirname:
+                os.makedirs(dirname, exist_ok=True)
+            with self._conn() as conn:
+                conn.executescript(_SCHEMA)
+
+    def _conn(self):
+        # sqlite connections can not be shared across threads or processes, the pool
+        # unpickles a copy of the cache for every task, which reuses the connection of its worker
+        ident = (self.path, self.mode, os.getpid(), threading.get_ident())
+        conn = _CONNECTIONS.get(ident)
+        if conn is None:
+            if self.mode == 'r':
+                conn = sqlite3.connect(f'file:{self.path}?mode=ro', uri=True, timeout=60)
+            else:
+                conn = sqlite3.connect(self.path, timeout=60)
+                conn.execute('PRAGMA journal_mode=WAL')
+                conn.execute('PRAGMA synchronous=NORMAL')
+            _CONNECTIONS[ident] = conn
+        return conn
+
+    def _count(self, conn, name, n=1):
+        conn.execute(
+            'INSERT INTO stats (name, value) VALUES (?, ?) '
+            'ON CONFLICT(name) DO UPDATE SET value = value + excluded.value', (name, n))
+        return conn.execute('SELECT value FROM stats WHERE name = ?', (name, )).fetchone()[0]
+
+    def get(self, key):
+        """The cached answer of ``key``, or None."""
+        if self.mode == 'w' or key is None:
+            return None
+        try:
+            conn = self._conn()
+            row = conn.execute('SELECT answer FROM responses WHERE key = ?', (key, )).fetchone()
+        except sqlite3.OperationalError:
+            # a read-only cache that has not been created
+            return None
+        if self.mode == 'r' or row is None:
+            return None if row is None else row[0]
+        with conn:
+            conn.execute('UPDATE responses SET last_used = ? WHERE key = ?', (time.time(), key))
+            self._count(conn, 'hit')
+        return row[0]
+
+    def put(self, key, answer):
+        if self.mode == 'r' or key is None:
+            return
+        conn = self._conn()
+        now = time.time()
+        with conn:
+            conn.execute(
+                'INSERT OR REPLACE INTO responses (key, answer, size, created, last_used) VALUES (?, ?, ?, ?, ?)',
+                (key, answer, len(answer.encode('utf-8')), now, now))
+            if self.mode == 'rw':
+                # answers are only written after a lookup missed
+                self._count(conn, 'miss')
+            writes = self._count(conn, 'write')
+        if writes % self.check_every == 0:
+            self.evict()
+
+    def evict(self):
+        """Drop the least recently used answers until the cache fits into
+        ``max_bytes``. Returns the number of answers dropped."""
+        conn = self._conn()
+        with conn:
+            total = conn.execute('SELECT total(size) FROM responses').fetchone()[0]
+            if total <= self.max_bytes:
+                return 0
+            dropped, excess = 0, total - self.max_bytes
+            for key, size in conn.execute('SELECT key, size FROM responses ORDER BY last_used').fetchall():
+                if excess <= 0:
+                    break
+                conn.execute('DELETE FROM responses WHERE key = ?', (key, ))
+                excess -= size
+                dropped += 1
+            self._count(conn, 'evict', dropped)
+        return dropped
+
+    def stats(self):
+        """Counters accumulated by all users of the database, and its size."""
+        try:
+            conn = self._conn()
+            res = dict(conn.execute('SELECT name, value FROM stats').fetchall())
+            res['entries'], res['bytes'] = conn.execute('SELECT count(*), total(size) FROM responses').fetchone()
+        except sqlite3.OperationalError:
+            res = dict(entries=0, bytes=0)
+        for k in ['hit', 'miss', 'write', 'evict']:
+            res.setdefault(k, 0)
+        return res
+
+    @staticmethod
+    def report(before, after):
+        """Describe the hits and misses between two ``stats()`` snapshots."""
+        hit, miss = after['hit'] - before['hit'], after['miss'] - before['miss']
+        rate = 100 * hit / max(hit + miss, 1)
+        return (f'Response cache: {hit} hits, {miss} misses ({rate:.1f}% hit rate), '
+                f"{after['entries']} entries, {after['bytes'] / 2 ** 20:.1f} MiB")
@@ -1,23 +1,106 @@
+import math
+import re
 from ada_leval.smp import *
+from ada_leval.tokenizer import TokenIndex
+from ada_leval.indexed import load_records
+from ada_leval.segments import SegmentStore
+
+
+def setting_tokens(setting):
+    """The nominal prompt tokens of a setting, e.g. 16000 for ``'16k'`` and
+    1000000 for ``'1m'``."""
+    m = re.fullmatch(r'(\d+)([km])', setting)
+    if m is None:
+        raise ValueError(f'Invalid setting {setting}, expected e.g. 16k or 1m. ')
+    return int(m.group(1)) * (1000 if m.group(2) == 'k' else 1000000)
+
+
+# the layout of the released TSort prompts, {k} is the displayed number of a segment
+TEXTSORT_TEMPLATE = dict(
+    instruction=('You are an AI assistant. Your job is to sort the 4 segments of a novel in the right order. '
+                 'Give your answer in the format "Answer: [x, x, x, x]".\n\n'),
+    before='Context before the segments:\n{text}\n\n',
+    segment='Segment {k}:\n{text}\n\n',
+    after='Context after the segments:\n{text}\n\nAnswer: ')
+
+
+# ascii digits only, as str.find of the designations: \d also matches e.g. '３' or '٣'
+_DESIGNATION = re.compile(r'(A?)([0-9]+)')
+
+
+def _prefix_choice(digits, start, width, num_choice):
+    # the largest choice whose decimal string starts at digits[start]
+    if digits[start] == '0':
+        return 0
+    for ln in range(min(width, len(digits) - start), 0, -1):
+        v = int(digits[start: start + ln])
+        if v <= num_choice:
+            return v
+    return 0
+
+
+# an 'Answer:' followed by a designation that can not grow any more
+_COMPLETE_CHOICE = re.compile(r'Answer:\s*A?[0-9]+[^0-9]')
+_COMPLETE_ORDER = re.compile(r'Answer:\s*(\[[^\[\]]*\])')
+
+
+def stackselect_answer_complete(text):
+    """True once a streamed BestAnswer completion contains a complete
+    ``Answer: A{i}``.
+
+    Closing the stream there changes the metric: ``StackSelect.extract``
+    takes the largest designation anywhere in the completion, so the text
+    after the answer (e.g. ``A2 is more complete than A5``) can change the
+    label of the full completion."""
+    return _COMPLETE_CHOICE.search(text) is not None
+
+
+def textsort_answer_complete(text):
+    """True once a streamed TSort completion contains ``Answer:`` followed
+    by a closed json list of integers, which ``TextSort.extract`` parses.
+
+    As for BestAnswer, closing the stream there changes the metric: the text
+    after the list is part of what ``TextSort.extract`` reads."""
+    m = _COMPLETE_ORDER.search(text)
+    if m is None:
+        return False
+    try:
+        order = json.loads(m.group(1))
+    except ValueError:
+        return False
+    return len(order) > 0 and all(isinstance(x, int) for x in order)
+
+
+def extract_choice(prediction, num_choice):
+    """Find the designation of the chosen answer in one regex pass.
+
+    Returns the same label as searching every candidate: ``A{i}`` for the
+    largest ``i <= num_choice`` such that ``A{i}`` occurs in the prediction,
+    else for the largest ``i`` such that ``str(i)`` occurs in it, else
+    ``???``. ``A{i}`` occurs iff ``str(i)`` is a prefix of a digit run
+    preceded by ``A``, and ``str(i)`` occurs iff it is a prefix of some
+    suffix of a digit run.
+    """
+    width = len(str(num_choice))
+    best_a, best_d = 0, 0
+    for m in _DESIGNATION.finditer(prediction):
+        digits = m.group(2)
+        if m.group(1):
+            best_a = max(best_a, _prefix_choice(digits, 0, width, num_choice))
+        if not best_a:
+            for j in range(len(digits)):
+                best_d = max(best_d, _prefix_choice(digits, j, width, num_choice))
+    if best_a:
+        return f'A{best_a}'
+    return f'A{best_d}' if best_d else '???'
 
 class StackSelect:
 
-    def __init__(self, setting='1k', mode='normal'):
-        data = load(f'data/stackselect_{setting}.json')
-        self.setting = setting
-        assert mode in ['normal', 'less']
-        if mode == 'normal':
-            num = 1000 if int(setting[:-1]) < 32 else 200
-        elif mode == 'less':
-            num = 200 if int(setting[:-1]) < 32 else 50
+    # bump when the extraction logic changes, invalidates the score caches
+    extractor_version = 2
 
-        if num > 0:
-            data = data[:num] 
-        for item in data:
-            item['index'] = f"{item['question_id']}_{item['answer']}"
-        self.data = data
-        
-        self.meta_prompt = """
+    # a class attribute, so that the generator renders prompts without loading a data file
+    meta_prompt = """
 You are an AI assistant. Your job is to find out the most helpful answer to a given question.
 Each time, you will be provided with a question and n answers to this question.
 Each answer begins with an 'A' and a number(e.g. A4), which represents its designation.
@@ -42,28 +125,60 @@ You must give me only the designation of the MOST helpful answer.
 Sample Output (format only): \n
 Answer: The designation of the most helpful answer.(e.g. A4 means answer 4 is the most helpful answer) \n\n
 """
+
+    def __init__(self, setting='1k', mode='normal'):
+        self.data_file = f'data/stackselect_{setting}.json'
+        self.setting = setting
+        assert mode in ['normal', 'less']
+        if mode == 'normal':
+            num = 1000 if setting_tokens(setting) < 32000 else 200
+        elif mode == 'less':
+            num = 200 if setting_tokens(setting) < 32000 else 50
+
+        # only the first num records are materialized when the indexed format is available
+        data = load_records(self.data_file, num)
+        for item in data:
+            item['index'] = f"{item['question_id']}_{item['answer']}"
+        self.data = data
         
     def __len__(self):
         return len(self.data)
+
+    def token_lens(self, model='gpt-4'):
+        # token counts of all prompts, persisted next to the data file
+        return TokenIndex(self.data_file, model).lookup(self.build_prompt(i) for i in range(len(self)))
     
-    def get_meta(self):
-        res = {
-            'index': [x['index'] for x in self.data], 
-            'question': [x['question'] for x in self.data], 
+    def get_meta(self, with_text=True):
+        # without text, the question is referenced by the index (its question_id)
+        res = {'index': [x['index'] for x in self.data]}
+        if with_text:
+            res['question'] = [x['question'] for x in self.data]
+        res.update({
             'answer': [x['answer'] for x in self.data], 
             'tags': [x['tags'] for x in self.data], 
             'num_choice': [len(x['all_answers']) for x in self.data]
-        }
+        })
         return pd.DataFrame(res)
         
-    def build_prompt(self, line):
+    def generation_config(self):
+        # the answer is a single designation, a few tokens suffice, and the answer line ends the reply
+        return dict(max_tokens=128, stop=['\n\n'], answer_complete=stackselect_answer_complete)
+
+    def shared_prefix(self, line):
+        # the part of the prompt shared by all samples of the same question
         if isinstance(line, int):
             line = self.data[line]
-        assert isinstance(line, dict)
         prompt = self.meta_prompt
         prompt += 'The question is given below.\n'
         prompt += line['question'] + '\n\n' 
         prompt += 'Possible answers are given below.\n'
+        return prompt
+
+    def build_prompt(self, line):
+        if isinstance(line, int):
+            line = self.data[line]
+        assert isinstance(line, dict)
+        prompt = self.shared_prefix(line)
         all_answers = line['all_answers']
         for j in range(1, len(all_answers) + 1):
             prompt += 'A' + str(j) + ':\n\n' + all_answers[j - 1] + '\n\n'
@@ -74,60 +189,155 @@ You must give me only the designation of the MOST helpful answer.
 """     
         return prompt
 
-    def evaluate(self, df):
-        assert 'prediction' in df and 'answer' in df and 'num_choice' in df
+    @staticmethod
+    def extract(prediction, num_choice):
+        return extract_choice(prediction, num_choice)
+
+    @staticmethod
+    def extract_batch(predictions, num_choices):
+        # completions repeat a lot (e.g. a bare 'Answer: A3'), each distinct one is extracted once
+        memo = {}
+        res = []
+        for p, nc in zip(predictions, num_choices):
+            key = (p, nc)
+            if key not in memo:
+                memo[key] = extract_choice(p, nc)
+            res.append(memo[key])
+        return res
+
+    def score(self, line, prediction):
+        if isinstance(line, int):
+            line = self.data[line]
+        return self.extract(prediction, len(line['all_answers'])) == line['answer']
 
-        def extract(line):
-            nc = line['num_choice']
-            cands = [f'A{i}' for i in range(1, nc + 1)]
-            finds = [line['prediction'].find(c) for c in cands]
-            matched = sum([x >= 0 for x in finds])
-            if matched >= 1:
-                for i in range(nc - 1, -1, -1):
-                    if finds[i] >= 0:
-                        return cands[i]
-            else:
-                cands = [str(i) for i in range(1, nc + 1)]
-                finds = [line['prediction'].find(c) for c in cands]
-                matched = sum([x >= 0 for x in finds])
-                if matched >= 1:
-                    for i in range(nc - 1, -1, -1):
-                        if finds[i] >= 0:
-                            return 'A' + cands[i]
-                else:
-                    return '???'
-                
-        extracted = [extract(df.iloc[i]) for i in range(len(df))]
-        df['extracted'] = extracted
+    def chance(self, line):
+        # the probability of a random guess being right
+        if isinstance(line, int):
+            line = self.data[line]
+        return 1 / len(line['all_answers'])
+
+    def evaluate(self, df, cache=None):
+        """``cache`` is an optional ``scoring.ScoreCache``, with which only the
+        rows with a new prediction are extracted again."""
+        assert 'prediction' in df and 'answer' in df and 'num_choice' in df
+        preds, ncs = df['prediction'].tolist(), df['num_choice'].tolist()
+        if cache is None:
+            df['extracted'] = self.extract_batch(preds, ncs)
+        else:
+            df['extracted'] = cache.extract(
+                df['index'].tolist(), preds, self.extractor_version,
+                lambda rows: self.extract_batch([preds[k] for k in rows], [ncs[k] for k in rows]))
+            cache.save()
         acc = np.mean([x == y for x, y in zip(df['extracted'], df['answer'])])
         acc = 100 * acc
         print(f'StackSelect {self.setting} Accuracy: {acc:.1f}%')
         return acc
         
 
+def _label(x, num_segments):
+    # the segment id in 1..num_segments a parsed element equals (as compared with ==), or -1, which equals none;
+    # larger values would not fit the int64 arrays of evaluate
+    if isinstance(x, float):
+        x = int(x) if x.is_integer() else -1
+    return x if isinstance(x, int) and 1 <= x <= num_segments else -1
+
+
+def as_order(extracted, num_segments):
+    # the extracted order as a list of ints, or None if it is not one of the right length; ids outside
+    # 1..num_segments are -1
+    if not isinstance(extracted, (list, tuple)) or len(extracted) != num_segments:
+        return None
+    if not all(isinstance(x, int) and not isinstance(x, bool) for x in extracted):
+        return None
+    return [x if 1 <= x <= num_segments else -1 for x in extracted]
+
+
+def extract_order(text, num_segments=4):
+    """Find the only order of segments ``1..num_segments`` that is a
+    subsequence of ``text``, in linear time.
+
+    Segment ids are single characters for up to 9 segments and integer
+    tokens otherwise. After dropping other characters and collapsing runs
+    of the same id, exactly one permutation is a subsequence iff every id
+    is left exactly once, in which case that sequence is the order. If none
+    or several permutations are subsequences, ``[0] * num_segments`` is
+    returned.
+    """
+    n = num_segments
+    if n <= 9:
+        ids = (ord(c) - 48 for c in text if '1' <= c <= str(n))
+    else:
+        ids = (int(x) for x in re.findall(r'[0-9]+', text) if 1 <= int(x) <= n)
+    seq = []
+    for x in ids:
+        if not len(seq) or seq[-1] != x:
+            seq.append(x)
+            if len(seq) > n:
+                break
+    if len(seq) == n and len(set(seq)) == n:
+        return seq
+    return [0] * n
+
+
 class TextSort:
 
+    extractor_version = 2
+
     def __init__(self, setting='1k', mode='normal'):
-        data = load(f'data/textsort_{setting}.json')
+        self.data_file = f'data/textsort_{setting}.json'
         self.setting = setting
         assert mode in ['normal', 'less']
         if mode == 'normal':
-            num = 1000 if int(setting[:-1]) < 32 else 200
+            num = 1000 if setting_tokens(setting) < 32000 else 200
         elif mode == 'less':
-            num = 200 if int(setting[:-1]) < 32 else 50
+            num = 200 if setting_tokens(setting) < 32000 else 50
 
-        if num > 0:
-            data = data[:num] 
+        if SegmentStore.available(self.data_file):
+            # the prompts are rebuilt from the deduplicated book segments on demand
+            self.segments = SegmentStore(self.data_file)
+            data = self.segments.records(num)
+        else:
+            # only the first num records are materialized when the indexed format is available
+            self.segments = None
+            data = load_records(self.data_file, num)
         for item in data:
             book_id = item['book_id']
             para_offset = item['para_offset']
             item['index'] = f"{book_id}_{'_'.join([str(x) for x in para_offset])}"
         self.data = data
+        self._prefix_lens = None
 
     def __len__(self):
         return len(self.data)
+
+    def generation_config(self):
+        # the answer is a json list of segment ids, on one line
+        return dict(max_tokens=128, stop=['\n\n'], answer_complete=textsort_answer_complete)
+
+    def shared_prefix(self, line):
+        # the longest prefix shared by the prompts of the same book (at least the instruction shared by all prompts)
+        if isinstance(line, int):
+            line = self.data[line]
+        if self._prefix_lens is None:
+            common = self._common_prefix_len(self.data) if len(self.data) > 1 else 0
+            books = defaultdict(list)
+            for x in self.data:
+                books[x['book_id']].append(x)
+            self._prefix_lens = {
+                k: self._common_prefix_len(v) if len(v) > 1 else common for k, v in books.items()}
+        return self.build_prompt(line)[:self._prefix_lens.get(line['book_id'], 0)]
+
+    def _common_prefix_len(self, lines):
+        if self.segments is not None:
+            return self.segments.common_prefix_len([x['prompt_id'] for x in lines])
+        return len(osp.commonprefix([x['prompt'] for x in lines]))
+
+    def token_lens(self, model='gpt-4'):
+        # token counts of all prompts, persisted next to the data file
+        return TokenIndex(self.data_file, model).lookup(self.build_prompt(i) for i in range(len(self)))
     
-    def get_meta(self):
+    def get_meta(self, with_text=True):
+        # the prompts are never copied, ``book_id`` and ``para_offset`` locate the segments
         res = {
             'book_id': [x['book_id'] for x in self.data], 
             'para_offset': [x['para_offset'] for x in self.data], 
@@ -140,50 +350,108 @@ class TextSort:
         if isinstance(line, int):
             line = self.data[line]
         assert isinstance(line, dict)
+        if self.segments is not None:
+            return self.segments.prompt(line['prompt_id'])
         return line['prompt']
     
-    def evaluate(self, df):
+    @staticmethod
+    def extract(prediction, num_segments=4):
+        pred = prediction
+        if 'Answer:' in pred:
+            pred = pred.split('Answer:')[1].strip()
+        try:
+            order = json.loads(pred)
+            if isinstance(order, list):
+                return order
+        except:
+            pass
+        return extract_order(pred, num_segments)
+
+    @staticmethod
+    def match(answer, extracted, strict=False):
+        """Exact match of the extracted order, compared element-wise over
+        the shorter of the two as in the published results. With ``strict``,
+        it must be a list of ints of the length of the answer."""
+        answer = json.loads(answer) if isinstance(answer, str) else list(answer)
+        if strict:
+            return as_order(extracted, len(answer)) == answer
+        if not isinstance(extracted, (list, tuple)):
+            return False
+        return all(a == e for a, e in zip(answer, extracted))
+
+    def score(self, line, prediction):
+        if isinstance(line, int):
+            line = self.data[line]
+        answer = line['answer']
+        answer = json.loads(answer) if isinstance(answer, str) else answer
+        return self.match(answer, self.extract(prediction, len(answer)))
+
+    def chance(self, line):
+        # the probability of a random order being right
+        if isinstance(line, int):
+            line = self.data[line]
+        answer = line['answer']
+        answer = json.loads(answer) if isinstance(answer, str) else answer
+        return 1 / math.factorial(len(answer))
+
+    def evaluate(self, df, kendall_tau=False, cache=None, strict=False):
+        """Exact-match accuracy of the predicted orders, see :meth:`match`
+        for ``strict``. With ``kendall_tau``, the Kendall rank correlation of
+        each prediction (0 if it can not be parsed) is computed in the same
+        pass and added as a column. ``cache`` is an optional
+        ``scoring.ScoreCache``."""
         assert 'prediction' in df and 'answer' in df
+        answers = [json.loads(x) if isinstance(x, str) else list(x) for x in df['answer']]
+        preds = df['prediction'].tolist()
+        extract = lambda rows: [self.extract(preds[k], len(answers[k])) for k in rows]
+        if cache is None:
+            extracted = extract(range(len(preds)))
+        else:
+            extracted = cache.extract(df['index'].tolist(), preds, self.extractor_version, extract)
+            cache.save()
+        lens = np.array([len(a) for a in answers])
+        width = lens.max()
+        # rows are padded with 0 after their own length, unparsable predictions are all -1
+        A = np.zeros((len(answers), width), dtype=np.int64)
+        E = np.full((len(answers), width), -1, dtype=np.int64)
+        # the parsed lists as they are and the positions compared by the default rule
+        L = np.full((len(answers), width), -1, dtype=np.int64)
+        M = np.zeros((len(answers), width), dtype=bool)
+        for k, (a, e) in enumerate(zip(answers, extracted)):
+            A[k, :len(a)] = a
+            if isinstance(e, (list, tuple)):
+                n = min(len(a), len(e))
+                L[k, :n] = [_label(x, len(a)) for x in e[:n]]
+                M[k, :n] = True
+            e = as_order(e, len(a))
+            if e is not None:
+                E[k] = 0
+                E[k, :len(a)] = e
 
-        def is_subseq(needle, haystack):
-            current_pos = 0
-            for c in needle:
-                current_pos = haystack.find(c, current_pos) + 1
-                if current_pos == 0:
-                    return False
-            return True
-
-        def extract(line):
-            pred = line['prediction']
-            if 'Answer:' in pred:
-                pred = pred.split('Answer:')[1].strip()
-            try:
-                pred = json.loads(pred)
-                return pred
-            except:
-                import itertools
-                perms = list(itertools.permutations(range(1, 5)))
-                perms = [''.join([str(x) for x in p]) for p in perms]
-                subseq = [is_subseq(p, pred) for p in perms]
-                if sum(subseq) == 1:
-                    for p, s in zip(perms, subseq):
-                        if s:
-                            return [int(pp) for pp in p]
-                return [0, 0, 0, 0]
-        
-        extracted = [extract(df.iloc[i]) for i in range(len(df))]
-        answers = [json.loads(x) if isinstance(x, str) else x for x in df['answer']]
-        hit, tot = 0, 0
-
-        for a, e in zip(answers, extracted):
-            tot += 1
-            flag = True
-            for aa, ee in zip(a, e):
-                if aa != ee:
-                    flag = False
-            hit += flag
-        
-        acc = hit / tot
-        acc = 100 * acc
+        if strict:
+            hit = (A == E).all(axis=1)
+        else:
+            # a list matching a prefix of the answer (even an empty one) counts, as in the published results
+            valid = np.array([isinstance(e, (list, tuple)) for e in extracted])
+            hit = ((A == L) | ~M).all(axis=1) & valid
+        acc = 100 * hit.mean()
         print(f'TextSort {self.setting} Accuracy: {acc:.1f}%')
-        return acc
\ No newline at end of file
+        if kendall_tau:
+            iu = np.triu_indices(width, k=1)
+            sa = np.sign(A[:, :, None] - A[:, None, :])[:, iu[0], iu[1]]
+            se = np.sign(E[:, :, None] - E[:, None, :])[:, iu[0], iu[1]]
+            valid = iu[1][None, :] < lens[:, None]
+            tau = (sa * se * valid).sum(axis=1) / np.maximum(lens * (lens - 1) / 2, 1)
+            df['kendall_tau'] = tau
+            print(f'TextSort {self.setting} Kendall Tau: {tau.mean():.3f}')
+        return acc
+
+
+def build_dataset(dname, mode='normal'):
+    """Build a dataset by its name, e.g. ``stackselect_16k`` or ``textsort_2k``."""
+    d, setting = dname.split('_')
+    if d == 'stackselect':
+        return StackSelect(setting=setting, mode=mode)
+    elif d == 'textsort':
+        return TextSort(setting=setting, mode=mode)
+    raise NotImplementedError(f'Unknown dataset {dname}. ')
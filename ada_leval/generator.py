@@ -0,0 +1,302 @@
+import argparse
+import json
+import os
+import os.path as osp
+import random as rd
+import threading
+import time
+from functools import partial
+from multiprocessing import Pool
+
+from .dataset import TEXTSORT_TEMPLATE, StackSelect, setting_tokens
+from .indexed import IndexedRecords, convert
+from .segments import SegmentStore, build as build_segments
+from .synthetic import num_records
+from .tokenizer import get_encoder
+
+# renders BestAnswer prompts exactly as the harness does, without loading a data file
+_STACKSELECT = StackSelect.__new__(StackSelect)
+
+
+def num_tokens(text, model='gpt-4'):
+    return len(get_encoder(model).encode_ordinary(text))
+
+
+def iter_records(path):
+    """Stream the records of a source file: a dataset file (indexed or json
+    list) or a jsonl file with one record per line."""
+    if path.endswith('.jsonl'):
+        with open(path, 'r', encoding='utf-8') as fin:
+            for line in fin:
+                if line.strip():
+                    yield json.loads(line)
+    elif IndexedRecords.available(path):
+        records = IndexedRecords(path)
+        for i in range(len(records)):
+            yield records[i]
+    else:
+        with open(path, 'r', encoding='utf-8') as fin:
+            yield from json.load(fin)
+
+
+def _relabel(record, keep, correct):
+    # the answers in ``keep`` in their original order, the designation follows the correct one
+    return dict(record, all_answers=[record['all_answers'][j] for j in keep], answer=f'A{keep.index(correct) + 1}')
+
+
+def pack_stackselect(record, budgets, min_fill=0.8, model='gpt-4'):
+    """Fit one BestAnswer question into each token budget of ``budgets``.
+
+    The correct answer is always kept and the other answers are taken in
+    their original order whenever they still fit (first fit), with the token
+    counts of each answer. The prompt of the selection is then rendered and
+    counted, and the last added answers are dropped while it is over budget.
+    Returns ``{budget: (record, tokens) or None}``, None if fewer than two
+    answers fit or the prompt would fill less than ``min_fill`` of the budget.
+    """
+    answers = record['all_answers']
+    correct = int(record['answer'][1:]) - 1
+    fixed = num_tokens(_STACKSELECT.build_prompt(dict(record, all_answers=[])), model)
+    cost = [num_tokens(f'A{j + 1}:\n\n{a}\n\n', model) for j, a in enumerate(answers)]
+    res = {}
+    for budget in budgets:
+        keep, added, used = [correct], [], fixed + cost[correct]
+        for j in range(len(answers)):
+            if j != correct and used + cost[j] <= budget:
+                keep.append(j)
+                added.append(j)
+                used += cost[j]
+        keep.sort()
+        while True:
+            line = _relabel(record, keep, correct)
+            n = num_tokens(_STACKSELECT.build_prompt(line), model)
+            if n <= budget or not len(added):
+                break
+            keep.remove(added.pop())
+        ok = n <= budget and len(keep) >= 2 and n >= min_fill * budget
+        res[budget] = (line, n) if ok else None
+    return res
+
+
+def _render(template, paras, parts, order):
+    text = lambda part: '\n'.join(paras[p] for p in part)
+    prompt = template['instruction'] + template['before'].format(text=text(parts[0]))
+    for k, t in enumerate(order):
+        prompt += template['segment'].format(k=k + 1, text=text(parts[1 + t]))
+    return prompt + template['after'].format(text=text(parts[-1]))
+
+
+def _textsort_instance(book, lens, budget, room, rng, template, context, model):
+    paras = book['paragraphs']
+    # the context before, the 4 segments and the context after, filled up to cumulative targets
+    shares = [context] + [(1 - 2 * context) / 4] * 4 + [context]
+    p = rng.randrange(len(paras))
+    parts, target, used = [], 0, 0
+    for share in shares:
+        target += share * room
+        part = []
+        while p < len(paras) and (used + lens[p] <= target or not len(part)):
+            part.append(p)
+            used += lens[p]
+            p += 1
+        if not len(part):
+            return None
+        parts.append(part)
+    order = rng.sample(range(4), 4)
+    while True:
+        prompt = _render(template, paras, parts, order)
+        n = num_tokens(prompt, model)
+        if n <= budget or len(parts[-1]) == 1:
+            break
+        parts[-1].pop()
+    if n > budget:
+        return None
+    record = dict(
+        book_id=book['book_id'],
+        para_offset=[parts[1 + t][0] for t in range(4)],
+        # the displayed numbers of the segments, in the order of the book
+        answer=[order.index(t) + 1 for t in range(4)],
+        prompt=prompt)
+    return record, n
+
+
+def pack_textsort(book, budgets, per_book=5, seed=0, template=None, context=1 / 6, min_fill=0.8, model='gpt-4'):
+    """Cut up to ``per_book`` TSort instances of each token budget of
+    ``budgets`` out of one book (``{'book_id', 'paragraphs'}``).
+
+    Each instance starts at a random paragraph and fills the context before,
+    the 4 segments and the context after with consecutive paragraphs, each
+    part taking paragraphs while the prompt stays within its share of the
+    budget (``context`` for each context, the rest split evenly between the
+    segments). The paragraphs are tokenized once for all budgets, and the
+    rendered prompt is counted and trimmed at the end of the context after.
+    Returns ``{budget: [(record, tokens), ...]}``.
+    """
+    template = TEXTSORT_TEMPLATE if template is None else template
+    paras = book['paragraphs']
+    enc = get_encoder(model)
+    # paragraphs are joined by newlines, counted along with each paragraph
+    lens = [len(x) + 1 for x in enc.encode_ordinary_batch(paras)]
+    # the tokens of the prompt with empty parts
+    fixed = num_tokens(_render(template, [''], [[0]] * 6, range(4)), model)
+    res = {}
+    for budget in budgets:
+        rng = rd.Random(f"{seed}-{book['book_id']}-{budget}")
+        out, seen = [], set()
+        for _ in range(4 * per_book):
+            if len(out) == per_book or not len(paras):
+                break
+            inst = _textsort_instance(book, lens, budget, budget - fixed, rng, template, context, model)
+            if inst is None or inst[1] < min_fill * budget or tuple(inst[0]['para_offset']) in seen:
+                continue
+            seen.add(tuple(inst[0]['para_offset']))
+            out.append(inst)
+        res[budget] = out
+    return res
+
+
+class _ArrayWriter:
+    """Streams records to a json list file, renamed into place on close."""
+
+    def __init__(self, pth):
+        self.pth = pth
+        self.fout = open(pth + '.tmp', 'w', encoding='utf-8')
+        self.fout.write('[')
+        self.count = 0
+        self.tokens = 0
+
+    def write(self, record, tokens):
+        if self.count:
+            self.fout.write(', ')
+        json.dump(record, self.fout)
+        self.count += 1
+        self.tokens += tokens
+
+    def close(self, commit=True):
+        self.fout.write(']')
+        self.fout.close()
+        if commit:
+            os.replace(self.pth + '.tmp', self.pth)
+        else:
+            os.remove(self.pth + '.tmp')
+
+
+def generate(task,
+             settings,
+             source,
+             root='data',
+             num=None,
+             nproc=8,
+             per_book=5,
+             seed=0,
+             template=None,
+             min_fill=0.8,
+             index=False,
+             segments=False,
+             model='gpt-4'):
+    """Build ``{root}/{task}_{setting}.json`` for each setting in
+    ``settings`` (e.g. ``['256k', '1m']``) from ``source``.
+
+    For ``stackselect``, the source is a BestAnswer data file (e.g. the
+    largest released setting, to derive any shorter one) or a jsonl file of
+    questions with the same fields, each question yielding at most one
+    instance per setting. For ``textsort``, the source is a jsonl file of
+    books, ``{"book_id": ..., "paragraphs": [...]}``, each yielding up to
+    ``per_book`` instances per setting. Source items are packed by ``nproc``
+    processes for all the settings at once, so a length sweep reads and
+    tokenizes the source once, and records are streamed to the output files
+    in source order (the output does not depend on ``nproc``) until each
+    setting has ``num`` records (by default, what ``build_dataset`` reads).
+    With ``index``, the indexed format is built as well, and with
+    ``segments`` the segment store of the TSort prompts. Returns
+    ``{setting: (path, records, mean prompt tokens)}``.
+    """
+    assert task in ['stackselect', 'textsort'], task
+    budgets = {s: setting_tokens(s) for s in settings}
+    nums = {s: num_records(f'{task}_{s}') if num is None else num for s in settings}
+    if task == 'stackselect':
+        work = partial(pack_stackselect, budgets=list(budgets.values()), min_fill=min_fill, model=model)
+    else:
+        work = partial(pack_textsort, budgets=list(budgets.values()), per_book=per_book, seed=seed,
+                       template=template, min_fill=min_fill, model=model)
+    os.makedirs(root, exist_ok=True)
+    writers = {s: _ArrayWriter(osp.join(root, f'{task}_{s}.json')) for s in settings}
+    # at most ``depth`` source items are read but not yet packed
+    depth = 4 * nproc
+    sem, stop = threading.Semaphore(depth), threading.Event()
+
+    def feed():
+        for item in iter_records(source):
+            sem.acquire()
+            if stop.is_set():
+                return
+            yield item
+
+    ok = False
+    try:
+        with Pool(nproc) as pool:
+            try:
+                for res in pool.imap(work, feed()):
+                    sem.release()
+                    for s, budget in budgets.items():
+                        packed = res[budget]
+                        for inst in [packed] if task == 'stackselect' else packed:
+                            if inst is not None and writers[s].count < nums[s]:
+                                writers[s].write(*inst)
+                    if all(writers[s].count >= nums[s] for s in settings):
+                        break
+            finally:
+                # unblock the feeder, the pool waits for it on exit
+                stop.set()
+                for _ in range(depth + 1):
+                    sem.release()
+        ok = True
+    finally:
+        for w in writers.values():
+            w.close(commit=ok)
+    res = {}
+    for s, w in writers.items():
+        if w.count < nums[s]:
+            print(f'{task}_{s}: the source yields only {w.count} of {nums[s]} records')
+        # the indexed format or segment store of an earlier version of the file would be stale
+        if index or IndexedRecords.available(w.pth, check_source=False):
+            convert(w.pth)
+        if segments or SegmentStore.available(w.pth, check_source=False):
+            build_segments(w.pth)
+        res[s] = (w.pth, w.count, w.tokens / max(w.count, 1))
+    return res
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Build Ada-LEval data files of any length, e.g. textsort_256k or a stackselect length sweep. ')
+    parser.add_argument('--task', type=str, required=True, choices=['stackselect', 'textsort'])
+    parser.add_argument('--setting', type=str, nargs='+', required=True, help='token budgets, e.g. 24k 256k 1m')
+    parser.add_argument('--source', type=str, required=True,
+                        help='stackselect: a data file (e.g. data/stackselect_128k.json) or jsonl of questions; '
+                             'textsort: a jsonl of {"book_id", "paragraphs"}')
+    parser.add_argument('--root', type=str, default='data')
+    parser.add_argument('--num', type=int, default=None, help='records per setting, defaults to what the harness reads')
+    parser.add_argument('--nproc', type=int, default=8)
+    parser.add_argument('--per-book', type=int, default=5, help='textsort instances per book and setting')
+    parser.add_argument('--template', type=str, default=None,
+                        help='textsort: a json file with the instruction / before / segment / after strings')
+    parser.add_argument('--min-fill', type=float, default=0.8, help='drop instances shorter than this part of the budget')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--index', action='store_true', help='also build the indexed format')
+    parser.add_argument('--segments', action='store_true', help='textsort: also build the segment store')
+    args = parser.parse_args()
+
+    if args.task == 'textsort' and not args.source.endswith('.jsonl'):
+        # released TSort records only keep the rendered prompt, the paragraph boundaries are lost
+        parser.error('textsort instances are cut from a jsonl book corpus, released data files can not be re-packed')
+    template = None
+    if args.template is not None:
+        with open(args.template, 'r', encoding='utf-8') as fin:
+            template = json.load(fin)
+    t = time.time()
+    res = generate(args.task, args.setting, args.source, args.root, args.num, args.nproc, args.per_book, args.seed,
+                   template, args.min_fill, args.index, args.task == 'textsort' and args.segments)
+    for s, (pth, count, tokens) in res.items():
+        print(f'{pth}: {count} records, {tokens:.0f} prompt tokens on average ({100 * tokens / setting_tokens(s):.1f}% of {s})')
+    print(f'done in {time.time() - t:.1f}s')
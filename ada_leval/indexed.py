@@ -0,0 +1,124 @@
+import argparse
+import json
+import mmap
+import os
+import os.path as osp
+import struct
+from collections.abc import Sequence
+
+_MAGIC = b'ADALIDX2'
+# number of records, size and mtime (ns) of the json file the index was built from
+_HEADER = struct.Struct('<QQQ')
+
+
+def index_paths(data_file):
+    base = osp.splitext(data_file)[0]
+    return base + '.bin', base + '.idx'
+
+
+def source_stat(data_file):
+    """The size and mtime (ns) of a json file, recorded by the formats built
+    from it to tell when it has changed since."""
+    st = os.stat(data_file)
+    return st.st_size, st.st_mtime_ns
+
+
+def convert(data_file):
+    """Convert a json list dataset into the offset-indexed format.
+
+    ``{name}.bin`` holds all records as utf-8 json slices of one buffer and
+    ``{name}.idx`` holds the magic, the record count, the size and mtime of
+    ``data_file`` (an index whose source has changed since is not used) and
+    ``count + 1`` uint64 offsets into the buffer.
+    """
+    source = source_stat(data_file)
+    with open(data_file, 'r', encoding='utf-8') as fin:
+        data = json.load(fin)
+    bin_file, idx_file = index_paths(data_file)
+    offsets = [0]
+    with open(bin_file + '.tmp', 'wb') as fout:
+        for item in data:
+            rec = json.dumps(item, ensure_ascii=False).encode('utf-8')
+            fout.write(rec)
+            offsets.append(offsets[-1] + len(rec))
+    with open(idx_file + '.tmp', 'wb') as fout:
+        fout.write(_MAGIC + _HEADER.pack(len(data), *source))
+        fout.write(struct.pack(f'<{len(offsets)}Q', *offsets))
+    os.replace(bin_file + '.tmp', bin_file)
+    os.replace(idx_file + '.tmp', idx_file)
+    return bin_file, idx_file
+
+
+class IndexedRecords(Sequence):
+    """Read-only, lazily opened records of an indexed dataset file.
+
+    Only the offset table is read on open; the record buffer is memory-mapped
+    and each record is decoded when it is indexed.
+    """
+
+    def __init__(self, data_file):
+        self.bin_file, self.idx_file = index_paths(data_file)
+        with open(self.idx_file, 'rb') as fin:
+            assert fin.read(len(_MAGIC)) == _MAGIC, f'{self.idx_file} is not an index file'
+            n, *self.source = _HEADER.unpack(fin.read(_HEADER.size))
+            self.offsets = struct.unpack(f'<{n + 1}Q', fin.read(8 * (n + 1)))
+        self._buf = None
+
+    @staticmethod
+    def available(data_file, check_source=True):
+        """Whether the indexed format of ``data_file`` exists and, with
+        ``check_source``, was built from its current version (same size and
+        mtime); a stale or older-format index is ignored."""
+        if not all(osp.exists(x) for x in index_paths(data_file)):
+            return False
+        if not check_source:
+            return True
+        with open(index_paths(data_file)[1], 'rb') as fin:
+            if fin.read(len(_MAGIC)) != _MAGIC:
+                return False
+            source = _HEADER.unpack(fin.read(_HEADER.size))[1:]
+        return osp.exists(data_file) and source == source_stat(data_file)
+
+    def _get_buf(self):
+        if self._buf is None:
+            with open(self.bin_file, 'rb') as fin:
+                self._buf = mmap.mmap(fin.fileno(), 0, access=mmap.ACCESS_READ)
+        return self._buf
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError(i)
+        buf = self._get_buf()
+        return json.loads(buf[self.offsets[i]: self.offsets[i + 1]].decode('utf-8'))
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_buf'] = None
+        return state
+
+
+def load_records(data_file, num=-1):
+    """Load the first ``num`` records (all if ``num <= 0``) of a dataset,
+    from the indexed format if it has been built from the current json file,
+    else from the json file."""
+    if IndexedRecords.available(data_file):
+        records = IndexedRecords(data_file)
+        return records[:num] if num > 0 else records[:]
+    with open(data_file, 'r', encoding='utf-8') as fin:
+        data = json.load(fin)
+    return data[:num] if num > 0 else data
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Build the indexed format of Ada-LEval json files. ')
+    parser.add_argument('files', type=str, nargs='+')
+    args = parser.parse_args()
+    for f in args.files:
+        print(f, '->', *convert(f))
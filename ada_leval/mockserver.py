@@ -0,0 +1,240 @@
+import argparse
+import gzip
+import json
+import math
+import random as rd
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from uuid import uuid4
+
+_CHOICE = re.compile(r'^A(\d+):$', re.M)
+
+
+def parse_latency(spec):
+    """Parse a latency distribution into a sampler (seconds).
+
+    - ``const:S``
+    - ``uniform:LO,HI``
+    - ``exp:MEAN``
+    - ``lognormal:MEDIAN,SIGMA``, with a long tail for SIGMA around 0.5-1
+    """
+    name, _, params = spec.partition(':')
+    params = [float(x) for x in params.split(',')] if params else []
+    if name == 'const':
+        return lambda: params[0]
+    if name == 'uniform':
+        return lambda: rd.uniform(params[0], params[1])
+    if name == 'exp':
+        return lambda: rd.expovariate(1 / params[0])
+    if name == 'lognormal':
+        return lambda: params[0] * math.exp(params[1] * rd.gauss(0, 1))
+    raise ValueError(f'Unknown latency distribution {spec}')
+
+
+def fake_answer(prompt):
+    """A well-formed (random) answer to an Ada-LEval prompt."""
+    choices = _CHOICE.findall(prompt)
+    if len(choices):
+        return f'Answer: A{rd.randint(1, max(int(x) for x in choices))}'
+    if 'segment' in prompt.lower():
+        return 'Answer: ' + json.dumps(rd.sample(range(1, 5), 4))
+    return 'Answer: hello'
+
+
+class MockState:
+    """Settings and counters of the server, shared by the handler threads."""
+
+    def __init__(self,
+                 latency='const:0',
+                 per_token=0.0,
+                 tpot=0.0,
+                 rate_429=0.0,
+                 rate_5xx=0.0,
+                 retry_after=1.0,
+                 rpm=0,
+                 padding=0):
+        self.sample_latency = parse_latency(latency)
+        self.per_token = per_token
+        self.tpot = tpot
+        self.rate_429 = rate_429
+        self.rate_5xx = rate_5xx
+        self.retry_after = retry_after
+        self.rpm = rpm
+        self.padding = padding
+        self.lock = threading.Lock()
+        self.counts = dict(requests=0, ok=0, status_429=0, status_5xx=0, streamed=0, cancelled=0,
+                           prompt_tokens=0, completion_tokens=0)
+        self.start = time.time()
+        self._window = []
+
+    def count(self, **kwargs):
+        with self.lock:
+            for k, v in kwargs.items():
+                self.counts[k] += v
+
+    def over_limit(self):
+        """Seconds until a request is allowed by ``rpm``, 0 if allowed now."""
+        if self.rpm <= 0:
+            return 0
+        now = time.time()
+        with self.lock:
+            self._window = [t for t in self._window if now - t < 60]
+            if len(self._window) < self.rpm:
+                self._window.append(now)
+                return 0
+            return 60 - (now - self._window[0])
+
+    def stats(self):
+        with self.lock:
+            res = dict(self.counts)
+        res['elapsed'] = time.time() - self.start
+        res['requests_per_s'] = res['ok'] / max(res['elapsed'], 1e-9)
+        return res
+
+
+class MockHandler(BaseHTTPRequestHandler):
+    """An OpenAI compatible ``/v1/chat/completions`` endpoint with fake
+    answers. ``GET /stats`` returns the counters of the server."""
+
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def _send_json(self, status, obj, headers=None):
+        body = json.dumps(obj).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for k, v in (headers or {}).items():
+            self.send_header(k, v)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path.rstrip('/').endswith('/stats'):
+            self._send_json(200, self.server.state.stats())
+        else:
+            self._send_json(404, dict(error=dict(message='Not found')))
+
+    def do_POST(self):
+        state = self.server.state
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        if self.headers.get('Content-Encoding') == 'gzip':
+            body = gzip.decompress(body)
+        state.count(requests=1)
+        if not self.path.rstrip('/').endswith('/chat/completions'):
+            return self._send_json(404, dict(error=dict(message='Not found')))
+        try:
+            payload = json.loads(body)
+            messages = payload['messages']
+        except (ValueError, KeyError):
+            return self._send_json(400, dict(error=dict(message='Invalid request')))
+
+        wait = state.over_limit()
+        if wait > 0 or rd.random() < state.rate_429:
+            state.count(status_429=1)
+            retry_after = wait if wait > 0 else state.retry_after
+            headers = {'Retry-After': f'{math.ceil(retry_after)}', 'x-ratelimit-reset-requests': f'{retry_after:.3f}s'}
+            if state.rpm > 0:
+                headers.update({'x-ratelimit-limit-requests': str(state.rpm), 'x-ratelimit-remaining-requests': '0'})
+            return self._send_json(429, dict(error=dict(message='Rate limit reached', type='requests')), headers)
+        if rd.random() < state.rate_5xx:
+            state.count(status_5xx=1)
+            return self._send_json(rd.choice([500, 502, 503]), dict(error=dict(message='Server error')))
+
+        prompt = '\n'.join(m['content'] if isinstance(m['content'], str) else json.dumps(m['content'])
+                           for m in messages)
+        prompt_tokens = len(prompt) // 4
+        words = fake_answer(prompt).split(' ') + ['and'] * state.padding
+        words = words[:max(payload.get('max_tokens') or len(words), 1)]
+        usage = dict(prompt_tokens=prompt_tokens, completion_tokens=len(words),
+                     total_tokens=prompt_tokens + len(words))
+        # time to the first token scales with the prompt length
+        time.sleep(max(state.sample_latency(), 0) + state.per_token * prompt_tokens)
+        if payload.get('stream'):
+            return self._stream(payload, words, usage)
+        time.sleep(state.tpot * len(words))
+        state.count(ok=1, prompt_tokens=prompt_tokens, completion_tokens=len(words))
+        self._send_json(200, dict(
+            id=f'chatcmpl-{uuid4().hex}', object='chat.completion', created=int(time.time()), model=payload.get('model'),
+            choices=[dict(index=0, message=dict(role='assistant', content=' '.join(words)), finish_reason='stop')],
+            usage=usage))
+
+    def _stream(self, payload, words, usage):
+        state = self.server.state
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Cache-Control', 'no-cache')
+        self.send_header('Connection', 'close')
+        self.end_headers()
+        self.close_connection = True
+        cid = f'chatcmpl-{uuid4().hex}'
+
+        def event(choices, **extra):
+            chunk = dict(id=cid, object='chat.completion.chunk', created=int(time.time()), model=payload.get('model'),
+                         choices=choices, **extra)
+            self.wfile.write(f'data: {json.dumps(chunk)}\n\n'.encode('utf-8'))
+            self.wfile.flush()
+
+        sent = 0
+        try:
+            for k, w in enumerate(words):
+                if k:
+                    time.sleep(state.tpot)
+                event([dict(index=0, delta=dict(content=w if k == 0 else ' ' + w), finish_reason=None)])
+                sent += 1
+            event([dict(index=0, delta={}, finish_reason='stop')])
+            if (payload.get('stream_options') or {}).get('include_usage'):
+                event([], usage=usage)
+            self.wfile.write(b'data: [DONE]\n\n')
+            self.wfile.flush()
+        except (BrokenPipeError, ConnectionResetError):
+            state.count(cancelled=1)
+        state.count(ok=1, streamed=1, prompt_tokens=usage['prompt_tokens'], completion_tokens=sent)
+
+
+class MockServer(ThreadingHTTPServer):
+    # the default backlog of 5 drops connections under load
+    request_queue_size = 1024
+    daemon_threads = True
+
+    def __init__(self, address, state):
+        super().__init__(address, MockHandler)
+        self.state = state
+
+
+def serve(host='127.0.0.1', port=8000, background=False, **kwargs):
+    """Start a mock server. With ``background=True``, it runs in a daemon
+    thread and the server is returned (call ``shutdown()`` to stop it)."""
+    server = MockServer((host, port), MockState(**kwargs))
+    if background:
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        return server
+    print(f'Serving on http://{host}:{server.server_address[1]}/v1/chat/completions', flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    return server
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='A local OpenAI compatible server answering with fake answers. ')
+    parser.add_argument('--host', type=str, default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--latency', type=str, default='lognormal:0.5,0.5',
+                        help='const:S, uniform:LO,HI, exp:MEAN or lognormal:MEDIAN,SIGMA')
+    parser.add_argument('--per-token', type=float, default=1e-5, help='extra seconds per prompt token')
+    parser.add_argument('--tpot', type=float, default=0.0, help='seconds per output token')
+    parser.add_argument('--rate-429', type=float, default=0.0)
+    parser.add_argument('--rate-5xx', type=float, default=0.0)
+    parser.add_argument('--retry-after', type=float, default=1.0)
+    parser.add_argument('--rpm', type=int, default=0, help='requests per minute, 429 beyond it')
+    parser.add_argument('--padding', type=int, default=0, help='output words after the answer')
+    args = parser.parse_args()
+    serve(args.host, args.port, latency=args.latency, per_token=args.per_token, tpot=args.tpot,
+          rate_429=args.rate_429, rate_5xx=args.rate_5xx, retry_after=args.retry_after, rpm=args.rpm,
+          padding=args.padding)
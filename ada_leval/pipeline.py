@@ -0,0 +1,348 @@
+import asyncio
+import os.path as osp
+import queue
+import threading
+import time
+from functools import partial
+from multiprocessing import Pool
+
+from rich.progress import BarColumn, MofNCompleteColumn, Progress, TaskProgressColumn, TextColumn
+
+from .api import GPT_context_window
+from .batching import batch_dispatch
+from .store import ResultStore, default_writer
+from .telemetry import tagged
+from .tokenizer import TokenIndex
+from .util import _SkipFirstTimeRemainingColumn
+
+_DONE = object()
+
+
+class RunningScore:
+    """Accuracy of the predictions scored so far."""
+
+    def __init__(self):
+        self.hit = 0
+        self.tot = 0
+
+    def update(self, flag):
+        self.hit += bool(flag)
+        self.tot += 1
+
+    @property
+    def acc(self):
+        return 100 * self.hit / max(self.tot, 1)
+
+    def __str__(self):
+        return f'{self.acc:.1f}% ({self.hit}/{self.tot})'
+
+
+# Each stage is a generator consuming the previous one, so that only the items
+# in flight are materialized.
+def load_stage(dataset, done, rank=0, world_size=1, order=None):
+    """Yield ``(i, index)`` of the samples without a result, sharded by rank.
+    If ``order`` is given, it is the list of samples assigned to this rank,
+    in processing order."""
+    if order is not None:
+        for i in order:
+            index = dataset.data[i]['index']
+            if index not in done:
+                yield i, index
+        return
+    k = 0
+    for i in range(len(dataset)):
+        index = dataset.data[i]['index']
+        if index in done:
+            continue
+        if k % world_size == rank:
+            yield i, index
+        k += 1
+
+
+def prompt_stage(dataset, items):
+    for i, index in items:
+        yield i, index, dataset.build_prompt(i)
+
+
+def admit_stage(model, items, token_index=None, admitted=None):
+    """Yield ``(i, index, prompt, prediction)``. For API models, prompts that
+    can not fit into the context window get a failure prediction right away
+    and are not dispatched. If ``admitted`` is given (``dict(lens={},
+    tokens=0)``), the token count of each prompt is recorded in it as it
+    passes."""
+    window = GPT_context_window(model.model) if getattr(model, 'is_api', False) else None
+    for i, index, prompt in items:
+        n = None if token_index is None else token_index.get(prompt)
+        if admitted is not None:
+            admitted['lens'][i] = n
+            admitted['tokens'] += n
+        if window is not None and n is not None and n >= window:
+            yield i, index, None, model.fail_msg + 'Input string longer than context window. '
+        else:
+            yield i, index, prompt, None
+
+
+class _Call:
+    """Picklable wrapper that runs ``func`` on the prompt of one item, with
+    the telemetry tag of the item (if any) set."""
+
+    def __init__(self, func):
+        self.func = func
+
+    def __call__(self, item):
+        i, index, prompt, tag = item
+        if tag is None:
+            return i, index, self.func(prompt)
+        with tagged(**tag):
+            return i, index, self.func(prompt)
+
+
+def _tag(task, i, index):
+    # ``task`` is the name of the task, or a function returning it for item ``i``
+    if task is None:
+        return None
+    return dict(task=task(i) if callable(task) else task, index=index, enqueue=time.time())
+
+
+async def _tagged_generate(model, prompt, tag, kwargs):
+    # runs as its own asyncio task, so the tag is only visible to this request
+    if tag is None:
+        return await model.agenerate(prompt, **kwargs)
+    with tagged(**tag):
+        return await model.agenerate(prompt, **kwargs)
+
+
+def local_dispatch(func, items):
+    for i, index, prompt, pred in items:
+        yield i, index, func(prompt) if pred is None else pred
+
+
+def pool_dispatch(func, items, nproc=4, depth=None, task=None):
+    """Run ``func`` over a process pool, with at most ``depth`` items taken
+    from ``items`` but not yet returned. Yields ``(i, index, prediction)``.
+    If ``task`` is given, requests are tagged with it (or with ``task(i)``
+    if it is callable) for the telemetry."""
+    depth = 2 * nproc if depth is None else max(depth, nproc)
+    sem = threading.BoundedSemaphore(depth)
+    bypass = queue.Queue()
+
+    def feed():
+        for i, index, prompt, pred in items:
+            if pred is not None:
+                bypass.put((i, index, pred))
+                continue
+            sem.acquire()
+            yield i, index, prompt, _tag(task, i, index)
+
+    with Pool(nproc) as pool:
+        for res in pool.imap_unordered(_Call(func), feed()):
+            sem.release()
+            while not bypass.empty():
+                yield bypass.get()
+            yield res
+    while not bypass.empty():
+        yield bypass.get()
+
+
+def async_dispatch(model, items, concurrency=64, task=None, **kwargs):
+    """Run ``model.agenerate(prompt, **kwargs)`` on an event loop in a
+    background thread, with at most ``concurrency`` requests in flight.
+    Yields ``(i, index, prediction)``."""
+    loop = asyncio.new_event_loop()
+    thread = threading.Thread(target=loop.run_forever, daemon=True)
+    thread.start()
+    sem = threading.BoundedSemaphore(concurrency)
+    out = queue.Queue()
+
+    def done(i, index, fut):
+        sem.release()
+        try:
+            out.put((i, index, fut.result()))
+        except BaseException as err:
+            out.put(err)
+
+    def feed():
+        try:
+            n = 0
+            for i, index, prompt, pred in items:
+                n += 1
+                if pred is not None:
+                    out.put((i, index, pred))
+                    continue
+                sem.acquire()
+                fut = asyncio.run_coroutine_threadsafe(_tagged_generate(model, prompt, _tag(task, i, index), kwargs), loop)
+                fut.add_done_callback(lambda f, i=i, index=index: done(i, index, f))
+            out.put((_DONE, n))
+        except BaseException as err:
+            out.put(err)
+
+    feeder = threading.Thread(target=feed, daemon=True)
+    feeder.start()
+    try:
+        received, total = 0, None
+        while total is None or received < total:
+            res = out.get()
+            if isinstance(res, BaseException):
+                raise res
+            if res[0] is _DONE:
+                total = res[1]
+                continue
+            received += 1
+            yield res
+    finally:
+        asyncio.run_coroutine_threadsafe(model.aclose(), loop).result()
+        loop.call_soon_threadsafe(loop.stop)
+        thread.join()
+
+
+def run_pipeline(dataset,
+                 model,
+                 out_file,
+                 nproc=4,
+                 concurrency=0,
+                 depth=None,
+                 rank=0,
+                 world_size=1,
+                 order=None,
+                 token_budget=0,
+                 batch_window=256,
+                 telemetry=None,
+                 gen_kwargs=None,
+                 stop=None,
+                 done=None,
+                 description=None,
+                 color='blue'):
+    """Stream the samples of ``dataset`` through load -> build prompt ->
+    tokenize/admit -> dispatch -> persist -> score.
+
+    Predictions are appended to the :class:`ResultStore` at ``out_file`` and
+    scored as soon as they arrive; the running accuracy (including samples
+    finished by earlier runs) is shown in the progress bar.
+
+    Args:
+        dataset: A ``StackSelect`` or ``TextSort`` instance.
+        model: An API wrapper or a local pipeline (called as ``model(prompt).text``).
+        out_file (str): The result store path.
+        nproc (int): Pool workers for API models. Defaults to 4.
+        concurrency (int): If > 0, API requests are issued with
+            ``agenerate`` from one event loop instead. Defaults to 0.
+        depth (int, optional): Max items in flight in the pool,
+            defaults to ``2 * nproc``.
+        rank (int): Rank of this process for local models. Defaults to 0.
+        world_size (int): Number of ranks for local models. Defaults to 1.
+        order (list, optional): The samples assigned to this rank in
+            processing order, overrides the default strided sharding.
+        token_budget (int): If > 0, prompts of local models are passed to
+            the pipeline in batches of at most this many tokens, see
+            :func:`batch_dispatch`. Defaults to 0 (one prompt per call).
+        batch_window (int): Pending prompts sorted by length before being
+            batched. Defaults to 256.
+        telemetry (Telemetry, optional): If given, API requests are tagged
+            with the task (the name of ``out_file``), the time spent
+            persisting results is recorded, and a summary is printed at the
+            end. The model should write to the same sink.
+        gen_kwargs (dict, optional): Keyword arguments of every call of the
+            model, e.g. ``max_tokens`` for API models or ``gen_config`` for
+            lmdeploy pipelines.
+        stop (SequentialStop, optional): If given, no more samples are
+            dispatched once it decides to stop; the samples in flight are
+            still persisted. ``order`` should then be random.
+        done (set, optional): The indices which had a result when the run
+            started, from which the pending samples are sharded. With
+            several ranks, it must be read once (e.g. by rank 0, before any
+            rank writes) and shared, as the store also holds the results
+            the other ranks are writing. Defaults to the indices in the
+            store.
+
+    Returns:
+        RunningScore: The running score over all samples with a prediction.
+    """
+    is_api = getattr(model, 'is_api', False)
+    gen_kwargs = {} if gen_kwargs is None else gen_kwargs
+    store = ResultStore(out_file, writer=default_writer() if world_size == 1 else f'{default_writer()}-rank{rank}')
+    loaded = store.load()
+    done = loaded if done is None else {k: loaded[k] for k in done}
+    score = RunningScore()
+    for i in range(len(dataset)):
+        index = dataset.data[i]['index']
+        if index in done:
+            flag = dataset.score(i, done[index])
+            score.update(flag)
+            if stop is not None:
+                stop.update(flag, dataset.chance(i))
+    total = sum(1 for _ in load_stage(dataset, done, rank, world_size, order))
+
+    if is_api:
+        token_index = TokenIndex(dataset.data_file, model.model)
+    elif token_budget > 0:
+        # tiktoken counts are used as a proxy of the lengths under the local tokenizer
+        token_index = TokenIndex(dataset.data_file)
+    else:
+        token_index = None
+    stats = dict(items=0, tokens=0)
+    # token counts of the prompts weight the ETA, taken as they are admitted, so no prompt is built ahead
+    admitted = None if token_index is None else dict(lens={}, tokens=0)
+    task = None if telemetry is None else osp.basename(out_file)[:-len('.pkl')]
+    items = load_stage(dataset, done, rank, world_size, order)
+    if stop is not None:
+        items = stop.gate(items)
+    items = prompt_stage(dataset, items)
+    items = admit_stage(model, items, token_index, admitted)
+    if is_api and concurrency > 0:
+        results = async_dispatch(model, items, concurrency, task=task, **gen_kwargs)
+    elif is_api:
+        results = pool_dispatch(partial(model.generate, **gen_kwargs), items, nproc, depth, task=task)
+    elif token_budget > 0:
+        results = batch_dispatch(partial(model, **gen_kwargs), items, token_index.lookup, token_budget,
+                                 window=batch_window, stats=stats)
+    else:
+        results = local_dispatch(lambda prompt: model(prompt, **gen_kwargs).text, items)
+
+    description = 'Processing' if description is None else description
+    parallel = concurrency if (is_api and concurrency > 0) else (nproc if is_api else 1)
+    prog_bar = Progress(
+        TextColumn('{task.description}'),
+        BarColumn(),
+        _SkipFirstTimeRemainingColumn(skip_times=parallel if parallel > 1 else 0),
+        MofNCompleteColumn(),
+        TaskProgressColumn(show_speed=True),
+        TextColumn('Acc: {task.fields[acc]}'),
+    )
+    fields = {} if admitted is None else dict(tokens_total=0, tokens_done=0)
+    task_id = prog_bar.add_task(total=total, color=color, description=description, acc=str(score), **fields)
+    t = time.time()
+    ckpt, tokens_done = 0, 0
+    try:
+        with prog_bar:
+            for i, index, pred in results:
+                t0 = time.time()
+                store.put(index, pred)
+                ckpt += time.time() - t0
+                flag = dataset.score(i, pred)
+                score.update(flag)
+                if stop is not None:
+                    stop.update(flag, dataset.chance(i))
+                if admitted is not None:
+                    # the samples not admitted yet count as the mean of those admitted
+                    lens = admitted['lens']
+                    tokens_done += lens.get(i, 0)
+                    fields['tokens_done'] = tokens_done
+                    fields['tokens_total'] = admitted['tokens'] * total / max(len(lens), 1)
+                prog_bar.update(task_id, advance=1, acc=str(score), refresh=True, **fields)
+    finally:
+        t0 = time.time()
+        store.close()
+        ckpt += time.time() - t0
+        if token_index is not None:
+            token_index.save()
+        if telemetry is not None:
+            telemetry.write(kind='checkpoint', task=task, seconds=ckpt)
+    elapsed = time.time() - t
+    if stats['items'] and elapsed > 0:
+        print(f"{description}: {stats['items'] / elapsed:.2f} items/s, {stats['tokens'] / elapsed:.0f} tokens/s "
+              f'with a budget of {token_budget} tokens per batch')
+    if stop is not None:
+        print(f'{description}: {stop}')
+    if telemetry is not None:
+        print(telemetry.summarize(task))
+    return score
@@ -0,0 +1,108 @@
+import argparse
+from collections import OrderedDict, defaultdict
+
+from .batching import Response
+from .tokenizer import text_hash
+from .util import balanced_partition
+
+
+def prefix_groups(dataset, indices):
+    """Group samples whose prompts start with the same shared prefix (see
+    ``shared_prefix`` of the datasets), largest groups first."""
+    groups = defaultdict(list)
+    for i in indices:
+        groups[text_hash(dataset.shared_prefix(i))].append(i)
+    return sorted(groups.values(), key=len, reverse=True)
+
+
+def prefix_order(dataset, indices):
+    """Reorder samples so that prompts with the same prefix are dispatched
+    back to back, while the prefix is still in the engine's cache."""
+    return [i for g in prefix_groups(dataset, indices) for i in g]
+
+
+def prefix_partition(dataset, indices, lens, k):
+    """Assign whole prefix groups to ``k`` ranks, balanced by prompt tokens
+    (``lens[i]`` for sample ``i``). Returns the order of each rank."""
+    groups = prefix_groups(dataset, indices)
+    parts, _ = balanced_partition([sum(lens[i] for i in g) for g in groups], k)
+    return [[i for g in part for i in groups[g]] for part in parts]
+
+
+class PrefixCacheEngine:
+    """A mock of a serving engine with automatic prefix caching.
+
+    Prompts are split into blocks of ``block_size`` characters (a proxy of
+    tokens), each identified by the hash of itself and all preceding blocks,
+    as in the block-level prefix caches of lmdeploy and vLLM. The leading
+    blocks found in an LRU cache of ``capacity`` blocks are not prefilled
+    again. It can be called like a pipeline and echoes the first line of each
+    prompt.
+    """
+
+    def __init__(self, block_size=256, capacity=4096):
+        self.block_size = block_size
+        self.capacity = capacity
+        self.blocks = OrderedDict()
+        self.hit = 0
+        self.total = 0
+
+    def prefill(self, prompt):
+        """Returns the number of characters that must be computed."""
+        h, cached = '', 0
+        bs = self.block_size
+        for start in range(0, len(prompt) - bs + 1, bs):
+            h = text_hash(h + prompt[start: start + bs])
+            if cached == start and h in self.blocks:
+                self.blocks.move_to_end(h)
+                cached += bs
+            else:
+                self.blocks[h] = True
+                if len(self.blocks) > self.capacity:
+                    self.blocks.popitem(last=False)
+        self.hit += cached
+        self.total += len(prompt)
+        return len(prompt) - cached
+
+    def __call__(self, prompts, **kwargs):
+        single = isinstance(prompts, str)
+        prompts = [prompts] if single else prompts
+        for p in prompts:
+            self.prefill(p)
+        res = [Response(p.split('\n', 1)[0]) for p in prompts]
+        return res[0] if single else res
+
+    @property
+    def hit_rate(self):
+        return 100 * self.hit / max(self.total, 1)
+
+    def __str__(self):
+        return (f'prefix hit {self.hit_rate:.1f}%, '
+                f'prefilled {self.total - self.hit} / {self.total} chars')
+
+
+def simulate(dataset, order, block_size=256, capacity=4096):
+    engine = PrefixCacheEngine(block_size, capacity)
+    for i in order:
+        engine.prefill(dataset.build_prompt(i))
+    return engine
+
+
+if __name__ == '__main__':
+    from .dataset import build_dataset
+    parser = argparse.ArgumentParser(
+        description='Measure prefix-cache hits of the default and the prefix-grouped order with a mock engine. ')
+    parser.add_argument('--data', type=str, nargs='+', required=True)
+    parser.add_argument('--mode', type=str, default='normal', choices=['normal', 'less'])
+    parser.add_argument('--block-size', type=int, default=256)
+    parser.add_argument('--capacity', type=int, default=4096)
+    args = parser.parse_args()
+    for dname in args.data:
+        dataset = build_dataset(dname, mode=args.mode)
+        indices = list(range(len(dataset)))
+        groups = prefix_groups(dataset, indices)
+        shared = sum(len(dataset.shared_prefix(i)) for i in indices)
+        total = sum(len(dataset.build_prompt(i)) for i in indices)
+        print(f'{dname}: {len(groups)} prefix groups, shared prefix {100 * shared / max(total, 1):.1f}% of chars')
+        for name, order in [('default', indices), ('prefix', prefix_order(dataset, indices))]:
+            print(f'  {name:<8}', simulate(dataset, order, args.block_size, args.capacity))
@@ -0,0 +1,196 @@
+import asyncio
+import os
+import os.path as osp
+import re
+import struct
+import time
+from email.utils import parsedate_to_datetime
+
+import portalocker
+
+# req_bucket, tok_bucket, last_refill, limit, inflight, blocked_until, last_decrease, rpm, tpm
+_STATE = struct.Struct('<9d')
+
+
+def parse_duration(s):
+    """Parse durations used by ``x-ratelimit-reset-*`` headers, e.g. ``6m0s``,
+    ``1.5s`` or ``20ms``. Returns seconds or None."""
+    if s is None:
+        return None
+    try:
+        return float(s)
+    except ValueError:
+        pass
+    parts = re.findall(r'(\d+(?:\.\d+)?)(ms|s|m|h)', str(s))
+    if not len(parts):
+        return None
+    scale = dict(ms=0.001, s=1, m=60, h=3600)
+    return sum(float(v) * scale[u] for v, u in parts)
+
+
+def parse_retry_after(s):
+    if s is None:
+        return None
+    try:
+        return max(float(s), 0)
+    except ValueError:
+        pass
+    try:
+        return max(parsedate_to_datetime(s).timestamp() - time.time(), 0)
+    except Exception:
+        return None
+
+
+class RateLimiter:
+    """A requests/minute + tokens/minute token-bucket limiter with AIMD
+    concurrency control.
+
+    The state lives in a small file guarded by ``portalocker``, so all pool
+    workers that receive a (pickled) copy of the limiter share the same
+    buckets and concurrency window. The window grows additively on success
+    and is halved on 429, which makes a run settle near the max sustainable
+    throughput of the endpoint. ``Retry-After`` and ``x-ratelimit-*``
+    response headers are used to pause and to correct the local buckets.
+
+    Args:
+        path (str): The shared state file.
+        rpm (int): Requests per minute, 0 means unknown / unlimited.
+            Learned from ``x-ratelimit-limit-requests`` if not set.
+        tpm (int): Tokens per minute, 0 means unknown / unlimited.
+            Learned from ``x-ratelimit-limit-tokens`` if not set.
+        max_concurrency (int): Upper bound of the concurrency window.
+        min_concurrency (int): Lower bound of the concurrency window.
+        init_concurrency (int, optional): Initial window, defaults to
+            ``max_concurrency``.
+        backoff (float): Pause after a 429 without ``Retry-After``, in seconds.
+        reset (bool): Reset the shared state on construction. Only the
+            process that creates the limiter should pass True.
+    """
+
+    def __init__(self,
+                 path,
+                 rpm=0,
+                 tpm=0,
+                 max_concurrency=64,
+                 min_concurrency=1,
+                 init_concurrency=None,
+                 backoff=5.0,
+                 reset=True):
+        self.path = path
+        self.max_concurrency = max_concurrency
+        self.min_concurrency = min_concurrency
+        self.backoff = backoff
+        if reset or not osp.exists(path):
+            limit = max_concurrency if init_concurrency is None else init_concurrency
+            with portalocker.Lock(path, mode='wb', timeout=10) as fh:
+                fh.write(_STATE.pack(rpm, tpm, time.time(), limit, 0, 0, 0, rpm, tpm))
+                fh.flush()
+
+    def _update(self, func):
+        with open(self.path, 'r+b') as fh:
+            portalocker.lock(fh, portalocker.LOCK_EX)
+            try:
+                state = list(_STATE.unpack(fh.read(_STATE.size)))
+                ret = func(state, time.time())
+                fh.seek(0)
+                fh.write(_STATE.pack(*state))
+                fh.flush()
+            finally:
+                portalocker.unlock(fh)
+        return ret
+
+    @staticmethod
+    def _refill(state, now):
+        req, tok, last, _, _, _, _, rpm, tpm = state
+        elapsed = max(now - last, 0)
+        state[0] = min(rpm, req + elapsed * rpm / 60) if rpm > 0 else 0
+        state[1] = min(tpm, tok + elapsed * tpm / 60) if tpm > 0 else 0
+        state[2] = now
+
+    def _try_acquire(self, state, now, tokens):
+        self._refill(state, now)
+        req, tok, _, limit, inflight, blocked_until, _, rpm, tpm = state
+        if now < blocked_until:
+            return blocked_until - now
+        if inflight + 1 > max(int(limit), self.min_concurrency):
+            return 0.05
+        # a single request larger than the bucket is admitted once the bucket is full
+        tokens = min(tokens, tpm) if tpm > 0 else 0
+        wait = 0
+        if rpm > 0 and req < 1:
+            wait = max(wait, (1 - req) * 60 / rpm)
+        if tpm > 0 and tok < tokens:
+            wait = max(wait, (tokens - tok) * 60 / tpm)
+        if wait > 0:
+            return wait
+        state[0] = req - 1 if rpm > 0 else 0
+        state[1] = tok - tokens if tpm > 0 else 0
+        state[4] = inflight + 1
+        return 0
+
+    def try_acquire(self, tokens=0):
+        """Take one request slot and ``tokens`` tokens. Returns 0 on success,
+        otherwise the number of seconds to wait before trying again."""
+        return self._update(lambda state, now: self._try_acquire(state, now, tokens))
+
+    def acquire(self, tokens=0):
+        while True:
+            wait = self.try_acquire(tokens)
+            if wait <= 0:
+                return
+            time.sleep(min(wait, 1.0))
+
+    async def aacquire(self, tokens=0):
+        while True:
+            wait = self.try_acquire(tokens)
+            if wait <= 0:
+                return
+            await asyncio.sleep(min(wait, 1.0))
+
+    def _release(self, state, now, ret_code, headers):
+        self._refill(state, now)
+        state[4] = max(state[4] - 1, 0)
+        if ret_code == 0:
+            # additive increase: about +1 per window of successful requests
+            state[3] = min(self.max_concurrency, state[3] + 1 / max(state[3], 1))
+        elif ret_code == 429:
+            retry_after = parse_retry_after(headers.get('retry-after')) if headers is not None else None
+            pause = self.backoff if retry_after is None else retry_after
+            state[5] = max(state[5], now + pause)
+            # multiplicative decrease, at most once per pause window
+            if now >= state[6]:
+                state[3] = max(self.min_concurrency, state[3] / 2)
+                state[6] = now + max(pause, 1)
+        if headers is None:
+            return
+        for i, kind in enumerate(['requests', 'tokens']):
+            limit = headers.get(f'x-ratelimit-limit-{kind}')
+            if limit is not None and state[7 + i] <= 0:
+                try:
+                    state[7 + i] = float(limit)
+                    state[i] = float(limit)
+                except ValueError:
+                    pass
+            remaining = headers.get(f'x-ratelimit-remaining-{kind}')
+            if remaining is not None and state[7 + i] > 0:
+                try:
+                    state[i] = min(state[i], float(remaining))
+                except ValueError:
+                    pass
+            if remaining is not None and str(remaining).strip() in ['0', '0.0']:
+                reset = parse_duration(headers.get(f'x-ratelimit-reset-{kind}'))
+                if reset is not None:
+                    state[5] = max(state[5], now + reset)
+
+    def release(self, ret_code=None, headers=None):
+        """Return the request slot. ``ret_code`` follows ``generate_inner``
+        (0 means success), ``headers`` are the response headers if any."""
+        self._update(lambda state, now: self._release(state, now, ret_code, headers))
+
+    def stats(self):
+        state = self._update(lambda state, now: list(state))
+        return dict(concurrency=state[3], inflight=int(state[4]), rpm=state[7], tpm=state[8])
+
+    def remove(self):
+        if osp.exists(self.path):
+            os.remove(self.path)
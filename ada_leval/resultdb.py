@@ -0,0 +1,276 @@
+import argparse
+import json
+import os
+import os.path as osp
+import socket
+import sqlite3
+import threading
+import time
+
+from .dataset import setting_tokens
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    model TEXT NOT NULL,
+    dataset TEXT NOT NULL,
+    task TEXT NOT NULL,
+    setting TEXT NOT NULL,
+    accuracy REAL,
+    samples INTEGER,
+    total INTEGER,
+    seconds REAL,
+    prompt_tokens INTEGER,
+    completion_tokens INTEGER,
+    extra TEXT,
+    host TEXT,
+    created REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS runs_task ON runs (task, id);
+CREATE INDEX IF NOT EXISTS runs_model ON runs (model, dataset, id);
+CREATE INDEX IF NOT EXISTS runs_dataset ON runs (dataset, id);
+CREATE TABLE IF NOT EXISTS latest (
+    model TEXT NOT NULL,
+    dataset TEXT NOT NULL,
+    task TEXT NOT NULL,
+    run INTEGER NOT NULL,
+    PRIMARY KEY (model, dataset)
+);
+"""
+
+_COLUMNS = ['id', 'model', 'dataset', 'task', 'setting', 'accuracy', 'samples', 'total', 'seconds',
+            'prompt_tokens', 'completion_tokens', 'extra', 'host', 'created']
+# the names of the tasks in the README tables
+TASK_TITLES = dict(textsort='TSort', stackselect='BestAnswer')
+
+
+# file systems on which the shared memory of the WAL index does not work across hosts
+_NETWORK_FS = {'nfs', 'nfs4', 'cifs', 'smb3', 'smbfs', 'lustre', 'gpfs', 'ceph', 'afs', '9p',
+               'fuse.sshfs', 'fuse.glusterfs', 'fuse.cephfs'}
+
+
+def _on_network_fs(path):
+    # the type of the longest mount point containing ``path``, from /proc/mounts
+    path = osp.realpath(osp.dirname(osp.abspath(path)))
+    best, fstype = '', None
+    try:
+        with open('/proc/mounts') as fin:
+            for line in fin:
+                fields = line.split()
+                if len(fields) < 3:
+                    continue
+                mnt = fields[1].replace('\\040', ' ')
+                if (path == mnt or path.startswith(mnt.rstrip('/') + '/')) and len(mnt) > len(best):
+                    best, fstype = mnt, fields[2]
+    except OSError:
+        return False
+    return fstype in _NETWORK_FS
+
+
+def _setting_key(setting):
+    try:
+        return setting_tokens(setting)
+    except ValueError:
+        return 0
+
+
+class ResultDB:
+    """A SQLite database of evaluation runs, one row per (model, dataset)
+    evaluation, with its accuracy, sample count, wall time and token usage.
+
+    Each run is recorded by a single INSERT, so any number of evaluations
+    (different models or datasets) can record results at once without losing
+    each other's rows. On a local disk the database is in WAL mode, which
+    only works for the processes of one host; on a network file system (NFS,
+    CIFS, Lustre, ... from ``/proc/mounts``) it falls back to the rollback
+    journal (``journal_mode=DELETE``), which relies on the file locks of the
+    file system and is slower. Earlier runs are kept; queries and exports use the latest run of
+    each (model, dataset) unless asked for the history. The latest runs are
+    tracked in their own table, updated in the same transaction, so that the
+    tables are rebuilt without scanning the history.
+
+    Args:
+        path (str): The SQLite database file. Defaults to ``result.sqlite``.
+        journal_mode (str): ``'WAL'`` or ``'DELETE'``, by default chosen
+            from the file system of ``path``.
+    """
+
+    def __init__(self, path='result.sqlite', journal_mode=None):
+        self.path = path
+        if journal_mode is None:
+            journal_mode = 'DELETE' if _on_network_fs(path) else 'WAL'
+        self.journal_mode = journal_mode
+        self._local = threading.local()
+        dirname = osp.dirname(path)
+        if dirname:
+            os.makedirs(dirname, exist_ok=True)
+        with self._conn() as conn:
+            conn.executescript(_SCHEMA)
+
+    def _conn(self):
+        # sqlite connections can not be shared across threads or processes
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=60)
+            conn.execute(f'PRAGMA journal_mode={self.journal_mode}')
+            conn.execute(f"PRAGMA synchronous={'NORMAL' if self.journal_mode == 'WAL' else 'FULL'}")
+            self._local.conn, self._local.pid = conn, os.getpid()
+        return conn
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_local'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._local = threading.local()
+
+    @staticmethod
+    def _insert(conn, model, dataset, accuracy, samples, total, seconds, prompt_tokens, completion_tokens, extra):
+        # a new run, made the latest of (model, dataset) in the same transaction
+        task, setting = dataset.rsplit('_', 1)
+        cur = conn.execute(
+            'INSERT INTO runs (model, dataset, task, setting, accuracy, samples, total, seconds, '
+            'prompt_tokens, completion_tokens, extra, host, created) '
+            'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+            (model, dataset, task, setting, None if accuracy is None else float(accuracy), samples, total,
+             seconds, prompt_tokens, completion_tokens, json.dumps(extra) if len(extra) else None,
+             socket.gethostname(), time.time()))
+        conn.execute('INSERT OR REPLACE INTO latest (model, dataset, task, run) VALUES (?, ?, ?, ?)',
+                     (model, dataset, task, cur.lastrowid))
+        return cur.lastrowid
+
+    def record(self, model, dataset, accuracy, samples=None, total=None, seconds=None,
+               prompt_tokens=None, completion_tokens=None, **extra):
+        """Record one evaluation of ``model`` on ``dataset``. Keyword
+        arguments beyond the columns (e.g. ``sequential``) are kept as json.
+        Returns the id of the run."""
+        with self._conn() as conn:
+            return self._insert(conn, model, dataset, accuracy, samples, total, seconds, prompt_tokens,
+                                completion_tokens, extra)
+
+    def rescore(self, model, dataset, accuracy, samples=None):
+        """Record a new accuracy of the latest run of ``model`` on
+        ``dataset`` (e.g. after the scorer changed), as a new run keeping its
+        total, wall time, token usage and extra fields, with
+        ``rescored_from`` set to its id. Without an earlier run, the same as
+        ``record``. Returns the id of the run."""
+        with self._conn() as conn:
+            # the run read is the one replaced, even if another process records meanwhile
+            conn.execute('BEGIN IMMEDIATE')
+            row = conn.execute(
+                'SELECT runs.id, runs.total, runs.seconds, runs.prompt_tokens, runs.completion_tokens, runs.extra '
+                'FROM latest CROSS JOIN runs ON runs.id = latest.run WHERE latest.model = ? AND latest.dataset = ?',
+                (model, dataset)).fetchone()
+            if row is None:
+                total = seconds = prompt_tokens = completion_tokens = None
+                extra = {}
+            else:
+                run, total, seconds, prompt_tokens, completion_tokens, extra = row
+                extra = dict(json.loads(extra) if extra else {}, rescored_from=run)
+            return self._insert(conn, model, dataset, accuracy, samples, total, seconds, prompt_tokens,
+                                completion_tokens, extra)
+
+    def query(self, model=None, dataset=None, task=None, latest=True, limit=None):
+        """Runs matching all the given fields, newest first, as dicts. With
+        ``latest``, only the last run of each (model, dataset)."""
+        # the latest runs are filtered on the small latest table, which drives the join
+        table = 'latest' if latest else 'runs'
+        where, params = [], []
+        for name, value in [('model', model), ('dataset', dataset), ('task', task)]:
+            if value is not None:
+                where.append(f'{table}.{name} = ?')
+                params.append(value)
+        cond = f"WHERE {' AND '.join(where)}" if len(where) else ''
+        source = 'latest CROSS JOIN runs ON runs.id = latest.run' if latest else 'runs'
+        sql = f"SELECT {', '.join('runs.' + c for c in _COLUMNS)} FROM {source} {cond} ORDER BY runs.id DESC"
+        if limit is not None:
+            sql += f' LIMIT {int(limit)}'
+        res = []
+        for row in self._conn().execute(sql, params):
+            run = dict(zip(_COLUMNS, row))
+            run['extra'] = json.loads(run['extra']) if run['extra'] else {}
+            res.append(run)
+        return res
+
+    def latest(self):
+        """``{'{model}_{dataset}': accuracy}`` of the latest runs, plus the
+        early-stopping decision as ``'{model}_{dataset}_sequential'``, the
+        layout of ``result.json``."""
+        res = {}
+        for run in sorted(self.query(), key=lambda r: r['id']):
+            key = f"{run['model']}_{run['dataset']}"
+            res[key] = run['accuracy']
+            if 'sequential' in run['extra']:
+                res[f'{key}_sequential'] = run['extra']['sequential']
+        return res
+
+    def export_json(self, path='result.json'):
+        """Rewrite ``path`` from the latest runs. Entries of an existing file
+        that are not in the database (e.g. from before it) are kept, and the
+        file is replaced atomically."""
+        res = {}
+        if osp.exists(path):
+            with open(path, 'r', encoding='utf-8') as fin:
+                res = json.load(fin)
+        res.update(self.latest())
+        tmp = f'{path}.{os.getpid()}.tmp'
+        with open(tmp, 'w') as fout:
+            json.dump(res, fout, indent=4, ensure_ascii=False)
+        os.replace(tmp, path)
+        return res
+
+    def leaderboard(self, task, models=None):
+        """The README table of ``task`` (``'textsort'`` or ``'stackselect'``)
+        from the latest runs: one row per model, one column per setting, blank
+        where a setting was not evaluated."""
+        table = {}
+        for run in self.query(task=task):
+            if models is None or run['model'] in models:
+                table.setdefault(run['model'], {})[run['setting']] = run['accuracy']
+        settings = sorted({s for row in table.values() for s in row}, key=_setting_key)
+        rows = sorted(table) if models is None else [m for m in models if m in table]
+        title = TASK_TITLES.get(task, task)
+        width = max([20, len(title)] + [len(m) for m in rows])
+        widths = [max(4, len(s)) for s in settings]
+
+        def line(cells):
+            return '| ' + ' | '.join(c.ljust(w) for c, w in zip(cells, [width] + widths)) + ' |'
+
+        lines = [line([title] + settings), line(['-' * width] + ['-' * w for w in widths])]
+        for m in rows:
+            cells = [m]
+            for s in settings:
+                acc = table[m].get(s)
+                cells.append('' if acc is None else f'{acc:.1f}')
+            lines.append(line(cells))
+        return '\n'.join(lines)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Query the results database and print the README tables. ')
+    parser.add_argument('--db', type=str, default='result.sqlite')
+    parser.add_argument('--task', type=str, nargs='+', default=['textsort', 'stackselect'])
+    parser.add_argument('--model', type=str, nargs='+', default=None)
+    parser.add_argument('--runs', action='store_true', help='list every run instead of the tables')
+    parser.add_argument('--export', type=str, default=None, help='also rewrite this result.json file')
+    args = parser.parse_args()
+
+    db = ResultDB(args.db)
+    if args.runs:
+        print(f"{'id':>5} {'model':<20} {'dataset':<18} {'acc':>6} {'samples':>8} {'seconds':>9} {'tokens':>10}  created")
+        for run in db.query(latest=False):
+            if args.model is not None and run['model'] not in args.model:
+                continue
+            tokens = (run['prompt_tokens'] or 0) + (run['completion_tokens'] or 0)
+            print(f"{run['id']:>5} {run['model']:<20} {run['dataset']:<18} "
+                  f"{'' if run['accuracy'] is None else format(run['accuracy'], '.1f'):>6} "
+                  f"{run['samples'] if run['samples'] is not None else '':>8} "
+                  f"{'' if run['seconds'] is None else format(run['seconds'], '.1f'):>9} {tokens or '':>10}  "
+                  f"{time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(run['created']))}")
+    else:
+        for task in args.task:
+            print(db.leaderboard(task, args.model), end='\n\n')
+    if args.export is not None:
+        db.export_json(args.export)
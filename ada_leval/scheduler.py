@@ -0,0 +1,267 @@
+import heapq
+import os.path as osp
+import random as rd
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from rich.progress import BarColumn, MofNCompleteColumn, Progress, TaskProgressColumn, TextColumn
+
+from .api import GPT_context_window
+from .dataset import setting_tokens
+from .pipeline import RunningScore, async_dispatch, pool_dispatch
+from .store import ResultStore
+from .tokenizer import TokenIndex
+from .util import _SkipFirstTimeRemainingColumn
+
+# the prediction of samples dropped after their dataset stopped early, never persisted
+_SKIPPED = object()
+
+
+class DatasetJob:
+    """One dataset of a multi-dataset run: the samples without a result, their
+    prompt tokens, the running score and the optional early-stopping rule."""
+
+    def __init__(self, name, dataset, out_file, gen_kwargs=None, stop=None):
+        self.name = name
+        self.dataset = dataset
+        self.out_file = out_file
+        self.task = osp.basename(out_file)[:-len('.pkl')]
+        self.gen_kwargs = {} if gen_kwargs is None else gen_kwargs
+        self.stop = stop
+        self.store = ResultStore(out_file)
+        done = self.store.load()
+        self.score = RunningScore()
+        self.pending = []
+        for i in range(len(dataset)):
+            index = dataset.data[i]['index']
+            if index in done:
+                flag = dataset.score(i, done[index])
+                self.score.update(flag)
+                if stop is not None:
+                    stop.update(flag, dataset.chance(i))
+            else:
+                self.pending.append(i)
+        if stop is not None and stop.done:
+            self.pending = []
+        self.remaining = self.total = len(self.pending)
+        self.lens = {}
+        self.tokens_done = 0
+        self.checkpoint = 0
+        self.progress_id = None
+        self.closed = False
+        self.start = None
+        self.seconds = None
+
+    def count_tokens(self, model):
+        token_index = TokenIndex(self.dataset.data_file, model)
+        self.lens = dict(zip(self.pending, token_index.lookup(self.dataset.build_prompt(i) for i in self.pending)))
+        token_index.save()
+
+    def priorities(self):
+        """Heap keys of the pending samples, longest prompts first. With
+        early stopping, samples are taken in a random order instead (the
+        accuracy of any prefix must be unbiased), ranked with the mean length
+        of the dataset against the other datasets."""
+        if self.stop is None:
+            return {i: (-self.lens[i], 0) for i in self.pending}
+        mean = sum(self.lens.values()) / max(len(self.lens), 1)
+        ranks = rd.Random(self.name).sample(range(len(self.pending)), len(self.pending))
+        return {i: (-mean, r) for i, r in zip(self.pending, ranks)}
+
+
+class _JobModel:
+    """Calls the model with the generation kwargs of the dataset each prompt
+    belongs to. Prompts are ``(job, prompt)`` pairs."""
+
+    def __init__(self, model, kwargs):
+        self.model = model
+        self.kwargs = kwargs
+
+    def generate(self, item):
+        j, prompt = item
+        return self.model.generate(prompt, **self.kwargs[j])
+
+    async def agenerate(self, item):
+        j, prompt = item
+        return await self.model.agenerate(prompt, **self.kwargs[j])
+
+    async def aclose(self):
+        await self.model.aclose()
+
+
+def _nominal_tokens(name):
+    # datasets are named {task}_{setting}, e.g. textsort_128k
+    try:
+        return setting_tokens(name.rsplit('_', 1)[1])
+    except (IndexError, ValueError):
+        return 0
+
+
+def run_datasets(names,
+                 load,
+                 model,
+                 nproc=4,
+                 concurrency=0,
+                 depth=None,
+                 prefetch=2,
+                 telemetry=None,
+                 on_done=None,
+                 make_stop=None,
+                 color='blue'):
+    """Evaluate an API model on several datasets at once.
+
+    Datasets are loaded (and their prompts tokenized) by ``prefetch``
+    background threads, the nominally longest first. The samples of all the
+    loaded datasets share one pool of ``nproc`` workers (or one event loop
+    with ``concurrency`` requests in flight), which always takes the longest
+    pending prompt next, so that no dataset drains its tail alone and the
+    makespan stays close to the total work divided by the parallelism.
+    Results are persisted per dataset as in :func:`run_pipeline`, and
+    ``on_done(job)`` is called as soon as each dataset is complete.
+
+    Args:
+        names (list): The dataset names.
+        load (callable): ``load(name)`` returns the dataset, the result store
+            path and the generation kwargs of the model for it.
+        model (BaseAPI): The API wrapper.
+        nproc (int): Pool workers. Defaults to 4.
+        concurrency (int): If > 0, requests are issued with ``agenerate``
+            from one event loop instead. Defaults to 0.
+        depth (int, optional): Max items in flight in the pool, defaults to
+            ``2 * nproc``.
+        prefetch (int): Datasets loaded in parallel. Defaults to 2.
+        telemetry (Telemetry, optional): Tag requests with the task of their
+            dataset, record the time spent persisting results and print a
+            summary of each dataset.
+        on_done (callable, optional): Called with the :class:`DatasetJob`
+            of each dataset once all its samples have a result.
+        make_stop (callable, optional): Returns a new
+            :class:`SequentialStop` for each dataset. Once it decides to
+            stop, the pending samples of the dataset are dropped, and it is
+            finalized when the ones in flight are back.
+
+    Returns:
+        dict: The running score of each dataset.
+    """
+    window = GPT_context_window(model.model)
+    jobs = [None] * len(names)
+    kwargs = {}
+    heap, idle = [], deque()
+    prog_bar = Progress(
+        TextColumn('{task.description}'),
+        BarColumn(),
+        _SkipFirstTimeRemainingColumn(skip_times=concurrency if concurrency > 0 else nproc),
+        MofNCompleteColumn(),
+        TaskProgressColumn(show_speed=True),
+        TextColumn('Acc: {task.fields[acc]}'),
+    )
+
+    def load_job(name):
+        job = DatasetJob(name, *load(name), stop=None if make_stop is None else make_stop())
+        job.count_tokens(model.model)
+        return job
+
+    def add(j, job):
+        jobs[j] = job
+        job.start = time.time()
+        kwargs[j] = job.gen_kwargs
+        for i, key in job.priorities().items():
+            heapq.heappush(heap, (*key, j, i))
+        job.progress_id = prog_bar.add_task(
+            total=job.total, color=color, description=job.name, acc=str(job.score),
+            tokens_total=sum(job.lens.values()), tokens_done=0)
+        if job.remaining == 0:
+            idle.append(job)
+
+    executor = ThreadPoolExecutor(max(prefetch, 1))
+    order = sorted(range(len(names)), key=lambda j: -_nominal_tokens(names[j]))
+    futures = {executor.submit(load_job, names[j]): j for j in order}
+
+    def items():
+        loading, purged = set(futures), set()
+        while len(heap) or len(loading):
+            ready = {f for f in loading if f.done()}
+            if not len(heap) and not len(ready):
+                ready = wait(loading, return_when=FIRST_COMPLETED).done
+            for f in ready:
+                loading.discard(f)
+                add(futures[f], f.result())
+            # drop the pending samples of the datasets which stopped early
+            for j, job in enumerate(jobs):
+                if job is not None and job.stop is not None and job.stop.done and j not in purged:
+                    purged.add(j)
+                    dropped = [e[-1] for e in heap if e[-2] == j]
+                    heap[:] = [e for e in heap if e[-2] != j]
+                    heapq.heapify(heap)
+                    for i in dropped:
+                        yield (j, i), job.dataset.data[i]['index'], None, _SKIPPED
+            if not len(heap):
+                continue
+            *_, j, i = heapq.heappop(heap)
+            job = jobs[j]
+            index = job.dataset.data[i]['index']
+            if job.lens[i] >= window:
+                yield (j, i), index, None, model.fail_msg + 'Input string longer than context window. '
+            else:
+                yield (j, i), index, (j, job.dataset.build_prompt(i)), None
+
+    def task(key):
+        return jobs[key[0]].task
+
+    job_model = _JobModel(model, kwargs)
+    tag = None if telemetry is None else task
+    if concurrency > 0:
+        results = async_dispatch(job_model, items(), concurrency, task=tag)
+    else:
+        results = pool_dispatch(job_model.generate, items(), nproc, depth, task=tag)
+
+    def finish(job):
+        job.seconds = time.time() - job.start
+        t0 = time.time()
+        job.store.close()
+        job.closed = True
+        job.checkpoint += time.time() - t0
+        if telemetry is not None:
+            telemetry.write(kind='checkpoint', task=job.task, seconds=job.checkpoint)
+        if job.stop is not None:
+            print(f'{job.name}: {job.stop}')
+        if on_done is not None:
+            on_done(job)
+        if telemetry is not None:
+            print(telemetry.summarize(job.task))
+
+    try:
+        with prog_bar:
+            for (j, i), index, pred in results:
+                job = jobs[j]
+                if pred is _SKIPPED:
+                    job.remaining -= 1
+                    job.total -= 1
+                    prog_bar.update(job.progress_id, total=job.total)
+                    if job.remaining == 0:
+                        finish(job)
+                    continue
+                t0 = time.time()
+                job.store.put(index, pred)
+                job.checkpoint += time.time() - t0
+                flag = job.dataset.score(i, pred)
+                job.score.update(flag)
+                if job.stop is not None:
+                    job.stop.update(flag, job.dataset.chance(i))
+                job.remaining -= 1
+                job.tokens_done += job.lens[i]
+                prog_bar.update(job.progress_id, advance=1, acc=str(job.score), refresh=True,
+                                tokens_done=job.tokens_done)
+                if job.remaining == 0:
+                    finish(job)
+                while len(idle):
+                    finish(idle.popleft())
+            while len(idle):
+                finish(idle.popleft())
+    finally:
+        executor.shutdown(wait=True)
+        for job in jobs:
+            if job is not None and not job.closed:
+                job.store.close()
+    return {job.name: job.score for job in jobs if job is not None}
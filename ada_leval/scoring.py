@@ -0,0 +1,120 @@
+import argparse
+import os
+import os.path as osp
+import pickle
+from multiprocessing import Pool
+
+from .tokenizer import text_hash
+
+
+class ScoreCache:
+    """Extracted answers keyed by (index, prediction hash, extractor version).
+
+    Stored next to the results as ``results/{model}_{dname}.score.pkl``, so
+    re-evaluating a result file only runs the extractor on rows whose
+    prediction (or the extractor itself) changed.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.cache = {}
+        self.dirty = False
+        if osp.exists(path):
+            with open(path, 'rb') as fin:
+                self.cache = pickle.load(fin)
+
+    def extract(self, indices, predictions, version, func):
+        """Return the extracted answer of each row. ``func(rows)`` extracts
+        the rows (positions) that miss the cache."""
+        keys = [(text_hash(str(p)), version) for p in predictions]
+        res = [None] * len(keys)
+        todo = []
+        for k, (idx, key) in enumerate(zip(indices, keys)):
+            hit = self.cache.get(idx)
+            if hit is not None and hit[0] == key:
+                res[k] = hit[1]
+            else:
+                todo.append(k)
+        if len(todo):
+            for k, ext in zip(todo, func(todo)):
+                res[k] = ext
+                self.cache[indices[k]] = (keys[k], ext)
+            self.dirty = True
+        return res
+
+    def save(self):
+        if not self.dirty:
+            return
+        tmp = f'{self.path}.{os.getpid()}.tmp'
+        with open(tmp, 'wb') as fout:
+            pickle.dump(self.cache, fout, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, self.path)
+        self.dirty = False
+
+
+def score_cache_file(result_file):
+    return result_file[:-len('.pkl')] + '.score.pkl'
+
+
+def parse_result_file(result_file):
+    """``results/{model}_{dname}.pkl`` -> (model, dname)"""
+    name = osp.basename(result_file)[:-len('.pkl')]
+    model, task, setting = name.rsplit('_', 2)
+    return model, f'{task}_{setting}'
+
+
+def list_result_files(root='results'):
+    res = []
+    for f in sorted(os.listdir(root)):
+        if not f.endswith('.pkl') or f.endswith('.score.pkl'):
+            continue
+        try:
+            _, dname = parse_result_file(f)
+        except ValueError:
+            continue
+        if dname.split('_')[0] in ['stackselect', 'textsort']:
+            res.append(osp.join(root, f))
+    return res
+
+
+def rescore(result_file):
+    """Evaluate one result file with its score cache. Returns
+    ``(model, dname, acc, num_samples)``."""
+    from .dataset import build_dataset
+    from .store import ResultStore
+    model, dname = parse_result_file(result_file)
+    res = ResultStore(result_file).load()
+    # predictions of both the 'less' and 'normal' mode are a prefix of the 'normal' samples
+    dataset = build_dataset(dname, mode='normal')
+    meta = dataset.get_meta(with_text=False)
+    meta = meta[meta['index'].isin(res)].reset_index(drop=True)
+    if not len(meta):
+        return model, dname, None, 0
+    meta['prediction'] = [res[k] for k in meta['index']]
+    acc = dataset.evaluate(meta, cache=ScoreCache(score_cache_file(result_file)))
+    return model, dname, acc, len(meta)
+
+
+def rescore_all(root='results', nproc=8):
+    files = list_result_files(root)
+    if nproc > 1 and len(files) > 1:
+        with Pool(min(nproc, len(files))) as pool:
+            return pool.map(rescore, files)
+    return [rescore(f) for f in files]
+
+
+if __name__ == '__main__':
+    from .resultdb import ResultDB
+    parser = argparse.ArgumentParser(description='Re-score every results/*.pkl in parallel. ')
+    parser.add_argument('--root', type=str, default='results')
+    parser.add_argument('--nproc', type=int, default=8)
+    parser.add_argument('--result-db', type=str, default='result.sqlite')
+    parser.add_argument('--result-file', type=str, default='result.json')
+    args = parser.parse_args()
+
+    db = ResultDB(args.result_db)
+    for model, dname, acc, num in rescore_all(args.root, args.nproc):
+        if acc is not None:
+            db.rescore(model, dname, acc, samples=num)
+            print(f'{model}_{dname}: {acc:.1f} ({num} samples)')
+    db.export_json(args.result_file)
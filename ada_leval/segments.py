@@ -0,0 +1,243 @@
+import argparse
+import json
+import mmap
+import multiprocessing as mp
+import os
+import os.path as osp
+import struct
+import sys
+from array import array
+
+from .indexed import load_records, source_stat
+
+_MAGIC = b'ADALSEG2'
+# number of segments, number of records, size and mtime (ns) of the json file the store was built from
+_HEADER = struct.Struct('<QQQQ')
+
+
+def segment_paths(data_file):
+    base = osp.splitext(data_file)[0]
+    return base + '.segs.bin', base + '.segs.idx'
+
+
+def _array(typecode, data):
+    res = array(typecode)
+    res.frombytes(data)
+    if sys.byteorder != 'little':
+        res.byteswap()
+    return res
+
+
+def _bytes(arr):
+    if sys.byteorder != 'little':
+        arr = array(arr.typecode, arr)
+        arr.byteswap()
+    return arr.tobytes()
+
+
+def build(data_file):
+    """Build the segment store of a TSort json file.
+
+    Prompts are split into lines, keeping the line ends: the paragraphs of
+    the books and the template lines between them. Each distinct line is a
+    segment, stored once in ``{name}.segs.bin``, and a prompt is the
+    sequence of its segment ids. ``{name}.segs.idx`` holds the magic, the
+    counts, the size and mtime of ``data_file`` (a store whose source has
+    changed since is not used), ``n + 1`` uint64 segment offsets into the
+    buffer, the uint64 offsets of the ids of each record, the uint32 ids,
+    the uint64 offsets of the json of the other fields of each record and
+    that json. Every prompt is rebuilt and compared with the original before
+    the files are put in place.
+    """
+    source = source_stat(data_file)
+    records = load_records(data_file)
+    ids, index, meta = {}, array('I'), []
+    rec_offsets, meta_offsets = array('Q', [0]), array('Q', [0])
+    bin_file, idx_file = segment_paths(data_file)
+    seg_offsets = array('Q', [0])
+    with open(bin_file + '.tmp', 'wb') as fout:
+        for item in records:
+            for line in item['prompt'].splitlines(keepends=True):
+                k = ids.get(line)
+                if k is None:
+                    k = ids[line] = len(ids)
+                    seg = line.encode('utf-8')
+                    fout.write(seg)
+                    seg_offsets.append(seg_offsets[-1] + len(seg))
+                index.append(k)
+            rec_offsets.append(len(index))
+            meta.append(json.dumps({k: v for k, v in item.items() if k != 'prompt'}, ensure_ascii=False).encode('utf-8'))
+            meta_offsets.append(meta_offsets[-1] + len(meta[-1]))
+    with open(idx_file + '.tmp', 'wb') as fout:
+        fout.write(_MAGIC + _HEADER.pack(len(ids), len(records), *source))
+        fout.write(_bytes(seg_offsets))
+        fout.write(_bytes(rec_offsets))
+        fout.write(_bytes(index))
+        fout.write(_bytes(meta_offsets))
+        fout.writelines(meta)
+    store = SegmentStore(data_file, suffix='.tmp')
+    for i, item in enumerate(records):
+        assert store.prompt(i) == item['prompt'], f'prompt {i} of {data_file} is not rebuilt identically'
+    store.close()
+    os.replace(bin_file + '.tmp', bin_file)
+    os.replace(idx_file + '.tmp', idx_file)
+    return bin_file, idx_file
+
+
+class SegmentStore:
+    """The content-addressed segments of a TSort dataset.
+
+    The segment ids of each prompt are read on open and the other fields of
+    the records when they are requested; the segment buffer is memory-mapped, and a prompt is
+    rebuilt by joining its segments when it is requested, so that the book
+    paragraphs shared by overlapping samples are held once, by the page
+    cache.
+    """
+
+    def __init__(self, data_file, suffix=''):
+        self.bin_file, self.idx_file = (x + suffix for x in segment_paths(data_file))
+        with open(self.idx_file, 'rb') as fin:
+            assert fin.read(len(_MAGIC)) == _MAGIC, f'{self.idx_file} is not a segment store'
+            num_segments, num_records, *self.source = _HEADER.unpack(fin.read(_HEADER.size))
+            self.seg_offsets = _array('Q', fin.read(8 * (num_segments + 1)))
+            self.rec_offsets = _array('Q', fin.read(8 * (num_records + 1)))
+            self.ids = _array('I', fin.read(4 * self.rec_offsets[-1]))
+            self.meta_offsets = _array('Q', fin.read(8 * (num_records + 1)))
+            self._meta_start = fin.tell()
+        self._buf = None
+
+    @staticmethod
+    def available(data_file, check_source=True):
+        """Whether the segment store of ``data_file`` exists and, with
+        ``check_source``, was built from its current version (same size and
+        mtime); a stale or older-format store is ignored."""
+        if not all(osp.exists(x) for x in segment_paths(data_file)):
+            return False
+        if not check_source:
+            return True
+        with open(segment_paths(data_file)[1], 'rb') as fin:
+            if fin.read(len(_MAGIC)) != _MAGIC:
+                return False
+            source = _HEADER.unpack(fin.read(_HEADER.size))[2:]
+        return osp.exists(data_file) and source == source_stat(data_file)
+
+    def _get_buf(self):
+        if self._buf is None:
+            with open(self.bin_file, 'rb') as fin:
+                self._buf = mmap.mmap(fin.fileno(), 0, access=mmap.ACCESS_READ)
+        return self._buf
+
+    def close(self):
+        if self._buf is not None:
+            self._buf.close()
+            self._buf = None
+
+    def __len__(self):
+        return len(self.meta_offsets) - 1
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_buf'] = None
+        return state
+
+    def records(self, num=-1):
+        """The first ``num`` records (all if ``num <= 0``) without their
+        prompt, which is ``prompt(record['prompt_id'])``."""
+        num = len(self) if num <= 0 else min(num, len(self))
+        offsets = self.meta_offsets
+        with open(self.idx_file, 'rb') as fin:
+            fin.seek(self._meta_start)
+            data = fin.read(offsets[num])
+        return [dict(json.loads(data[offsets[i]: offsets[i + 1]].decode('utf-8')), prompt_id=i) for i in range(num)]
+
+    def segment_ids(self, i):
+        return self.ids[self.rec_offsets[i]: self.rec_offsets[i + 1]]
+
+    def segment(self, k):
+        return self._get_buf()[self.seg_offsets[k]: self.seg_offsets[k + 1]].decode('utf-8')
+
+    def prompt(self, i):
+        buf, offsets = self._get_buf(), self.seg_offsets
+        return b''.join(buf[offsets[k]: offsets[k + 1]] for k in self.segment_ids(i)).decode('utf-8')
+
+    def common_prefix_len(self, rows):
+        """The length of the longest common prefix of the prompts of
+        ``rows``, in characters, as ``osp.commonprefix`` would find, without
+        rebuilding them: the shared leading segments plus the common prefix
+        of the first segments that differ."""
+        seqs = [self.segment_ids(i) for i in rows]
+        n = 0
+        while all(len(s) > n for s in seqs) and len({s[n] for s in seqs}) == 1:
+            n += 1
+        size = sum(len(self.segment(k)) for k in seqs[0][:n])
+        return size + len(osp.commonprefix([self.segment(s[n]) if len(s) > n else '' for s in seqs]))
+
+    def stats(self):
+        """Bytes of the prompts as stored in the json file and as segments."""
+        sizes = [self.seg_offsets[k + 1] - self.seg_offsets[k] for k in range(len(self.seg_offsets) - 1)]
+        return dict(
+            records=len(self),
+            segments=len(sizes),
+            prompt_bytes=sum(sizes[k] for k in self.ids),
+            segment_bytes=sum(sizes),
+            store_bytes=osp.getsize(self.bin_file) + osp.getsize(self.idx_file))
+
+
+def _rss():
+    # resident set size of this process in bytes
+    try:
+        with open('/proc/self/statm') as fin:
+            return int(fin.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except OSError:
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def _loaded_rss(data_file, num, segments):
+    # run in a fresh interpreter: the memory held by the records TextSort keeps, once every evaluated prompt was
+    # built (which maps in the segments they use)
+    import gc
+    before = _rss()
+    if segments:
+        store = SegmentStore(data_file)
+        data = store.records(num)
+        size = sum(len(store.prompt(x['prompt_id'])) for x in data)
+    else:
+        data = load_records(data_file, num)
+        size = sum(len(x['prompt']) for x in data)
+    gc.collect()
+    res = _rss() - before
+    del data, size
+    return res
+
+
+def report(data_file, num=-1):
+    """Storage and memory of a dataset as records and as a segment store,
+    loading the first ``num`` records and building their prompts in fresh
+    processes."""
+    store = SegmentStore(data_file)
+    res = store.stats()
+    res['json_bytes'] = osp.getsize(data_file)
+    with mp.get_context('spawn').Pool(1) as pool:
+        res['records_rss'] = pool.apply(_loaded_rss, (data_file, num, False))
+    with mp.get_context('spawn').Pool(1) as pool:
+        res['segments_rss'] = pool.apply(_loaded_rss, (data_file, num, True))
+    return res
+
+
+if __name__ == '__main__':
+    from .synthetic import num_records
+    parser = argparse.ArgumentParser(
+        description='Build the segment stores of TSort json files, from which TextSort rebuilds the prompts. ')
+    parser.add_argument('files', type=str, nargs='+')
+    parser.add_argument('--mode', type=str, default='normal', choices=['normal', 'less'])
+    args = parser.parse_args()
+    mib = 1 << 20
+    for f in args.files:
+        build(f)
+        r = report(f, num_records(osp.splitext(osp.basename(f))[0], args.mode))
+        print(f'{f}: {r["records"]} records, {r["segments"]} distinct segments, prompts '
+              f'{r["prompt_bytes"] / mib:.1f} MiB -> {r["segment_bytes"] / mib:.1f} MiB '
+              f'({r["prompt_bytes"] / max(r["segment_bytes"], 1):.1f}x); on disk {r["json_bytes"] / mib:.1f} MiB json, '
+              f'{r["store_bytes"] / mib:.1f} MiB store; RSS after building the evaluated prompts '
+              f'{r["records_rss"] / mib:.1f} MiB -> {r["segments_rss"] / mib:.1f} MiB')
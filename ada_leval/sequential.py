@@ -0,0 +1,130 @@
+import math
+
+
+def z_value(confidence):
+    """The two-sided z value of a confidence level, e.g. 1.96 for 0.95."""
+    lo, hi = 0.0, 10.0
+    for _ in range(64):
+        mid = (lo + hi) / 2
+        if math.erf(mid / math.sqrt(2)) < confidence:
+            lo = mid
+        else:
+            hi = mid
+    return (lo + hi) / 2
+
+
+def wilson_interval(hit, n, z=1.96):
+    """The Wilson score interval of a proportion of ``hit`` out of ``n``.
+    Unlike the normal approximation, it stays inside [0, 1] and is not
+    degenerate for proportions near 0, where the long settings score."""
+    if n == 0:
+        return 0.0, 1.0
+    p = hit / n
+    denom = 1 + z * z / n
+    center = (p + z * z / (2 * n)) / denom
+    half = z * math.sqrt(p * (1 - p) / n + z * z / (4 * n * n)) / denom
+    return max(center - half, 0.0), min(center + half, 1.0)
+
+
+class SequentialStop:
+    """Decides when a dataset has been evaluated on enough samples.
+
+    Samples are scored as their predictions arrive. After ``min_samples``,
+    evaluation stops once the Wilson interval of the accuracy is at most
+    ``width`` points wide (``'width'``), or once it contains the accuracy of
+    random guessing and reaches at most ``margin`` points above it
+    (``'random'``). Samples must arrive in a random order for the accuracy
+    of a prefix to be unbiased. Checking after every sample makes the actual
+    coverage of the interval somewhat lower than ``confidence``.
+
+    Args:
+        width (float): Target width of the interval, in accuracy points.
+            Defaults to 10.
+        margin (float): How far above the random-guess accuracy the interval
+            may reach to be considered indistinguishable from it, in points.
+            Defaults to 5.
+        min_samples (int): Never stop before this many samples. Defaults
+            to 30.
+        confidence (float): Confidence level of the interval. Defaults
+            to 0.95.
+    """
+
+    def __init__(self, width=10.0, margin=5.0, min_samples=30, confidence=0.95):
+        self.width = width
+        self.margin = margin
+        self.min_samples = min_samples
+        self.confidence = confidence
+        self.z = z_value(confidence)
+        self.hit = 0
+        self.n = 0
+        self.chance = 0.0
+        self.decision = None
+        self.decided_at = None
+
+    @property
+    def done(self):
+        return self.decision is not None
+
+    @property
+    def accuracy(self):
+        return 100 * self.hit / max(self.n, 1)
+
+    @property
+    def baseline(self):
+        # the accuracy of random guessing on the samples seen so far
+        return 100 * self.chance / max(self.n, 1)
+
+    def interval(self):
+        lo, hi = wilson_interval(self.hit, self.n, self.z)
+        return 100 * lo, 100 * hi
+
+    def check(self):
+        if self.n < self.min_samples:
+            return None
+        lo, hi = self.interval()
+        if lo <= self.baseline <= hi and hi - self.baseline <= self.margin:
+            return 'random'
+        if hi - lo <= self.width:
+            return 'width'
+        return None
+
+    def update(self, flag, chance):
+        """Record the score of one sample and the probability of a random
+        guess being right on it. Results arriving after the decision still
+        narrow the interval, but do not change the decision."""
+        self.hit += bool(flag)
+        self.n += 1
+        self.chance += chance
+        if self.decision is None:
+            self.decision = self.check()
+            if self.decision is not None:
+                self.decided_at = self.n
+
+    def gate(self, items):
+        """Pass ``items`` through until the decision to stop is made."""
+        for item in items:
+            if self.done:
+                return
+            yield item
+
+    def summary(self, total):
+        """The decision and the effective sample size, out of ``total``
+        samples, as recorded in ``result.json``."""
+        lo, hi = self.interval()
+        return dict(
+            decision='exhausted' if self.decision is None else self.decision,
+            samples=self.n,
+            decided_at=self.decided_at,
+            total=total,
+            accuracy=round(self.accuracy, 2),
+            ci=[round(lo, 2), round(hi, 2)],
+            confidence=self.confidence,
+            baseline=round(self.baseline, 2),
+            width=self.width,
+            margin=self.margin)
+
+    def __str__(self):
+        lo, hi = self.interval()
+        decision = 'running' if self.decision is None else f'stopped ({self.decision}) at {self.decided_at}'
+        return (f'{self.accuracy:.1f}% [{lo:.1f}, {hi:.1f}] over {self.n} samples, '
+                f'random {self.baseline:.1f}%, {decision}')
@@ -3,30 +3,67 @@ import abc
 import argparse
 import collections
 import csv
+import importlib
 import json
 import multiprocessing as mp
-import numpy as np
 import os, sys, time, base64, io
 import os.path as osp
 import copy as cp
 import pickle
 import random as rd
-import requests
 import shutil
 import string
 import subprocess
 import warnings
-import pandas as pd
 from collections import OrderedDict, defaultdict
 from multiprocessing import Pool, current_process
-from tqdm import tqdm
-from PIL import Image
 import uuid
 from uuid import uuid4
 from datetime import datetime
-import matplotlib.pyplot as plt
-import seaborn as sns
-from tabulate import tabulate
+
+
+class LazyImport:
+    """A module (or an attribute of it) imported on first use.
+
+    Every module star-imports this file, so the heavy dependencies below are
+    only imported by the processes that use them: ``run.py --help``, the pool
+    workers and the scorers never load the plotting stacks.
+    """
+
+    # looked up by pickle and copy on the proxy itself, before ``__dict__`` is set when unpickling
+    _PROTOCOL = {'__getstate__', '__setstate__', '__reduce__', '__reduce_ex__', '__getnewargs__',
+                 '__getnewargs_ex__', '__copy__', '__deepcopy__', '_module', '_attr', '_obj'}
+
+    def __init__(self, module, attr=None):
+        self.__dict__.update(_module=module, _attr=attr, _obj=None)
+
+    def _load(self):
+        if self._obj is None:
+            obj = importlib.import_module(self._module)
+            self.__dict__['_obj'] = obj if self._attr is None else getattr(obj, self._attr)
+        return self._obj
+
+    def __getattr__(self, name):
+        if name in LazyImport._PROTOCOL:
+            raise AttributeError(name)
+        return getattr(self._load(), name)
+
+    def __call__(self, *args, **kwargs):
+        return self._load()(*args, **kwargs)
+
+    def __repr__(self):
+        name = self._module if self._attr is None else f'{self._module}.{self._attr}'
+        return f'<lazy {name}{"" if self._obj is None else " (loaded)"}>'
+
+
+np = LazyImport('numpy')
+pd = LazyImport('pandas')
+requests = LazyImport('requests')
+plt = LazyImport('matplotlib.pyplot')
+sns = LazyImport('seaborn')
+Image = LazyImport('PIL.Image')
+tqdm = LazyImport('tqdm', 'tqdm')
+tabulate = LazyImport('tabulate', 'tabulate')
 
 def d2df(D):
     return pd.DataFrame({x: [D[x]] for x in D})
@@ -167,18 +204,26 @@ def dump(data, f, **kwargs):
     def dump_tsv(data, f, quoting=csv.QUOTE_MINIMAL):
         data.to_csv(f, sep='\t', index=False, encoding='utf-8', quoting=quoting)
 
-    handlers = dict(pkl=dump_pkl, json=dump_json, jsonl=dump_jsonl, xlsx=dump_xlsx, csv=dump_csv, tsv=dump_tsv)
+    def dump_parquet(data, f, compression='zstd', row_group_size=1024):
+        # columnar and compressed, list columns (tags, orders) keep their types
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        pq.write_table(pa.Table.from_pandas(data, preserve_index=False), f,
+                       compression=compression, row_group_size=row_group_size)
+
+    handlers = dict(pkl=dump_pkl, json=dump_json, jsonl=dump_jsonl, xlsx=dump_xlsx, csv=dump_csv, tsv=dump_tsv,
+                    parquet=dump_parquet)
     suffix = f.split('.')[-1]
     return handlers[suffix](data, f, **kwargs)
 
-import portalocker
 def safe_dump(data, f, **kwargs):
+    import portalocker
     with portalocker.Lock(f, timeout=5) as fh:
         dump(data, f, **kwargs)
         fh.flush()
         os.fsync(fh.fileno())
 
-def load(f):
+def load(f, **kwargs):
     def load_pkl(pth):
         return pickle.load(open(pth, 'rb'))
 
@@ -202,6 +247,26 @@ def load(f):
     def load_tsv(f):
         return pd.read_csv(f, sep='\t')
 
-    handlers = dict(pkl=load_pkl, json=load_json, jsonl=load_jsonl, xlsx=load_xlsx, csv=load_csv, tsv=load_tsv)
+    def load_parquet(f, columns=None):
+        # only the given columns are read
+        return pd.read_parquet(f, columns=columns)
+
+    handlers = dict(pkl=load_pkl, json=load_json, jsonl=load_jsonl, xlsx=load_xlsx, csv=load_csv, tsv=load_tsv,
+                    parquet=load_parquet)
     suffix = f.split('.')[-1]
-    return handlers[suffix](f) 
\ No newline at end of file
+    return handlers[suffix](f, **kwargs)
+
+def convert(src, dst):
+    """Convert a file between the formats of ``load`` and ``dump``, e.g. a
+    parquet prediction file to xlsx for reading in a spreadsheet."""
+    dump(load(src), dst)
+    return dst
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Convert files between the formats of dump / load. ')
+    parser.add_argument('files', type=str, nargs='+')
+    parser.add_argument('--to', type=str, default='xlsx')
+    args = parser.parse_args()
+    for f in args.files:
+        print(convert(f, f[:f.rindex('.') + 1] + args.to)) 
\ No newline at end of file
@@ -0,0 +1,154 @@
+import os
+import os.path as osp
+import pickle
+import socket
+import struct
+import time
+
+import portalocker
+
+_HEADER = struct.Struct('<I')
+
+
+def default_writer():
+    return f'{socket.gethostname()}-{os.getpid()}'
+
+
+class ResultStore:
+    """An append-only result journal backed by a compacted pickle.
+
+    The compacted snapshot lives at ``path`` (a dict pickle, readable with
+    ``load``). New records are appended to a per-writer segment under
+    ``{path}.journal/`` as length-prefixed pickles, so writers never contend
+    for a lock and each ``put`` costs O(1) disk I/O. Segments are fsynced in
+    groups (every ``sync_every`` records or ``sync_interval`` seconds).
+    ``compact`` folds all segments into the snapshot and removes them.
+
+    Args:
+        path (str): The snapshot file, e.g. ``results/{model}_{dname}.pkl``.
+        writer (str, optional): The segment name owned by this writer.
+            Defaults to ``{hostname}-{pid}``.
+        sync_every (int): Number of records per group commit. Defaults to 64.
+        sync_interval (float): Max seconds between group commits.
+            Defaults to 1.0.
+    """
+
+    def __init__(self, path, writer=None, sync_every=64, sync_interval=1.0):
+        self.path = path
+        self.journal = path + '.journal'
+        self.writer = default_writer() if writer is None else writer
+        self.sync_every = sync_every
+        self.sync_interval = sync_interval
+        self._fh = None
+        self._pending = 0
+        self._last_sync = time.time()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_fh'] = None
+        state['_pending'] = 0
+        return state
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def _segment(self):
+        return osp.join(self.journal, f'{self.writer}.log')
+
+    def segments(self):
+        if not osp.isdir(self.journal):
+            return []
+        return sorted(osp.join(self.journal, x) for x in os.listdir(self.journal) if x.endswith('.log'))
+
+    def put(self, key, value):
+        if self._fh is None:
+            os.makedirs(self.journal, exist_ok=True)
+            self._fh = open(self._segment(), 'ab')
+        rec = pickle.dumps((key, value), protocol=pickle.HIGHEST_PROTOCOL)
+        self._fh.write(_HEADER.pack(len(rec)) + rec)
+        # hand the record to the OS right away, it survives a process crash
+        self._fh.flush()
+        self._pending += 1
+        if self._pending >= self.sync_every or time.time() - self._last_sync >= self.sync_interval:
+            self.flush()
+
+    def update(self, data):
+        for k, v in data.items():
+            self.put(k, v)
+
+    def flush(self, sync=True):
+        if self._fh is None:
+            return
+        self._fh.flush()
+        if sync and self._pending:
+            os.fsync(self._fh.fileno())
+        self._pending = 0
+        self._last_sync = time.time()
+
+    def close(self):
+        if self._fh is not None:
+            self.flush()
+            self._fh.close()
+            self._fh = None
+
+    @staticmethod
+    def read_segment(pth):
+        """Yield (key, value) records, ignoring a torn record at the tail."""
+        with open(pth, 'rb') as fin:
+            buf = fin.read()
+        pos = 0
+        while pos + _HEADER.size <= len(buf):
+            size, = _HEADER.unpack_from(buf, pos)
+            end = pos + _HEADER.size + size
+            if end > len(buf):
+                break
+            try:
+                yield pickle.loads(buf[pos + _HEADER.size: end])
+            except Exception:
+                break
+            pos = end
+
+    def load(self):
+        """Return the snapshot merged with all journal segments."""
+        res = {}
+        if osp.exists(self.path):
+            with open(self.path, 'rb') as fin:
+                res.update(pickle.load(fin))
+        for seg in self.segments():
+            res.update(self.read_segment(seg))
+        return res
+
+    def compact(self):
+        """Merge all segments into the snapshot and remove them.
+
+        Call it once every writer of the journal has closed, e.g. after the
+        final barrier of a run.
+        """
+        self.close()
+        os.makedirs(self.journal, exist_ok=True)
+        lock = osp.join(self.journal, 'compact.lock')
+        with portalocker.Lock(lock, timeout=60):
+            res = {}
+            if osp.exists(self.path):
+                with open(self.path, 'rb') as fin:
+                    res.update(pickle.load(fin))
+            segs = self.segments()
+            for seg in segs:
+                res.update(self.read_segment(seg))
+            tmp = f'{self.path}.{self.writer}.tmp'
+            with open(tmp, 'wb') as fout:
+                pickle.dump(res, fout, protocol=pickle.HIGHEST_PROTOCOL)
+                fout.flush()
+                os.fsync(fout.fileno())
+            os.replace(tmp, self.path)
+            for seg in segs:
+                os.remove(seg)
+        try:
+            os.remove(lock)
+            os.rmdir(self.journal)
+        except OSError:
+            pass
+        return res
@@ -0,0 +1,94 @@
+import argparse
+import json
+import os
+import os.path as osp
+import random as rd
+
+from .dataset import TEXTSORT_TEMPLATE, setting_tokens
+
+SETTINGS = ['1k', '2k', '4k', '8k', '16k', '32k', '64k', '128k']
+STACKSELECT_SETTINGS = SETTINGS + ['6k', '12k']
+
+_WORDS = ('the of and to in is that it for as with was on be by this are or from at an which but not have '
+          'function value return list error file python code data type class object string number method '
+          'answer question example case test result output input array problem solution would should '
+          'chapter said could there their about into than them then some what when where while before').split()
+
+
+def num_records(dname, mode='normal'):
+    """The number of records ``build_dataset(dname, mode)`` reads."""
+    long = setting_tokens(dname.split('_')[1]) >= 32000
+    if mode == 'less':
+        return 50 if long else 200
+    return 200 if long else 1000
+
+
+def _text(rng, num_tokens):
+    # about 1.3 tokens per word under cl100k
+    return ' '.join(rng.choice(_WORDS) for _ in range(max(int(num_tokens / 1.3), 1)))
+
+
+def stackselect_record(rng, tokens, idx):
+    """One BestAnswer sample of about ``tokens`` prompt tokens."""
+    num_choice = max(2, tokens // 350)
+    per_answer = (tokens - 600) // num_choice
+    answers = [_text(rng, rng.randint(per_answer // 2, per_answer * 3 // 2)) for _ in range(num_choice)]
+    return dict(
+        question_id=str(100000 + idx),
+        question=_text(rng, 150),
+        answer=f'A{rng.randint(1, num_choice)}',
+        tags=rng.sample(['python', 'java', 'c++', 'linux', 'sql', 'regex'], 2),
+        all_answers=answers)
+
+
+def textsort_record(rng, tokens, idx):
+    """One TSort sample of about ``tokens`` prompt tokens."""
+    book_id = idx // 5
+    offset = rng.randint(0, 1000)
+    para_offset = [offset + k for k in range(4)]
+    order = rng.sample(range(1, 5), 4)
+    segments = [_text(rng, (tokens - 400) // 6) for _ in range(4)]
+    template = TEXTSORT_TEMPLATE
+    prompt = template['instruction'] + template['before'].format(text=_text(rng, (tokens - 400) // 6))
+    for k, seg in enumerate(segments):
+        prompt += template['segment'].format(k=k + 1, text=seg)
+    prompt += template['after'].format(text=_text(rng, (tokens - 400) // 6))
+    return dict(book_id=book_id, para_offset=para_offset, answer=order, prompt=prompt)
+
+
+def generate(dname, root='data', num=None, mode='normal', seed=0):
+    """Write a schema-correct synthetic ``{root}/{dname}.json``. Prompts have
+    about as many tokens as the setting. Returns the file path."""
+    task, setting = dname.split('_')
+    assert task in ['stackselect', 'textsort'], dname
+    tokens = setting_tokens(setting)
+    num = num_records(dname, mode) if num is None else num
+    rng = rd.Random(f'{dname}-{seed}')
+    make = stackselect_record if task == 'stackselect' else textsort_record
+    os.makedirs(root, exist_ok=True)
+    pth = osp.join(root, f'{dname}.json')
+    # records are written one by one, so that the long settings are never held in memory
+    with open(pth, 'w', encoding='utf-8') as fout:
+        fout.write('[')
+        for i in range(num):
+            if i:
+                fout.write(', ')
+            json.dump(make(rng, tokens, i), fout)
+        fout.write(']')
+    return pth
+
+
+def all_datasets():
+    return [f'stackselect_{k}' for k in STACKSELECT_SETTINGS] + [f'textsort_{k}' for k in SETTINGS]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Generate synthetic Ada-LEval data files. ')
+    parser.add_argument('--data', type=str, nargs='+', default=all_datasets())
+    parser.add_argument('--root', type=str, default='data')
+    parser.add_argument('--num', type=int, default=None)
+    parser.add_argument('--mode', type=str, default='normal', choices=['normal', 'less'])
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    for dname in args.data:
+        print(generate(dname, args.root, args.num, args.mode, args.seed))
@@ -0,0 +1,158 @@
+import contextvars
+import json
+import os
+import os.path as osp
+import time
+from contextlib import contextmanager
+from uuid import uuid4
+
+# fields describing the item a request belongs to, set by the pipeline around each call
+_REQUEST_TAG = contextvars.ContextVar('ada_leval_request_tag', default=None)
+# (path, pid) -> append-only fd, shared by the copies of a sink unpickled in the same pool worker
+_FDS = {}
+
+
+@contextmanager
+def tagged(**tag):
+    token = _REQUEST_TAG.set(tag)
+    try:
+        yield
+    finally:
+        _REQUEST_TAG.reset(token)
+
+
+class Telemetry:
+    """A JSONL sink of structured events, shared by all processes of a run.
+
+    Every event is one json line tagged with the ``run`` id of the sink, and
+    written with a single ``O_APPEND`` write, so that pool workers (which get a
+    pickled copy of the sink) can write to the same file. Events:
+
+    - ``request``: one API call, with ``enqueue`` / ``start`` / ``end``
+      timestamps, ``attempts``, the last HTTP ``status``, ``prompt_tokens`` /
+      ``completion_tokens`` from the response usage, ``bytes_sent``,
+      ``last_attempt`` (seconds spent in the successful attempt) and, for
+      streamed completions, ``ttft`` and ``early_stop``.
+    - ``checkpoint``: seconds spent persisting the results of a task.
+    - ``summary``: see :meth:`summarize`.
+    """
+
+    def __init__(self, path, run_id=None):
+        self.path = path
+        self.run_id = uuid4().hex[:12] if run_id is None else run_id
+        dirname = osp.dirname(path)
+        if dirname:
+            os.makedirs(dirname, exist_ok=True)
+
+    def _fd(self):
+        # one fd per file and process, not per copy of the sink: the pool unpickles one for every task
+        key = (self.path, os.getpid())
+        fd = _FDS.get(key)
+        if fd is None:
+            fd = _FDS[key] = os.open(self.path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+        return fd
+
+    def write(self, **event):
+        event.setdefault('run', self.run_id)
+        os.write(self._fd(), (json.dumps(event, ensure_ascii=False) + '\n').encode('utf-8'))
+
+    def events(self, **match):
+        """Events of this run with all fields in ``match`` equal."""
+        if not osp.exists(self.path):
+            return []
+        res = []
+        with open(self.path, 'r', encoding='utf-8') as fin:
+            for line in fin:
+                try:
+                    event = json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+                if event.get('run') == self.run_id and all(event.get(k) == v for k, v in match.items()):
+                    res.append(event)
+        return res
+
+    def trace(self):
+        return RequestTrace(self)
+
+    def usage(self, task):
+        """Tokens used by the (not cached) requests of ``task``."""
+        reqs = [e for e in self.events(task=task, kind='request') if not e.get('cached')]
+        return dict(prompt_tokens=sum(e.get('prompt_tokens') or 0 for e in reqs),
+                    completion_tokens=sum(e.get('completion_tokens') or 0 for e in reqs))
+
+    def summarize(self, task):
+        """Summarize the events of ``task``, record the summary as an event
+        and return a printable description of it."""
+        import numpy as np
+        reqs = [e for e in self.events(task=task, kind='request') if not e.get('cached')]
+        ckpt = sum(e['seconds'] for e in self.events(task=task, kind='checkpoint'))
+        summary = dict(kind='summary', task=task, requests=len(reqs), checkpoint_s=ckpt)
+        if len(reqs):
+            latency = np.array([e['end'] - e['start'] for e in reqs])
+            wait = np.array([e['start'] - e.get('enqueue', e['start']) for e in reqs])
+            tokens = sum((e.get('prompt_tokens') or 0) + (e.get('completion_tokens') or 0) for e in reqs)
+            span = max(e['end'] for e in reqs) - min(e.get('enqueue', e['start']) for e in reqs)
+            last = sum(e.get('last_attempt') or 0 for e in reqs)
+            p50, p95, p99 = np.percentile(latency, [50, 95, 99])
+            summary.update(
+                latency_p50=p50, latency_p95=p95, latency_p99=p99,
+                queue_wait_p50=float(np.percentile(wait, 50)),
+                tokens_per_s=tokens / max(span, 1e-9),
+                retries=sum(e['attempts'] - 1 for e in reqs if e['attempts'] > 0),
+                # the share of request time spent in failed attempts, backoff and rate limiting
+                retry_overhead=1 - last / max(latency.sum(), 1e-9),
+                bytes_sent=sum(e.get('bytes_sent') or 0 for e in reqs))
+            ttft = [e['ttft'] for e in reqs if e.get('ttft') is not None]
+            if len(ttft):
+                summary.update(ttft_p50=float(np.percentile(ttft, 50)), early_stops=sum(bool(e.get('early_stop')) for e in reqs))
+        summary['cached'] = len(self.events(task=task, kind='request', cached=True))
+        summary = {k: float(v) if isinstance(v, np.floating) else v for k, v in summary.items()}
+        self.write(**summary)
+        if not len(reqs):
+            return f"{task}: no requests sent ({summary['cached']} cached), checkpointing {ckpt:.2f}s"
+        stream = ''
+        if 'ttft_p50' in summary:
+            stream = f"TTFT p50 {summary['ttft_p50']:.2f}s, {summary['early_stops']} stopped early, "
+        return (f"{task}: {len(reqs)} requests ({summary['cached']} cached), latency p50/p95/p99 "
+                f'{p50:.2f}/{p95:.2f}/{p99:.2f}s, {stream}queue wait p50 {summary["queue_wait_p50"]:.2f}s, '
+                f"{summary['tokens_per_s']:.0f} tokens/s, {summary['retries']} retries "
+                f"({100 * summary['retry_overhead']:.1f}% of request time outside the final attempt), "
+                f'checkpointing {ckpt:.2f}s')
+
+
+class RequestTrace:
+    """Collects the telemetry of one ``generate`` call. A no-op if the sink
+    is None."""
+
+    def __init__(self, sink=None):
+        self.sink = sink
+        if sink is None:
+            return
+        self.rec = dict(kind='request', **(_REQUEST_TAG.get() or {}))
+        self.rec.update(start=time.time(), attempts=0, status=None, bytes_sent=0)
+        self._t = None
+
+    def begin_attempt(self):
+        if self.sink is not None:
+            self.rec['attempts'] += 1
+            self._t = time.time()
+
+    def end_attempt(self, status, info=None):
+        if self.sink is None:
+            return
+        self.rec['status'] = status
+        self.rec['last_attempt'] = time.time() - self._t
+        info = {} if info is None else info
+        self.rec['bytes_sent'] += info.get('bytes_sent', 0)
+        for k in ['prompt_tokens', 'completion_tokens', 'ttft', 'early_stop']:
+            if info.get(k) is not None:
+                self.rec[k] = info[k]
+
+    def finish(self, ok, cached=False):
+        if self.sink is None:
+            return
+        self.rec.update(end=time.time(), ok=ok, cached=cached)
+        try:
+            self.sink.write(**self.rec)
+        except OSError:
+            pass
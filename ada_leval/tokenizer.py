@@ -0,0 +1,103 @@
+import hashlib
+import os
+import os.path as osp
+import pickle
+from functools import lru_cache
+
+# (encoding name, text hash) -> number of tokens, shared by everything in this process
+_TOKEN_LENS = {}
+
+
+@lru_cache()
+def get_encoder(model='gpt-4'):
+    import tiktoken
+    try:
+        return tiktoken.encoding_for_model(model)
+    except:
+        return tiktoken.encoding_for_model('gpt-4')
+
+
+def text_hash(text):
+    return hashlib.blake2b(text.encode('utf-8'), digest_size=16).hexdigest()
+
+
+def count_tokens(text, model='gpt-4'):
+    enc = get_encoder(model)
+    key = (enc.name, text_hash(text))
+    if key not in _TOKEN_LENS:
+        _TOKEN_LENS[key] = len(enc.encode_ordinary(text))
+    return _TOKEN_LENS[key]
+
+
+def count_tokens_batch(texts, model='gpt-4', nthreads=8):
+    """Count tokens of many texts, tokenizing the unseen ones with a thread pool
+    (tiktoken releases the GIL while encoding)."""
+    enc = get_encoder(model)
+    keys = [(enc.name, text_hash(t)) for t in texts]
+    todo = {}
+    for k, t in zip(keys, texts):
+        if k not in _TOKEN_LENS and k not in todo:
+            todo[k] = t
+    if len(todo):
+        encoded = enc.encode_ordinary_batch(list(todo.values()), num_threads=nthreads)
+        for k, tokens in zip(todo, encoded):
+            _TOKEN_LENS[k] = len(tokens)
+    return [_TOKEN_LENS[k] for k in keys]
+
+
+class TokenIndex:
+    """A persisted prompt hash -> token count index of one dataset file.
+
+    The index is stored next to the data file as
+    ``{data_file}.{encoding}.tokens.pkl`` and is shared by runs, workers and
+    planning tools, so each prompt is tokenized at most once. Looked up
+    lengths are also cached in-process, where ``count_tokens`` (and thus
+    ``OpenAIWrapper.get_token_len``) will find them.
+    """
+
+    def __init__(self, data_file, model='gpt-4'):
+        self.model = model
+        self.encoding = get_encoder(model).name
+        self.path = f'{data_file}.{self.encoding}.tokens.pkl'
+        self.index = {}
+        self.dirty = False
+        if osp.exists(self.path):
+            with open(self.path, 'rb') as fin:
+                self.index = pickle.load(fin)
+
+    def _fill(self, chunk):
+        missing = {h: p for h, p in chunk if h not in self.index}
+        if len(missing):
+            lens = count_tokens_batch(list(missing.values()), model=self.model)
+            self.index.update(zip(missing, lens))
+            self.dirty = True
+        for h, _ in chunk:
+            _TOKEN_LENS[(self.encoding, h)] = self.index[h]
+
+    def get(self, prompt):
+        h = text_hash(prompt)
+        self._fill([(h, prompt)])
+        return self.index[h]
+
+    def lookup(self, prompts, chunk_size=64):
+        """Token counts of an iterable of prompts, tokenized in chunks so that
+        at most ``chunk_size`` prompts are held at a time."""
+        hashes, chunk = [], []
+        for p in prompts:
+            hashes.append(text_hash(p))
+            chunk.append((hashes[-1], p))
+            if len(chunk) >= chunk_size:
+                self._fill(chunk)
+                chunk = []
+        self._fill(chunk)
+        self.save()
+        return [self.index[h] for h in hashes]
+
+    def save(self):
+        if not self.dirty:
+            return
+        tmp = f'{self.path}.{os.getpid()}.tmp'
+        with open(tmp, 'wb') as fout:
+            pickle.dump(self.index, fout, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, self.path)
+        self.dirty = False
@@ -52,8 +52,7 @@ from rich.progress import (BarColumn, MofNCompleteColumn, Progress, Task,
                            TaskProgressColumn, TextColumn, TimeRemainingColumn)
 from rich.text import Text
 import os.path as osp
-import portalocker
-from .smp import load, dump
+from .store import ResultStore
 
 
 class _Worker:
@@ -76,6 +75,10 @@ class _Worker:
 class _SkipFirstTimeRemainingColumn(TimeRemainingColumn):
     """Skip calculating remaining time for the first few times.
 
+    If the task has the ``tokens_total`` and ``tokens_done`` fields, the
+    remaining time is estimated from the tokens left instead of the items
+    left, as long prompts take much longer than short ones.
+
     Args:
         skip_times (int): The number of times to skip. Defaults to 0.
     """
@@ -88,6 +91,12 @@ class _SkipFirstTimeRemainingColumn(TimeRemainingColumn):
         """Show time remaining."""
         if task.completed <= self.skip_times:
             return Text('-:--:--', style='progress.remaining')
+        total, done = task.fields.get('tokens_total'), task.fields.get('tokens_done')
+        if total and done and task.elapsed:
+            remaining = int(task.elapsed * max(total - done, 0) / done)
+            minutes, seconds = divmod(remaining, 60)
+            hours, minutes = divmod(minutes, 60)
+            return Text(f'{hours:d}:{minutes:02d}:{seconds:02d}', style='progress.remaining')
         return super().render(task)
 
 
@@ -131,6 +140,11 @@ def track_progress_rich(func: Callable,
             Defaults to 1.
         description (str): The description of progress bar.
             Defaults to "Process".
+        save (str, optional): If set, each result is appended to a
+            :class:`ResultStore` journal at this path as ``keys[idx]``, and
+            the journal is compacted into ``save`` when all tasks are done.
+            Defaults to None.
+        keys (list, optional): The keys used when saving results.
         color (str): The color of progress bar. Defaults to "blue".
 
     Examples:
@@ -146,8 +160,7 @@ def track_progress_rich(func: Callable,
     """
     if save is not None:
         assert osp.exists(osp.dirname(save)) or osp.dirname(save) == ''
-        if not osp.exists(save):
-            dump({}, save)
+        store = ResultStore(save)
     if keys is not None:
         assert len(keys) == len(tasks)
 
@@ -186,58 +199,91 @@ def track_progress_rich(func: Callable,
     tasks = _tasks_with_index(tasks)
 
     # Use single process when nproc is 1, else use multiprocess.
-    with prog_bar:
-        if nproc == 1:
-            results = []
-            for task in tasks:
-                result, idx = worker(task)
-                results.append(worker(task)[0])
-                if save is not None:
-                    with portalocker.Lock(save, timeout=5) as fh:
-                        ans = load(save)
-                        ans[keys[idx]] = result
-
+    try:
+        with prog_bar:
+            if nproc == 1:
+                results = []
+                for task in tasks:
+                    result, idx = worker(task)
+                    results.append(result)
+                    if save is not None:
+                        store.put(keys[idx], result)
                         if os.environ.get('VERBOSE', True):
                             print(keys[idx], result, flush=True)
 
-                        dump(ans, save)
-                        fh.flush()
-                        os.fsync(fh.fileno())
-
-                prog_bar.update(task_id, advance=1, refresh=True)
-        else:
-            with Pool(nproc) as pool:
-                results = []
-                unordered_results = []
-                gen = pool.imap_unordered(worker, tasks, chunksize)
-                try:
-                    for result in gen:
-                        result, idx = result
-                        unordered_results.append((result, idx))
-
-                        if save is not None:
-                            with portalocker.Lock(save, timeout=5) as fh:
-                                ans = load(save)
-                                ans[keys[idx]] = result
-
+                    prog_bar.update(task_id, advance=1, refresh=True)
+            else:
+                with Pool(nproc) as pool:
+                    results = []
+                    unordered_results = []
+                    gen = pool.imap_unordered(worker, tasks, chunksize)
+                    try:
+                        for result in gen:
+                            result, idx = result
+                            unordered_results.append((result, idx))
+
+                            if save is not None:
+                                store.put(keys[idx], result)
                                 if os.environ.get('VERBOSE', False):
                                     print(keys[idx], result, flush=True)
 
-                                dump(ans, save)
-                                fh.flush()
-                                os.fsync(fh.fileno())
-
-                        results.append(None)
-                        prog_bar.update(task_id, advance=1, refresh=True)
-                except Exception as e:
-                    prog_bar.stop()
-                    raise e
-            for result, idx in unordered_results:
-                results[idx] = result
+                            results.append(None)
+                            prog_bar.update(task_id, advance=1, refresh=True)
+                    except Exception as e:
+                        prog_bar.stop()
+                        raise e
+                for result, idx in unordered_results:
+                    results[idx] = result
+    finally:
+        if save is not None:
+            store.close()
+    if save is not None:
+        store.compact()
     return results
 
 
 def get_rank_and_world_size():
     local_rank = int(os.environ.get('LOCAL_RANK', 0))
     world_size = int(os.environ.get('WORLD_SIZE', 1))
-    return local_rank, world_size
\ No newline at end of file
+    return local_rank, world_size
+
+
+def balanced_partition(weights, k):
+    """Split items into ``k`` parts of nearly equal total weight with the LPT
+    (longest processing time first) greedy rule: items are taken from the
+    heaviest down and each goes to the currently lightest part.
+
+    Args:
+        weights (list): The weight (e.g. token count) of each item.
+        k (int): The number of parts.
+
+    Returns:
+        tuple[list, list]: The item ids of each part, heaviest first, and the
+            total weight of each part.
+    """
+    import heapq
+    heap = [(0, r) for r in range(k)]
+    parts = [[] for _ in range(k)]
+    loads = [0] * k
+    for i in sorted(range(len(weights)), key=lambda i: (-weights[i], i)):
+        load, r = heapq.heappop(heap)
+        parts[r].append(i)
+        loads[r] = load + weights[i]
+        heapq.heappush(heap, (loads[r], r))
+    return parts, loads
+
+
+def report_makespan(loads, elapsed):
+    """Compare the planned per-rank load with the measured wall time of each
+    rank. The planned time of a rank is its share of the total load times
+    the total measured time."""
+    sec_per_unit = sum(elapsed) / max(sum(loads), 1)
+    rows = []
+    for r, (load, t) in enumerate(zip(loads, elapsed)):
+        rows.append(f'rank {r}: planned {load} tokens / {load * sec_per_unit:.1f}s, actual {t:.1f}s')
+    mean_t = sum(elapsed) / len(elapsed)
+    rows.append(
+        f'makespan: planned {max(loads) * sec_per_unit:.1f}s, actual {max(elapsed):.1f}s, '
+        f'imbalance (max / mean): planned {max(loads) * len(loads) / max(sum(loads), 1):.3f}, '
+        f'actual {max(elapsed) / max(mean_t, 1e-9):.3f}')
+    return '\n'.join(rows)
\ No newline at end of file
@@ -0,0 +1,200 @@
+import os
+import os.path as osp
+import threading
+import time
+from contextlib import contextmanager
+from uuid import uuid4
+
+from .store import default_writer
+
+
+class WorkQueue:
+    """A work queue of dataset chunks, shared through lease files in a
+    directory that all workers (possibly on different hosts) can see.
+
+    A worker claims a chunk by creating ``chunk-{k}.lease`` exclusively,
+    with a token unique to the claim as its content, and keeps the lease
+    alive by touching it from a heartbeat thread. A lease not touched for
+    ``ttl`` seconds belongs to a dead worker and is stolen by the next
+    worker looking for work, so a crash only costs the leased chunk. A lease
+    is only removed (released, completed or stolen) after being renamed
+    away and found to hold the expected token, else it is put back, so a
+    stalled worker never removes the lease of the worker which took over
+    its chunk. Finished chunks are marked with ``chunk-{k}.done``. Workers
+    can join at any time: they simply claim what is left.
+
+    Args:
+        root (str): The shared queue directory of one (model, dataset) pair.
+        num_items (int): The number of samples of the dataset.
+        chunk_size (int): Samples per chunk. Defaults to 64.
+        ttl (float): Seconds after which a silent lease expires.
+            Defaults to 120.
+        worker (str, optional): The worker id written into leases.
+            Defaults to ``{hostname}-{pid}``.
+    """
+
+    def __init__(self, root, num_items, chunk_size=64, ttl=120, worker=None):
+        self.root = root
+        self.num_items = num_items
+        self.chunk_size = chunk_size
+        self.num_chunks = (num_items + chunk_size - 1) // chunk_size
+        self.ttl = ttl
+        self.worker = default_writer() if worker is None else worker
+        # chunk -> token of the leases held by this worker
+        self._tokens = {}
+        os.makedirs(root, exist_ok=True)
+
+    def _path(self, k, suffix):
+        return osp.join(self.root, f'chunk-{k:05d}.{suffix}')
+
+    def items(self, k):
+        return list(range(k * self.chunk_size, min((k + 1) * self.chunk_size, self.num_items)))
+
+    def is_done(self, k):
+        return osp.exists(self._path(k, 'done'))
+
+    def finished(self):
+        return all(self.is_done(k) for k in range(self.num_chunks))
+
+    def _create(self, pth, content=None):
+        try:
+            fd = os.open(pth, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            return False
+        with os.fdopen(fd, 'w') as fout:
+            fout.write(self.worker if content is None else content)
+        return True
+
+    @staticmethod
+    def _read(pth):
+        try:
+            with open(pth) as fin:
+                return fin.read()
+        except FileNotFoundError:
+            return None
+
+    def _take(self, lease, token):
+        """Remove ``lease`` if it holds ``token``. The lease is renamed away
+        first, so that it can be checked without racing with a worker
+        replacing it, and linked back if it turns out to be another one."""
+        taken = f'{lease}.taken-{uuid4().hex}'
+        try:
+            os.rename(lease, taken)
+        except FileNotFoundError:
+            return False
+        if self._read(taken) == token:
+            os.remove(taken)
+            return True
+        try:
+            os.link(taken, lease)
+        except FileExistsError:
+            pass
+        os.remove(taken)
+        return False
+
+    def _try_lease(self, k):
+        lease = self._path(k, 'lease')
+        token = f'{self.worker}-{uuid4().hex}'
+        if self._create(lease, token):
+            self._tokens[k] = token
+            return True
+        seen = self._read(lease)
+        try:
+            expired = time.time() - os.stat(lease).st_mtime > self.ttl
+        except FileNotFoundError:
+            expired = False
+        if seen is None or not expired:
+            return False
+        # only the worker which takes away the very lease it found expired steals it
+        if not self._take(lease, seen) or not self._create(lease, token):
+            return False
+        self._tokens[k] = token
+        return True
+
+    def claim(self):
+        """Claim an unfinished chunk. Returns its id, or None if every chunk
+        is either done or leased by a live worker."""
+        for k in range(self.num_chunks):
+            if not self.is_done(k) and self._try_lease(k):
+                if self.is_done(k):
+                    self.release(k)
+                    continue
+                return k
+        return None
+
+    def owns(self, k):
+        token = self._tokens.get(k)
+        return token is not None and self._read(self._path(k, 'lease')) == token
+
+    def release(self, k):
+        """Drop the lease of chunk ``k``, unless another worker took it over."""
+        token = self._tokens.pop(k, None)
+        if token is not None:
+            self._take(self._path(k, 'lease'), token)
+
+    def complete(self, k):
+        self._create(self._path(k, 'done'))
+        self.release(k)
+
+    @contextmanager
+    def hold(self, k):
+        """Heartbeat the lease of chunk ``k`` while the block runs."""
+        stop = threading.Event()
+
+        def beat():
+            while not stop.wait(self.ttl / 4):
+                # a lease stolen while this worker stalled is left to its new owner
+                if not self.owns(k):
+                    continue
+                try:
+                    os.utime(self._path(k, 'lease'))
+                except FileNotFoundError:
+                    pass
+
+        thread = threading.Thread(target=beat, daemon=True)
+        thread.start()
+        try:
+            yield k
+        finally:
+            stop.set()
+            thread.join()
+
+    def chunks(self, poll=5):
+        """Yield chunk ids claimed by this worker until all chunks are done.
+        When nothing can be claimed but some leases are alive, wait for them
+        to finish or expire."""
+        while True:
+            k = self.claim()
+            if k is None:
+                if self.finished():
+                    return
+                time.sleep(poll)
+                continue
+            with self.hold(k):
+                yield k
+            self.complete(k)
+
+    def claim_merge(self):
+        """True for exactly one worker once all chunks are done, and never
+        again once the merge has succeeded. Call :meth:`merged` when the
+        merge is over (or has failed)."""
+        done = osp.join(self.root, 'merge.done')
+        if osp.exists(done) or not self.finished() or not self._create(osp.join(self.root, 'merge')):
+            return False
+        # the merge may have succeeded between the check and the claim
+        if osp.exists(done):
+            os.remove(osp.join(self.root, 'merge'))
+            return False
+        return True
+
+    def merged(self, ok=True):
+        """Mark the merge as done (``merge.done``, which stays), or release
+        the claim after a failed merge so that another worker merges."""
+        pth = osp.join(self.root, 'merge')
+        if ok:
+            os.replace(pth, pth + '.done')
+        else:
+            try:
+                os.remove(pth)
+            except FileNotFoundError:
+                pass
@@ -0,0 +1,346 @@
+import argparse
+import contextlib
+import gc
+import io
+import json
+import os
+import os.path as osp
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from ada_leval.synthetic import all_datasets, generate
+
+BASELINE_FILE = 'benchmark_baseline.json'
+STAGES = []
+RUN_PY = osp.join(osp.dirname(osp.abspath(__file__)), 'run.py')
+
+# entry points that must start fast: the CLI, and what the pool workers and the scorers import
+IMPORT_TARGETS = {
+    'run.py --help': [RUN_PY, '--help'],
+    'ada_leval.smp': ['-c', 'import ada_leval.smp'],
+    'ada_leval.dataset': ['-c', 'import ada_leval.dataset'],
+    'ada_leval.scoring': ['-c', 'import ada_leval.scoring'],
+}
+# dependencies only loaded on first use, none of the targets may import them
+HEAVY_MODULES = ['matplotlib', 'seaborn', 'pandas', 'PIL', 'requests', 'tiktoken', 'tabulate', 'tqdm']
+
+
+def stage(func):
+    STAGES.append(func)
+    return func
+
+
+def _read_status(field):
+    # in MiB, from /proc/self/status (linux only)
+    with open('/proc/self/status') as fin:
+        for line in fin:
+            if line.startswith(field + ':'):
+                return int(line.split()[1]) / 1024
+    raise KeyError(field)
+
+
+def reset_peak_rss():
+    """Reset the peak RSS of this process, so that it can be measured per
+    stage. Returns False if the kernel does not allow it."""
+    try:
+        with open('/proc/self/clear_refs', 'w') as fout:
+            fout.write('5')
+        return True
+    except OSError:
+        return False
+
+
+def peak_rss():
+    try:
+        return _read_status('VmHWM')
+    except (OSError, KeyError):
+        # the peak of the whole process so far, in KiB on linux
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def measure(func, alloc=True):
+    """Run ``func`` and return its result and the wall time, the peak RSS and
+    (from a second, traced run) the peak of python allocations."""
+    gc.collect()
+    reset_peak_rss()
+    with contextlib.redirect_stdout(io.StringIO()):
+        t = time.perf_counter()
+        res = func()
+        wall = time.perf_counter() - t
+    stats = dict(wall=wall, peak_rss_mb=peak_rss())
+    if alloc:
+        gc.collect()
+        tracemalloc.start()
+        with contextlib.redirect_stdout(io.StringIO()):
+            func()
+        stats['alloc_peak_mb'] = tracemalloc.get_traced_memory()[1] / 2 ** 20
+        tracemalloc.stop()
+    return res, stats
+
+
+def _predictions(dataset):
+    # half of the predictions are right
+    preds = []
+    for i, line in enumerate(dataset.data):
+        if 'all_answers' in line:
+            preds.append(f"Answer: {line['answer'] if i % 2 else 'A1'}")
+        else:
+            preds.append(f"Answer: {line['answer'] if i % 2 else [1, 2, 3, 4]}")
+    return preds
+
+
+class Context:
+
+    def __init__(self, dname, mode, workdir):
+        self.dname = dname
+        self.mode = mode
+        self.workdir = workdir
+        self.dataset = None
+        self.meta = None
+
+    def tmp(self, name):
+        return osp.join(self.workdir, 'results', f'{time.perf_counter_ns()}_{name}')
+
+
+@stage
+def load_json(ctx):
+    from ada_leval.dataset import build_dataset
+    ctx.dataset = build_dataset(ctx.dname, mode=ctx.mode)
+
+
+@stage
+def index(ctx):
+    from ada_leval.indexed import convert
+    convert(ctx.dataset.data_file)
+
+
+@stage
+def load_indexed(ctx):
+    from ada_leval.dataset import build_dataset
+    build_dataset(ctx.dname, mode=ctx.mode)
+
+
+@stage
+def build_prompt(ctx):
+    for i in range(len(ctx.dataset)):
+        ctx.dataset.build_prompt(i)
+
+
+@stage
+def get_meta(ctx):
+    ctx.meta = ctx.dataset.get_meta()
+    ctx.meta['prediction'] = _predictions(ctx.dataset)
+
+
+def _completions(dataset):
+    # verbose completions discussing several answers, the worst case of the designation search
+    preds = []
+    for i, line in enumerate(dataset.data):
+        n = len(line['all_answers'])
+        others = ', '.join(f'A{(i * 7 + k) % n + 1}' for k in range(8))
+        preds.append(f"After comparing {others} and {n} answers in total, the {i % 10}th point of "
+                     f"{line['answer']} is the most complete. " * 4 + f"Answer: {line['answer']}")
+    return preds
+
+
+@stage
+def extract(ctx):
+    # BestAnswer designations of long completions, e.g. at the 128k setting with hundreds of answers
+    from ada_leval.dataset import StackSelect
+    if not isinstance(ctx.dataset, StackSelect):
+        return
+    num_choices = [len(x['all_answers']) for x in ctx.dataset.data]
+    StackSelect.extract_batch(_completions(ctx.dataset), num_choices)
+
+
+@stage
+def evaluate(ctx):
+    ctx.dataset.evaluate(ctx.meta.copy())
+
+
+@stage
+def evaluate_cached(ctx):
+    from ada_leval.scoring import ScoreCache
+    pth = osp.join(ctx.workdir, 'results', f'{ctx.dname}.score.pkl')
+    if not osp.exists(pth):
+        cache = ScoreCache(pth)
+        ctx.dataset.evaluate(ctx.meta.copy(), cache=cache)
+        cache.save()
+    ctx.dataset.evaluate(ctx.meta.copy(), cache=ScoreCache(pth))
+
+
+@stage
+def dump_pkl(ctx):
+    from ada_leval.smp import dump
+    dump(ctx.meta, ctx.tmp('meta.pkl'))
+
+
+@stage
+def dump_xlsx(ctx):
+    from ada_leval.smp import dump
+    try:
+        import openpyxl  # noqa: F401
+    except ImportError:
+        return
+    dump(ctx.meta, ctx.tmp('meta.xlsx'))
+
+
+@stage
+def dump_parquet(ctx):
+    from ada_leval.smp import dump
+    dump(ctx.meta, ctx.tmp('meta.parquet'))
+
+
+@stage
+def result_store(ctx):
+    from ada_leval.store import ResultStore
+    with ResultStore(ctx.tmp('store.pkl')) as store:
+        for k, pred in zip(ctx.meta['index'], ctx.meta['prediction']):
+            store.put(k, pred)
+    store.compact()
+
+
+def _echo(x):
+    return x
+
+
+@stage
+def track_progress(ctx):
+    from ada_leval.util import track_progress_rich
+    preds = list(ctx.meta['prediction'])
+    track_progress_rich(_echo, preds, nproc=1, save=ctx.tmp('track.pkl'), keys=list(ctx.meta['index']))
+
+
+def run(datasets, mode='less', num=None, alloc=True, keep=None):
+    """Benchmark every stage on synthetic data. Returns
+    ``{'{dname}/{stage}': stats}``."""
+    from ada_leval.synthetic import num_records
+    # import everything up front, so that no stage is charged for imports
+    import ada_leval.dataset, ada_leval.indexed, ada_leval.scoring, ada_leval.util  # noqa: F401, E401
+    # including the dependencies ada_leval.smp imports on first use
+    import numpy, pandas  # noqa: F401, E401
+    try:
+        import openpyxl, pyarrow.parquet  # noqa: F401, E401
+    except ImportError:
+        pass
+    workdir = tempfile.mkdtemp(prefix='ada_leval_bench_') if keep is None else keep
+    cwd = os.getcwd()
+    res = {}
+    try:
+        os.chdir(workdir)
+        os.makedirs('results', exist_ok=True)
+        for dname in datasets:
+            # generate the records read by the mode, the datasets load a prefix of the file
+            generate(dname, 'data', num=num_records(dname, mode) if num is None else num)
+            ctx = Context(dname, mode, workdir)
+            for func in STAGES:
+                _, stats = measure(lambda: func(ctx), alloc=alloc)
+                res[f'{dname}/{func.__name__}'] = stats
+                print(f"{dname:<18} {func.__name__:<16} {stats['wall']:9.4f}s {stats['peak_rss_mb']:9.1f} MiB"
+                      + (f" {stats['alloc_peak_mb']:9.1f} MiB allocated" if alloc else ''), flush=True)
+    finally:
+        os.chdir(cwd)
+        if keep is None:
+            shutil.rmtree(workdir, ignore_errors=True)
+    return res
+
+
+def import_profile(argv):
+    """Run ``python -X importtime *argv`` and return the import time (in
+    seconds, the interpreter start-up excluded) and the imported modules."""
+    proc = subprocess.run([sys.executable, '-X', 'importtime', *argv], stdout=subprocess.DEVNULL,
+                          stderr=subprocess.PIPE, text=True, cwd=osp.dirname(RUN_PY))
+    total, modules = 0, set()
+    for line in proc.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        modules.add(name.strip())
+        # top-level imports are not indented, the ones of ``site`` run on every start-up
+        if not name[1:].startswith(' ') and name.strip() != 'site':
+            total += int(cumulative) / 1e6
+    return total, modules
+
+
+def check_imports(budget, repeat=3):
+    """Check that each of ``IMPORT_TARGETS`` imports no heavy module and
+    takes at most ``budget`` seconds (best of ``repeat``). Returns the
+    problems found."""
+    problems = []
+    for name, argv in IMPORT_TARGETS.items():
+        runs = [import_profile(argv) for _ in range(repeat)]
+        best = min(t for t, _ in runs)
+        heavy = sorted(m for m in HEAVY_MODULES if m in runs[0][1])
+        print(f'{name:<18} imports in {best:.3f}s' + (f", loads {', '.join(heavy)}" if heavy else ''), flush=True)
+        if len(heavy):
+            problems.append(f"{name} imports {', '.join(heavy)}")
+        if best > budget:
+            problems.append(f'{name} imports in {best:.3f}s, over the budget of {budget:.3f}s')
+    return problems
+
+
+def compare(res, baseline, tolerance=0.25, floor=0.05):
+    """Stages slower than the baseline by more than ``tolerance`` (and by at
+    least ``floor`` seconds, to ignore noise on tiny stages)."""
+    regressions = []
+    for key, stats in res.items():
+        if key not in baseline:
+            continue
+        base = baseline[key]['wall']
+        if stats['wall'] > base * (1 + tolerance) and stats['wall'] - base > floor:
+            regressions.append((key, base, stats['wall']))
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Offline micro-benchmarks of the Ada-LEval harness on synthetic data. ')
+    parser.add_argument('--data', type=str, nargs='+', default=all_datasets())
+    parser.add_argument('--mode', type=str, default='less', choices=['normal', 'less'])
+    parser.add_argument('--num', type=int, default=None, help='records per dataset, defaults to what the mode reads')
+    parser.add_argument('--no-alloc', action='store_true', help='skip the tracemalloc run of each stage')
+    parser.add_argument('--baseline', type=str, default=BASELINE_FILE)
+    parser.add_argument('--save-baseline', action='store_true')
+    parser.add_argument('--tolerance', type=float, default=0.25)
+    parser.add_argument('--output', type=str, default=None, help='also write the results to this json file')
+    parser.add_argument('--keep', type=str, default=None, help='work in this directory and keep it')
+    parser.add_argument('--import-budget', type=float, default=0.5, help='seconds allowed for importing each entry point')
+    parser.add_argument('--imports-only', action='store_true', help='only check the import times')
+    args = parser.parse_args()
+
+    problems = check_imports(args.import_budget)
+    for problem in problems:
+        print(f'IMPORT {problem}')
+    if args.imports_only:
+        sys.exit(1 if len(problems) else 0)
+
+    baseline_file = osp.abspath(args.baseline)
+    res = run(args.data, args.mode, args.num, alloc=not args.no_alloc, keep=args.keep)
+    if args.output is not None:
+        with open(args.output, 'w') as fout:
+            json.dump(res, fout, indent=2)
+
+    if args.save_baseline:
+        baseline = {}
+        if osp.exists(baseline_file):
+            with open(baseline_file) as fin:
+                baseline = json.load(fin)
+        baseline.update(res)
+        with open(baseline_file, 'w') as fout:
+            json.dump(baseline, fout, indent=2)
+        print(f'Baseline saved to {baseline_file}')
+    elif osp.exists(baseline_file):
+        with open(baseline_file) as fin:
+            baseline = json.load(fin)
+        regressions = compare(res, baseline, args.tolerance)
+        for key, base, wall in regressions:
+            print(f'REGRESSION {key}: {base:.4f}s -> {wall:.4f}s ({wall / base:.2f}x)')
+        if len(regressions):
+            sys.exit(1)
+        print(f'No regression against {baseline_file}')
+    if len(problems):
+        sys.exit(1)
@@ -0,0 +1,117 @@
+import argparse
+import json
+import os
+import os.path as osp
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+import requests
+
+from ada_leval.mockserver import serve
+from ada_leval.synthetic import generate, num_records
+
+RUN_PY = osp.join(osp.dirname(osp.abspath(__file__)), 'run.py')
+
+
+def load_events(pth, kind):
+    res = []
+    if not osp.exists(pth):
+        return res
+    with open(pth) as fin:
+        for line in fin:
+            event = json.loads(line)
+            if event.get('kind') == kind:
+                res.append(event)
+    return res
+
+
+def run_once(workdir, dname, model, nproc, api_base, extra=(), entry=RUN_PY):
+    """Run ``run.py`` on ``dname`` from scratch in ``workdir``. Returns the
+    wall time and the request / checkpoint telemetry of the run."""
+    for name in ['results', 'result.json', 'telemetry.jsonl']:
+        pth = osp.join(workdir, name)
+        if osp.isdir(pth):
+            shutil.rmtree(pth)
+        elif osp.exists(pth):
+            os.remove(pth)
+    env = dict(os.environ, OPENAI_API_BASE=api_base)
+    cmd = [sys.executable, entry, '--data', dname, '--model', model, '--mode', 'infer', '--nproc', str(nproc),
+           '--telemetry', 'telemetry.jsonl', *extra]
+    t = time.time()
+    proc = subprocess.run(cmd, cwd=workdir, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+    wall = time.time() - t
+    if proc.returncode != 0:
+        raise RuntimeError(f'{" ".join(cmd)} failed:\n{proc.stderr[-2000:]}')
+    tel = osp.join(workdir, 'telemetry.jsonl')
+    return wall, load_events(tel, 'request'), load_events(tel, 'checkpoint')
+
+
+def summarize(nproc, wall, reqs, ckpts, server):
+    ok = [e for e in reqs if e.get('ok')]
+    latency = np.array([e['end'] - e['start'] for e in ok]) if len(ok) else np.zeros(1)
+    span = (max(e['end'] for e in ok) - min(e.get('enqueue', e['start']) for e in ok)) if len(ok) else wall
+    ckpt = sum(e['seconds'] for e in ckpts)
+    p50, p95, p99 = np.percentile(latency, [50, 95, 99])
+    return dict(
+        nproc=nproc,
+        requests=len(ok),
+        requests_per_s=len(ok) / max(span, 1e-9),
+        latency_p50=p50,
+        latency_p95=p95,
+        latency_p99=p99,
+        attempts=sum(e['attempts'] for e in reqs),
+        status_429=server['status_429'],
+        status_5xx=server['status_5xx'],
+        checkpoint_s=ckpt,
+        checkpoint_pct=100 * ckpt / max(wall, 1e-9),
+        wall=wall)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Load test run.py against the local mock server at several --nproc values. ')
+    parser.add_argument('--data', type=str, default='stackselect_4k')
+    parser.add_argument('--model', type=str, default='gpt-4-0125')
+    parser.add_argument('--nproc', type=int, nargs='+', default=[1, 4, 16, 64])
+    parser.add_argument('--num', type=int, default=None, help='samples, defaults to what the api mode reads')
+    parser.add_argument('--port', type=int, default=0, help='port of the mock server, 0 picks a free one')
+    parser.add_argument('--latency', type=str, default='lognormal:0.5,0.5')
+    parser.add_argument('--per-token', type=float, default=1e-5)
+    parser.add_argument('--rate-429', type=float, default=0.0)
+    parser.add_argument('--rate-5xx', type=float, default=0.0)
+    parser.add_argument('--retry-after', type=float, default=1.0)
+    parser.add_argument('--rpm', type=int, default=0)
+    parser.add_argument('--entry', type=str, default=RUN_PY, help='the script to load test')
+    parser.add_argument('--output', type=str, default=None, help='also write the results to this json file')
+    args, extra = parser.parse_known_args()
+
+    server = serve(port=args.port, background=True, latency=args.latency, per_token=args.per_token,
+                   rate_429=args.rate_429, rate_5xx=args.rate_5xx, retry_after=args.retry_after, rpm=args.rpm)
+    host, port = server.server_address
+    api_base = f'http://{host}:{port}/v1/chat/completions'
+    workdir = tempfile.mkdtemp(prefix='ada_leval_loadtest_')
+    rows = []
+    try:
+        # API models evaluate the 'less' subset of each dataset
+        generate(args.data, osp.join(workdir, 'data'), num=num_records(args.data, 'less') if args.num is None else args.num)
+        for nproc in args.nproc:
+            before = requests.get(f'http://{host}:{port}/stats').json()
+            wall, reqs, ckpts = run_once(workdir, args.data, args.model, nproc, api_base, extra, args.entry)
+            after = requests.get(f'http://{host}:{port}/stats').json()
+            server_stats = {k: after[k] - before[k] for k in ['status_429', 'status_5xx']}
+            rows.append(summarize(nproc, wall, reqs, ckpts, server_stats))
+            r = rows[-1]
+            print(f"nproc {nproc:>4}: {r['requests_per_s']:7.2f} req/s, latency p50/p95/p99 "
+                  f"{r['latency_p50']:.2f}/{r['latency_p95']:.2f}/{r['latency_p99']:.2f}s, "
+                  f"{r['attempts'] - r['requests']} extra attempts ({r['status_429']} x 429, {r['status_5xx']} x 5xx), "
+                  f"checkpointing {r['checkpoint_s']:.2f}s ({r['checkpoint_pct']:.2f}% of {r['wall']:.1f}s)", flush=True)
+    finally:
+        server.shutdown()
+        shutil.rmtree(workdir, ignore_errors=True)
+    if args.output is not None:
+        with open(args.output, 'w') as fout:
+            json.dump(rows, fout, indent=2)
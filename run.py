@@ -1,29 +1,92 @@
+import re
 from ada_leval.smp import *
 from ada_leval.util import *
 from ada_leval.api import OpenAIWrapper
-from ada_leval.dataset import StackSelect, TextSort
+from ada_leval.store import ResultStore
+from ada_leval.ratelimit import RateLimiter
+from ada_leval.cache import ResponseCache
+from ada_leval.resultdb import ResultDB
+from ada_leval.telemetry import Telemetry
+from ada_leval.pipeline import run_pipeline
+from ada_leval.scheduler import run_datasets
+from ada_leval.sequential import SequentialStop
+from ada_leval.dataset import build_dataset
+from ada_leval.scoring import ScoreCache, score_cache_file
+from ada_leval.workqueue import WorkQueue
+from ada_leval.prefix import prefix_partition
 
+# rebuilt from the results database after each dataset
 RESULT_FILE = 'result.json'
-if not osp.exists(RESULT_FILE):
-    dump({}, RESULT_FILE)
 
 settings = ['1k', '2k', '4k', '8k', '16k', '32k', '64k', '128k']
 datasets = [f'stackselect_{k}' for k in settings + ['6k', '12k']] + [f'textsort_{k}' for k in settings]
 
+
+def dataset_name(name):
+    # the released settings, or any built by ada_leval.generator (e.g. textsort_256k, stackselect_1m)
+    if name not in datasets and re.fullmatch(r'(stackselect|textsort)_\d+[km]', name) is None:
+        raise argparse.ArgumentTypeError(f'invalid dataset {name}, expected e.g. {datasets[0]} or textsort_256k')
+    return name
+
 def parse_args():
     parser = argparse.ArgumentParser()
-    parser.add_argument('--data', type=str, nargs='+', required=True, choices=datasets)
+    parser.add_argument('--data', type=dataset_name, nargs='+', required=True)
     parser.add_argument('--model', type=str, required=True, choices=['internlm2-7b', 'internlm2-20b', 'gpt-4-0125'])
     parser.add_argument('--mode', type=str, default='all', choices=['infer', 'all'])
     parser.add_argument('--nproc', type=int, default=4)
+    # if > 0, API requests are issued from one asyncio event loop instead of a process pool
+    parser.add_argument('--concurrency', type=int, default=0)
+    # requests / tokens per minute of the API endpoint, 0 means learned from the rate-limit headers
+    parser.add_argument('--rpm', type=int, default=0)
+    parser.add_argument('--tpm', type=int, default=0)
+    # how samples are split across ranks: strided, balanced by prompt tokens (longest first),
+    # or whole groups of prompts sharing a prefix (dispatched back to back) balanced by prompt tokens
+    parser.add_argument('--assign', type=str, default='stride', choices=['stride', 'balanced', 'prefix'])
+    # a sqlite file caching API answers by request content, shared by runs
+    parser.add_argument('--response-cache', type=str, default=None)
+    parser.add_argument('--cache-mode', type=str, default='rw', choices=['rw', 'r', 'w'])
+    parser.add_argument('--cache-size', type=int, default=1024, help='cap of the response cache in MiB')
+    # a jsonl file receiving per-request telemetry, summarized at the end of each dataset
+    parser.add_argument('--telemetry', type=str, default=None)
+    # API models: stream the completions and record the time to first token
+    parser.add_argument('--stream', action='store_true')
+    # with --stream, stop reading once the answer is complete. This changes the metric: the prediction is cut after
+    # the first answer, while the scorers read the whole completion
+    parser.add_argument('--early-close', action='store_true')
+    # 'dataset' uses the max tokens / stop words of each dataset instead of the model defaults. This changes the
+    # metric as well, the completions are cut at the first blank line or the token budget
+    parser.add_argument('--gen-config', type=str, default='default', choices=['default', 'dataset'])
+    # enable the automatic prefix caching of the lmdeploy engine
+    parser.add_argument('--prefix-cache', action='store_true')
+    # a directory shared by all workers (e.g. on NFS), workers on any host claim chunks of samples from it
+    parser.add_argument('--queue', type=str, default=None)
+    parser.add_argument('--chunk-size', type=int, default=64)
+    # if > 0, local-model prompts are batched by length, with at most this many prompt tokens per batch
+    parser.add_argument('--token-budget', type=int, default=0)
+    # API models: 'global' loads the datasets in the background and runs all of them
+    # on one shared pool / event loop, longest prompts first
+    parser.add_argument('--schedule', type=str, default='sequential', choices=['sequential', 'global'])
+    # stop evaluating a dataset (samples taken in a random order) once its accuracy is known
+    # within --ci-width points, or is indistinguishable from random guessing
+    parser.add_argument('--early-stop', action='store_true')
+    parser.add_argument('--ci-width', type=float, default=10.0)
+    parser.add_argument('--ci-margin', type=float, default=5.0, help='points above random guessing still deemed random')
+    parser.add_argument('--confidence', type=float, default=0.95)
+    parser.add_argument('--min-samples', type=int, default=30)
+    # format of results/{model}_{dataset}.*, xlsx (with the question text) is slower and larger
+    parser.add_argument('--output-format', type=str, default='parquet', choices=['parquet', 'xlsx'])
+    # a sqlite file recording the accuracy, samples, time and tokens of every run, shared by concurrent runs
+    parser.add_argument('--result-db', type=str, default='result.sqlite')
     args = parser.parse_args()
     return args
 
-def build_model(m, setting=None):
+def build_model(m, setting=None, prefix_cache=False):
     if 'internlm2' in m:
         session_len = 160000
         from lmdeploy import pipeline, TurbomindEngineConfig
-        backend_config = TurbomindEngineConfig(rope_scaling_factor=2.0, session_len=session_len)
+        # lmdeploy versions before prefix caching have no such field, it is only passed when asked for
+        extra = dict(enable_prefix_caching=True) if prefix_cache else {}
+        backend_config = TurbomindEngineConfig(rope_scaling_factor=2.0, session_len=session_len, **extra)
     
     if m == 'gpt-4-0125':
         model = OpenAIWrapper('gpt-4-0125-preview')
@@ -33,11 +96,85 @@ def build_model(m, setting=None):
         model = pipeline('internlm/internlm2-chat-20b', backend_config=backend_config)
     return model
 
-import tiktoken
-ENC = tiktoken.encoding_for_model('gpt-4')
+def generation_kwargs(model, dataset, args):
+    cfg = dataset.generation_config()
+    if getattr(model, 'is_api', False):
+        kwargs = {}
+        if args.gen_config == 'dataset':
+            kwargs['max_tokens'] = cfg['max_tokens']
+            if cfg['stop'] is not None:
+                kwargs['stop'] = cfg['stop']
+        if args.stream and args.early_close:
+            kwargs['answer_complete'] = cfg['answer_complete']
+        return kwargs
+    if args.gen_config == 'dataset':
+        from lmdeploy import GenerationConfig
+        return dict(gen_config=GenerationConfig(max_new_tokens=cfg['max_tokens'], stop_words=cfg['stop']))
+    return {}
+
+def make_stop(args):
+    if not args.early_stop:
+        return None
+    return SequentialStop(width=args.ci_width, margin=args.ci_margin, min_samples=args.min_samples,
+                          confidence=args.confidence)
+
+def load_done(out_file, rank=0, world_size=1):
+    # with several ranks, rank 0 reads the finished samples before any rank writes and sends them to the others,
+    # so that all the ranks shard the same pending samples
+    if world_size == 1:
+        return set(ResultStore(out_file).load())
+    import torch.distributed as dist
+    done = [set(ResultStore(out_file).load()) if rank == 0 else None]
+    dist.broadcast_object_list(done, src=0)
+    return done[0]
+
+def infer(model, dataset, out_file, args, order=None, rank=0, world_size=1, stop=None, done=None, description=None):
+    gen_kwargs = generation_kwargs(model, dataset, args)
+    if getattr(model, 'is_api', False):
+        return run_pipeline(dataset, model, out_file, nproc=args.nproc, concurrency=args.concurrency,
+                            order=order, telemetry=args.telemetry_sink, gen_kwargs=gen_kwargs,
+                            stop=stop, done=done, description=description)
+    import torch
+    with torch.no_grad():
+        return run_pipeline(dataset, model, out_file, rank=rank, world_size=world_size,
+                            order=order, token_budget=args.token_budget, telemetry=args.telemetry_sink,
+                            gen_kwargs=gen_kwargs, stop=stop, done=done, description=description)
+
+def finalize(model_name, dname, dataset, out_file, args, stop=None, seconds=None):
+    res = ResultStore(out_file).compact()
+    meta = dataset.get_meta(with_text=args.output_format == 'xlsx')
+    if stop is not None:
+        # only the samples evaluated before stopping
+        meta = meta[meta['index'].isin(res)].reset_index(drop=True)
+    meta['prediction'] = [res[k] for k in meta['index']]
+    dump(meta, f'results/{model_name}_{dname}.{args.output_format}')
 
-def get_token_length(prompt):
-    return len(ENC.encode(prompt))
+    if args.mode == 'all':
+        acc = dataset.evaluate(meta, cache=ScoreCache(score_cache_file(out_file)))
+        usage = {} if args.telemetry_sink is None else args.telemetry_sink.usage(osp.basename(out_file)[:-len('.pkl')])
+        extra = {} if stop is None else dict(sequential=stop.summary(len(dataset)))
+        db = ResultDB(args.result_db)
+        db.record(model_name, dname, acc, samples=len(meta), total=len(dataset), seconds=seconds, **usage, **extra)
+        db.export_json(RESULT_FILE)
+
+def run_global(model, model_name, args):
+    response_cache = getattr(model, 'response_cache', None)
+    cache_stats = response_cache.stats() if response_cache is not None else None
+
+    def load_job(dname):
+        dataset = build_dataset(dname, mode='less')
+        return dataset, f'results/{model_name}_{dname}.pkl', generation_kwargs(model, dataset, args)
+
+    def on_done(job):
+        print(f'{job.name} Running Accuracy: {job.score}')
+        finalize(model_name, job.name, job.dataset, job.out_file, args, stop=job.stop, seconds=job.seconds)
+
+    t = time.time()
+    run_datasets(args.data, load_job, model, nproc=args.nproc, concurrency=args.concurrency,
+                 telemetry=args.telemetry_sink, on_done=on_done, make_stop=lambda: make_stop(args))
+    print(f'{len(args.data)} datasets done in {time.time() - t:.1f}s')
+    if cache_stats is not None:
+        print(ResponseCache.report(cache_stats, response_cache.stats()))
 
 def main():
     rank, world_size = get_rank_and_world_size()
@@ -52,71 +189,100 @@ def main():
 
     args = parse_args()
     model_name = args.model
-    model = build_model(args.model)
+    model = build_model(args.model, prefix_cache=args.prefix_cache)
+    args.telemetry_sink = None if args.telemetry is None else Telemetry(args.telemetry)
+    if getattr(model, 'is_api', False):
+        import tempfile
+        limiter_file = osp.join(tempfile.gettempdir(), f'ada_leval_{model_name}_{os.getpid()}.ratelimit')
+        model.rate_limiter = RateLimiter(
+            limiter_file, rpm=args.rpm, tpm=args.tpm, max_concurrency=max(args.concurrency, args.nproc))
+        if args.response_cache is not None:
+            model.response_cache = ResponseCache(
+                args.response_cache, mode=args.cache_mode, max_bytes=args.cache_size << 20)
+        model.telemetry = args.telemetry_sink
+        model.stream = args.stream
+    assert not args.early_stop or (args.queue is None and world_size == 1), \
+        '--early-stop needs a single process, without --queue'
+    if args.schedule == 'global':
+        assert getattr(model, 'is_api', False) and args.queue is None, \
+            '--schedule global is for API models, without --queue'
+        run_global(model, model_name, args)
+        model.rate_limiter.remove()
+        return
     for dname in args.data:
-        d, setting = dname.split('_')
         dataset_mode = 'less' if getattr(model, 'is_api', False) else 'normal'
+        dataset = build_dataset(dname, mode=dataset_mode)
 
-        if d == 'stackselect':
-            dataset = StackSelect(setting=setting, mode=dataset_mode)
-        elif d == 'textsort':
-            dataset = TextSort(setting=setting, mode=dataset_mode)
-
-        lt = len(dataset)
-        prompts = [dataset.build_prompt(i) for i in range(lt)]
-        meta = dataset.get_meta()
-        indices = list(meta['index'])
-        
         out_file = f'results/{model_name}_{dname}.pkl'
-        res = {} if not osp.exists(out_file) else load(out_file)
-        tups = [(i, p) for i, p in zip(indices, prompts) if i not in res]
-        
-        if len(tups):
-            if getattr(model, 'is_api', False):
-                res = track_progress_rich(
-                    model.generate, 
-                    [x[1] for x in tups], 
-                    nproc=args.nproc, 
-                    chunksize=args.nproc, 
-                    save=out_file, 
-                    keys=[x[0] for x in tups])
-            else:
-                sub_tups = tups[rank::world_size]
-                sub_out_file = f'results/{model_name}_{dname}_{rank}.pkl'
-                sub_res = {}
-                import torch
-                with torch.no_grad():
-                    for t in tqdm(sub_tups):
-                        index, prompt = t 
-                        sub_res[index] = model(prompt).text
-                        dump(sub_res, sub_out_file)
+        score, merge = None, rank == 0
+        stop = make_stop(args)
+        t = time.time()
+        response_cache = getattr(model, 'response_cache', None)
+        cache_stats = response_cache.stats() if response_cache is not None else None
+        if args.queue is not None:
+            # every worker, on any host, claims chunks of the dataset from the shared queue directory
+            wq = WorkQueue(osp.join(args.queue, f'{model_name}_{dname}'), len(dataset), chunk_size=args.chunk_size)
+            for k in wq.chunks():
+                score = infer(model, dataset, out_file, args, order=wq.items(k),
+                              description=f'{dname} [{k + 1}/{wq.num_chunks}]')
+            merge = wq.claim_merge()
+        elif stop is not None:
+            # a random but reproducible order, so that the samples evaluated before stopping are unbiased
+            order = list(range(len(dataset)))
+            rd.Random(dname).shuffle(order)
+            score = infer(model, dataset, out_file, args, order=order, stop=stop, description=dname)
+        elif args.assign != 'stride':
+            # rank 0 partitions the pending samples before any rank writes and sends the partition to the others
+            plan = [None]
+            if rank == 0:
+                done = ResultStore(out_file).load()
+                pending = [i for i in range(len(dataset)) if dataset.data[i]['index'] not in done]
+                # tiktoken counts are used as a proxy of the prefill cost
+                lens = dataset.token_lens()
+                if args.assign == 'balanced':
+                    parts, loads = balanced_partition([lens[i] for i in pending], world_size)
+                    parts = [[pending[i] for i in p] for p in parts]
+                else:
+                    parts = prefix_partition(dataset, pending, lens, world_size)
+                    loads = [sum(lens[i] for i in p) for p in parts]
+                plan = [(parts, loads)]
+            if world_size > 1:
+                dist.broadcast_object_list(plan, src=0)
+            parts, loads = plan[0]
+            t = time.time()
+            score = infer(model, dataset, out_file, args, order=parts[rank],
+                          rank=rank, world_size=world_size, description=dname)
+            if world_size > 1:
+                elapsed = [None] * world_size
+                dist.all_gather_object(elapsed, time.time() - t)
+                if rank == 0:
+                    print(report_makespan(loads, elapsed))
+        else:
+            done = load_done(out_file, rank, world_size)
+            score = infer(model, dataset, out_file, args, rank=rank, world_size=world_size, done=done,
+                          description=dname)
+        if score is not None:
+            print(f'{dname} Running Accuracy: {score}')
+        if cache_stats is not None:
+            print(ResponseCache.report(cache_stats, response_cache.stats()))
 
         if world_size > 1:
             dist.barrier()
 
-        if rank == 0:
-            res = {}
-            for i in range(world_size):
-                sub_out_file = f'results/{model_name}_{dname}_{i}.pkl'
-                if osp.exists(sub_out_file):
-                    res.update(load(sub_out_file))
-            if osp.exists(out_file):
-                res.update(load(out_file))
-            dump(res, out_file)
-
-            res = load(out_file)
-            meta['prediction'] = [res[k] for k in meta['index']]
-            dump(meta, f'results/{model_name}_{dname}.xlsx')
-
-            if args.mode == 'all':
-                results = load(RESULT_FILE)
-                acc = dataset.evaluate(meta)
-                results[f'{model_name}_{dname}'] = acc
-                dump(results, RESULT_FILE)
+        if merge:
+            ok = False
+            try:
+                finalize(model_name, dname, dataset, out_file, args, stop=stop, seconds=time.time() - t)
+                ok = True
+            finally:
+                if args.queue is not None:
+                    wq.merged(ok)
 
         if world_size > 1:
             dist.barrier()
-            os.system(f"rm {f'results/{model_name}_{dname}_{rank}.pkl'}")
+
+    if getattr(model, 'rate_limiter', None) is not None:
+        model.rate_limiter.remove()
 
 if __name__ == '__main__':
     main()
\ No newline at end of file
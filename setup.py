@@ -6,6 +6,7 @@ openai
 requests
 tqdm
 pandas>=1.5.3
+pyarrow
 tiktoken
 rich
 portalocker
@@ -36,6 +37,7 @@ def do_setup():
         long_description_content_type='text/markdown',
         cmdclass={},
         install_requires=get_install_requires(),
+        extras_require={'async': ['httpx[http2]'], 'xlsx': ['openpyxl']},
         setup_requires=[],
         python_requires='>=3.7.0',
         packages=find_packages(exclude=[
@@ -0,0 +1,31 @@
+import pickle
+from functools import partial
+from multiprocessing import Pool
+
+from ada_leval.cache import ResponseCache
+
+
+def _put(cache, k):
+    # as in pool_dispatch, the cache arrives pickled with every task
+    cache.put(f'key-{k}', 'x' * 1000)
+
+
+def test_eviction_across_pickled_copies(tmp_path):
+    cache = ResponseCache(str(tmp_path / 'cache.sqlite'), max_bytes=10000, check_every=4)
+    with Pool(2) as pool:
+        pool.map(partial(_put, cache), range(40), chunksize=1)
+    stats = cache.stats()
+    assert stats['write'] == 40 and stats['evict'] > 0
+    # evicted every 4 writes, at most 3 answers over the cap
+    assert stats['bytes'] <= 10000 + 3 * 1000
+
+
+def test_hits_and_misses(tmp_path):
+    cache = ResponseCache(str(tmp_path / 'cache.sqlite'))
+    assert cache.get('a') is None
+    cache.put('a', 'answer')
+    assert cache.get('a') == 'answer'
+    copy = pickle.loads(pickle.dumps(cache))
+    assert copy.get('a') == 'answer' and copy._conn() is cache._conn()
+    stats = cache.stats()
+    assert (stats['hit'], stats['miss'], stats['write']) == (2, 1, 1)
@@ -0,0 +1,76 @@
+import random as rd
+
+from ada_leval.dataset import StackSelect, extract_choice
+
+
+def reference_extract(prediction, num_choice):
+    # the search of StackSelect.evaluate before the single-pass engine
+    cands = [f'A{i}' for i in range(1, num_choice + 1)]
+    finds = [prediction.find(c) for c in cands]
+    if sum([x >= 0 for x in finds]) >= 1:
+        for i in range(num_choice - 1, -1, -1):
+            if finds[i] >= 0:
+                return cands[i]
+    cands = [str(i) for i in range(1, num_choice + 1)]
+    finds = [prediction.find(c) for c in cands]
+    if sum([x >= 0 for x in finds]) >= 1:
+        for i in range(num_choice - 1, -1, -1):
+            if finds[i] >= 0:
+                return 'A' + cands[i]
+    return '???'
+
+
+def random_prediction(rng):
+    # short texts dense in designations, digit runs and near misses
+    pieces = ['A', 'a', ' ', '\n', 'Answer: ', 'A0', '0', 'is', 'A1', '1', '10', '99', '100', '007', '\uff13', '\u0663']
+    pieces += [str(rng.randint(0, 2000)) for _ in range(3)]
+    return ''.join(rng.choice(pieces) for _ in range(rng.randint(0, 12)))
+
+
+def test_extract_parity():
+    rng = rd.Random(0)
+    for _ in range(30000):
+        pred = random_prediction(rng)
+        nc = rng.choice([1, 2, 5, 9, 10, 11, 99, 100, 101, rng.randint(1, 1000)])
+        assert extract_choice(pred, nc) == reference_extract(pred, nc), (pred, nc)
+
+
+def test_extract_examples():
+    assert extract_choice('Answer: A4', 10) == 'A4'
+    assert extract_choice('A12 is better than A3', 20) == 'A12'
+    # A12 is not a designation with 11 answers, but A1 is a prefix of it
+    assert extract_choice('A12 is better than A3', 11) == 'A3'
+    assert extract_choice('the 7th one', 10) == 'A7'
+    assert extract_choice('none', 10) == '???'
+    # only ascii digits are digits to str.find
+    for pred in ['Answer: A\uff13', 'Answer: A\u0663', '\uff13']:
+        assert extract_choice(pred, 4) == reference_extract(pred, 4) == '???'
+    assert extract_choice('A\uff131', 20) == reference_extract('A\uff131', 20) == 'A1'
+
+
+def test_extract_batch():
+    rng = rd.Random(1)
+    preds = [random_prediction(rng) for _ in range(2000)]
+    ncs = [rng.randint(1, 200) for _ in preds]
+    # repeated completions go through the memo of the batch
+    preds, ncs = preds + preds[:500], ncs + ncs[:500]
+    assert StackSelect.extract_batch(preds, ncs) == [reference_extract(p, nc) for p, nc in zip(preds, ncs)]
+
+
+def test_early_close_is_opt_in():
+    from argparse import Namespace
+
+    from ada_leval.dataset import stackselect_answer_complete
+    from run import generation_kwargs
+
+    text = 'Answer: A2\n\nA2 is more complete than A5, which misses the edge case.'
+    closed = next(text[:i] for i in range(len(text) + 1) if stackselect_answer_complete(text[:i]))
+    # the closed prefix and the full completion score differently
+    assert extract_choice(closed, 6) == 'A2' and extract_choice(text, 6) == 'A5'
+
+    model = Namespace(is_api=True)
+    ds = StackSelect.__new__(StackSelect)
+    args = Namespace(gen_config='default', stream=True, early_close=False)
+    assert generation_kwargs(model, ds, args) == {}
+    args.early_close = True
+    assert generation_kwargs(model, ds, args) == dict(answer_complete=stackselect_answer_complete)
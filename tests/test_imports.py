@@ -0,0 +1,33 @@
+import copy
+import pickle
+
+from ada_leval.smp import LazyImport
+
+from benchmark import HEAVY_MODULES, IMPORT_TARGETS, import_profile
+
+# seconds allowed for importing each entry point, as ``benchmark.py --import-budget``
+IMPORT_BUDGET = 0.5
+
+
+def test_entry_points_import_no_heavy_module():
+    for name, argv in IMPORT_TARGETS.items():
+        best, modules = None, set()
+        for _ in range(3):
+            t, modules = import_profile(argv)
+            best = t if best is None else min(best, t)
+        heavy = sorted(m for m in HEAVY_MODULES if m in modules)
+        assert not len(heavy), f"{name} imports {', '.join(heavy)}"
+        assert best <= IMPORT_BUDGET, f'{name} imports in {best:.3f}s'
+
+
+def test_lazy_import_passes_dunders_through():
+    json = LazyImport('json')
+    assert json.__name__ == 'json' and json.__version__
+    assert json.__doc__ is not None
+    assert json.dumps([1]) == '[1]'
+
+
+def test_lazy_import_pickle_and_copy():
+    lazy = LazyImport('json', 'dumps')
+    for other in [pickle.loads(pickle.dumps(lazy)), copy.copy(lazy), copy.deepcopy(lazy)]:
+        assert other([2]) == '[2]'
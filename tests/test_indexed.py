@@ -0,0 +1,34 @@
+import json
+import os
+
+from ada_leval.indexed import IndexedRecords, convert, load_records
+from ada_leval.segments import SegmentStore, build
+
+
+def _write(pth, records):
+    with open(pth, 'w', encoding='utf-8') as fin:
+        json.dump(records, fin)
+
+
+def test_indexed_records(tmp_path):
+    pth = str(tmp_path / 'textsort_1k.json')
+    records = [dict(answer=[1, 2, 3, 4], prompt=f'prompt {i}\n') for i in range(5)]
+    _write(pth, records)
+    convert(pth)
+    assert IndexedRecords.available(pth)
+    assert load_records(pth, 2) == records[:2] and IndexedRecords(pth)[-1] == records[-1]
+
+
+def test_stale_index_is_ignored(tmp_path):
+    pth = str(tmp_path / 'textsort_1k.json')
+    _write(pth, [dict(answer=[1, 2, 3, 4], prompt='old\n')])
+    convert(pth)
+    # the json is re-fetched, the index still holds the old records
+    _write(pth, [dict(answer=[4, 3, 2, 1], prompt='new\n')])
+    st = os.stat(pth)
+    os.utime(pth, ns=(st.st_atime_ns, st.st_mtime_ns + 1))
+    assert not IndexedRecords.available(pth) and IndexedRecords.available(pth, check_source=False)
+    assert load_records(pth)[0]['prompt'] == 'new\n'
+    # and a segment store built now holds the new prompts
+    build(pth)
+    assert SegmentStore(pth).prompt(0) == 'new\n'
@@ -0,0 +1,27 @@
+from ada_leval.resultdb import ResultDB
+
+
+def test_rescore_keeps_the_run_metadata(tmp_path):
+    db = ResultDB(str(tmp_path / 'result.sqlite'))
+    run = db.record('gpt-4', 'stackselect_1k', 60.0, samples=200, total=200, seconds=12.5,
+                    prompt_tokens=1000, completion_tokens=50, sequential='stopped')
+    db.rescore('gpt-4', 'stackselect_1k', 61.0, samples=200)
+    latest = db.query(model='gpt-4', dataset='stackselect_1k')[0]
+    assert latest['accuracy'] == 61.0 and latest['seconds'] == 12.5 and latest['total'] == 200
+    assert (latest['prompt_tokens'], latest['completion_tokens']) == (1000, 50)
+    assert latest['extra'] == dict(sequential='stopped', rescored_from=run)
+    assert db.latest() == {'gpt-4_stackselect_1k': 61.0, 'gpt-4_stackselect_1k_sequential': 'stopped'}
+    assert len(db.query(latest=False)) == 2
+
+
+def test_rescore_without_a_run(tmp_path):
+    db = ResultDB(str(tmp_path / 'result.sqlite'))
+    db.rescore('gpt-4', 'textsort_2k', 30.0, samples=10)
+    latest = db.query()[0]
+    assert latest['accuracy'] == 30.0 and latest['seconds'] is None and latest['extra'] == {}
+
+
+def test_journal_mode(tmp_path):
+    pth = str(tmp_path / 'result.sqlite')
+    assert ResultDB(pth, journal_mode='DELETE')._conn().execute('PRAGMA journal_mode').fetchone()[0] == 'delete'
+    assert ResultDB(pth + '.wal', journal_mode='WAL')._conn().execute('PRAGMA journal_mode').fetchone()[0] == 'wal'
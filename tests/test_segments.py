@@ -0,0 +1,36 @@
+import json
+import os
+
+from ada_leval.dataset import TextSort
+from ada_leval.segments import SegmentStore, build
+from ada_leval.synthetic import generate
+
+
+def test_store_rebuilds_prompts(tmp_path):
+    pth = generate('textsort_2k', str(tmp_path), num=30)
+    build(pth)
+    with open(pth, 'r', encoding='utf-8') as fin:
+        records = json.load(fin)
+    store = SegmentStore(pth)
+    assert len(store) == 30
+    head = store.records(5)
+    assert [x['prompt_id'] for x in head] == list(range(5))
+    assert [x['answer'] for x in head] == [x['answer'] for x in records[:5]]
+    assert all(store.prompt(i) == x['prompt'] for i, x in enumerate(records))
+
+
+def test_stale_store_is_ignored(tmp_path, monkeypatch):
+    pth = generate('textsort_2k', str(tmp_path / 'data'), num=30)
+    build(pth)
+    assert SegmentStore.available(pth)
+    # a regenerated file of the same name, the store still describes the old one
+    generate('textsort_2k', str(tmp_path / 'data'), num=30, seed=1)
+    st = os.stat(pth)
+    os.utime(pth, ns=(st.st_atime_ns, st.st_mtime_ns + 1))
+    assert not SegmentStore.available(pth)
+    assert SegmentStore.available(pth, check_source=False)
+    monkeypatch.chdir(tmp_path)
+    ds = TextSort('2k', mode='less')
+    assert ds.segments is None
+    with open(pth, 'r', encoding='utf-8') as fin:
+        assert ds.build_prompt(0) == json.load(fin)[0]['prompt']
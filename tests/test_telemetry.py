@@ -0,0 +1,25 @@
+import gc
+import os
+from functools import partial
+from multiprocessing import Pool
+
+from ada_leval.telemetry import Telemetry
+
+
+def _write(sink, k):
+    # as in pool_dispatch, the sink arrives pickled with every task
+    sink.write(kind='request', index=k)
+    # objects of earlier tests inherited by the fork may close their files when collected
+    gc.collect()
+    return os.getpid(), len(os.listdir('/proc/self/fd'))
+
+
+def test_workers_keep_one_fd(tmp_path):
+    sink = Telemetry(str(tmp_path / 'tel.jsonl'))
+    with Pool(2) as pool:
+        res = pool.map(partial(_write, sink), range(60), chunksize=1)
+    fds = {}
+    for pid, n in res:
+        fds.setdefault(pid, set()).add(n)
+    assert all(len(v) == 1 for v in fds.values())
+    assert sorted(e['index'] for e in sink.events(kind='request')) == list(range(60))
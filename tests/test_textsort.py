@@ -0,0 +1,67 @@
+import json
+import random as rd
+
+import pandas as pd
+
+from ada_leval.dataset import TextSort, extract_order
+
+
+def reference_hit(answer, extracted):
+    # the exact-match loop of TextSort.evaluate in the published results
+    flag = True
+    for aa, ee in zip(answer, extracted):
+        if aa != ee:
+            flag = False
+    return flag
+
+
+def random_prediction(rng):
+    order = rng.sample(range(1, 5), 4)
+    return rng.choice([
+        f'Answer: {order}',
+        f'Answer: {order[:rng.randint(0, 3)]}',
+        f'Answer: {order + [5]}',
+        f'Answer: [1.0, 2, true, "4"]',
+        f"The order is {' then '.join(map(str, order))}.",
+        'Answer: [[1], 2, 3, 4]',
+        'I can not tell.',
+    ])
+
+
+def _dataset():
+    # scoring needs no data file
+    ds = TextSort.__new__(TextSort)
+    ds.setting = 'test'
+    return ds
+
+
+def test_evaluate_matches_published_rule():
+    rng = rd.Random(0)
+    answers = [rng.sample(range(1, 5), 4) for _ in range(3000)]
+    preds = [random_prediction(rng) for _ in answers]
+    df = pd.DataFrame(dict(answer=[json.dumps(a) for a in answers], prediction=preds))
+    ds = _dataset()
+    expected = [reference_hit(a, TextSort.extract(p)) for a, p in zip(answers, preds)]
+    assert ds.evaluate(df.copy()) == 100 * sum(expected) / len(expected)
+    assert [ds.score(dict(answer=a), p) for a, p in zip(answers, preds)] == expected
+    strict = [TextSort.match(a, TextSort.extract(p), strict=True) for a, p in zip(answers, preds)]
+    assert ds.evaluate(df.copy(), strict=True) == 100 * sum(strict) / len(strict)
+    assert sum(strict) < sum(expected)
+
+
+def test_extract_order():
+    assert extract_order('first 3, then 1, 4 and 2') == [3, 1, 4, 2]
+    assert extract_order('3 1 4') == [0, 0, 0, 0]
+    assert extract_order('segments 10 2 1 ... 3', 10) == [0] * 10
+
+
+def test_evaluate_out_of_range_ids():
+    answers = [[1, 2, 3, 4]] * 4
+    preds = ['Answer: [99999999999999999999, 1, 2, 3]', 'Answer: [1, 2, 3, -99999999999999999999]',
+             'Answer: [1e300, 2, 3, 4]', 'Answer: [1, 2, 3, 4]']
+    df = pd.DataFrame(dict(answer=[json.dumps(a) for a in answers], prediction=preds))
+    ds = _dataset()
+    expected = [ds.score(dict(answer=a), p) for a, p in zip(answers, preds)]
+    assert expected == [False, False, False, True]
+    assert ds.evaluate(df.copy()) == 25.0
+    assert ds.evaluate(df.copy(), strict=True, kendall_tau=True) == 25.0
@@ -0,0 +1,72 @@
+import os
+import time
+
+from ada_leval.workqueue import WorkQueue
+
+
+def _expire(wq, k):
+    old = time.time() - 10 * wq.ttl
+    os.utime(wq._path(k, 'lease'), (old, old))
+
+
+def test_claim_and_complete(tmp_path):
+    a = WorkQueue(str(tmp_path), 10, chunk_size=4, worker='a')
+    b = WorkQueue(str(tmp_path), 10, chunk_size=4, worker='b')
+    assert a.claim() == 0 and b.claim() == 1
+    a.complete(0)
+    assert a.is_done(0) and a.claim() == 2 and a.claim() is None
+
+
+def test_stalled_owner_keeps_off_the_new_lease(tmp_path):
+    a = WorkQueue(str(tmp_path), 4, chunk_size=4, ttl=1, worker='a')
+    b = WorkQueue(str(tmp_path), 4, chunk_size=4, ttl=1, worker='b')
+    assert a.claim() == 0
+    _expire(a, 0)
+    assert b.claim() == 0 and b.owns(0) and not a.owns(0)
+    # the stalled worker wakes up: neither its release nor its completion removes b's lease
+    a.release(0)
+    assert b.owns(0)
+    a._tokens[0] = 'stale'
+    a.complete(0)
+    assert b.owns(0)
+
+
+def test_steal_race(tmp_path):
+    a = WorkQueue(str(tmp_path), 4, chunk_size=4, ttl=1, worker='a')
+    b = WorkQueue(str(tmp_path), 4, chunk_size=4, ttl=1, worker='b')
+    c = WorkQueue(str(tmp_path), 4, chunk_size=4, ttl=1, worker='c')
+    assert a.claim() == 0
+    _expire(a, 0)
+    lease = a._path(0, 'lease')
+    seen = c._read(lease)
+    # b steals first, c then tries to take away the lease it saw expired
+    assert b.claim() == 0
+    assert not c._take(lease, seen)
+    assert b.owns(0) and c._read(lease) == b._tokens[0]
+
+
+def test_merge_marker(tmp_path):
+    wq = WorkQueue(str(tmp_path), 4, chunk_size=4)
+    for k in wq.chunks(poll=0):
+        pass
+    assert wq.claim_merge() and not wq.claim_merge()
+    # a failed merge is retried by the next worker
+    wq.merged(ok=False)
+    assert wq.claim_merge()
+    wq.merged()
+    assert not wq.claim_merge()
+
+
+def test_workers_finishing_one_after_the_other(tmp_path):
+    a = WorkQueue(str(tmp_path), 8, chunk_size=4, worker='a')
+    b = WorkQueue(str(tmp_path), 8, chunk_size=4, worker='b')
+    assert a.claim() == 0 and b.claim() == 1
+    # a finishes first and waits in its poll while b still works
+    a.complete(0)
+    assert a.claim() is None and not a.finished()
+    b.complete(1)
+    assert b.claim() is None and b.claim_merge()
+    b.merged()
+    # a wakes up after the merge is over and must not merge (and record the run) again
+    assert a.finished() and not a.claim_merge()
+    assert sorted(os.listdir(tmp_path)) == ['chunk-00000.done', 'chunk-00001.done', 'merge.done']